@@ -0,0 +1,168 @@
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from routing import geocode_point, route_cache_key, snap_points
+from route_cache import route_cache_for
+from routing_engine import as_routing_graph
+from cost_tables import tables_for
+from heuristics import forward_cost_matrix, reverse_cost_matrix
+from contraction_hierarchy import pairs_along
+from multi_objective import _bounded_sweep, _route, _tree_path
+from metrics import count, label, stage, traced
+
+MAX_STRETCH = 1.4  # an alternative costs at most this times the optimal route
+MAX_OVERLAP = 0.6  # share of an alternative's length that may lie on earlier routes
+MIN_PLATEAU = 0.1  # shortest plateau, as a share of the optimal route's cost
+MAX_CANDIDATES = 50
+
+
+def _plateaus(forward_pred, backward_pred, dist_from, dist_to, limit):
+    """
+    Plateaus of the forward tree (from the source) and backward tree (to
+    the target): chains of edges u -> w on both trees, i.e. forward_pred[w]
+    is u and backward_pred[u] is w. The route through any node of a plateau
+    follows the whole plateau, so one candidate per plateau is enough.
+
+    Returns (end, via_cost, plateau_cost) arrays for the plateaus whose
+    route costs at most `limit`, cheapest first; `end` is the plateau's
+    last node.
+    """
+    n = len(forward_pred)
+    via_cost = dist_from + dist_to
+    nodes = np.flatnonzero(via_cost <= limit)
+    parent = forward_pred[nodes]
+    linked = parent >= 0
+    linked[linked] = backward_pred[parent[linked]] == nodes[linked]
+
+    # Plateau start of every node by pointer doubling along the links
+    root = np.arange(n)
+    root[nodes[linked]] = parent[linked]
+    while True:
+        jumped = root[root]
+        if np.array_equal(jumped, root):
+            break
+        root = jumped
+
+    # The last node of a plateau is its member farthest from the source
+    order = nodes[np.lexsort((dist_from[nodes], root[nodes]))]
+    is_end = np.ones(len(order), dtype=bool)
+    is_end[:-1] = root[order[1:]] != root[order[:-1]]
+    end = order[is_end]
+    start = root[end]
+    plateau_cost = dist_from[end] - dist_from[start]
+    by_cost = np.argsort(via_cost[end], kind="stable")
+    return end[by_cost], via_cost[end][by_cost], plateau_cost[by_cost]
+
+
+def _via_path(forward_pred, backward_pred, source, target, via):
+    # Node indices of the shortest path source -> via -> target
+    head = [via]
+    while head[-1] != source:
+        head.append(int(forward_pred[head[-1]]))
+    return head[::-1] + _tree_path(backward_pred, via, target)[1:]
+
+
+@traced("alternative_routes")
+def alternative_routes(G, origin, dest, weather, metric="cost_risk", k=3, max_stretch=MAX_STRETCH,
+                       max_overlap=MAX_OVERLAP, min_plateau=MIN_PLATEAU, max_snap_distance=None, cache=True):
+    """
+    Up to k reasonably different routes between two points, best first.
+
+    One backward sweep from the destination and one forward sweep from the
+    origin, both bounded to max_stretch times the optimal cost, give every
+    candidate at once: the route through a node v is the forward tree path
+    to v followed by the backward tree path from v, at cost
+    dist_from[v] + dist_to[v]. Candidates are taken per plateau (a stretch
+    shared by both trees), which keeps only routes that are locally
+    optimal: a plateau shorter than min_plateau times the optimal cost
+    means a detour made just to pass through v. Candidates are accepted
+    cheapest first when at most max_overlap of their length lies on the
+    routes accepted before. No search is repeated, so k routes cost about
+    two bounded sweeps however large k is.
+
+    Parameters:
+    - G: networkx.MultiDiGraph or RoutingGraph
+    - origin, dest: (lat, lng) tuples or address strings
+    - weather: weather condition of the cost tables
+    - metric: metric the routes minimize, e.g. 'cost_risk'
+    - k: maximum number of routes
+    - max_stretch, max_overlap, min_plateau: see above
+    - max_snap_distance: see astar_route
+    - cache: use the graph's RouteCache (see route_options); cached results
+             are shared, so treat the returned routes as read-only
+
+    Returns a list of routes; fewer than k when there are not enough
+    different routes. Every route is a dict with node_path, edge_path (which
+    plot_route draws directly), road_names, total_time (hours), total_risk
+    (sum of cost_risk), cost (sum of `metric`) and overlap: the share of the
+    route's length on the routes before it (0 for the first).
+    """
+    label(weather=weather, metric=metric)
+    with stage("geocode"):
+        origin = geocode_point(origin)
+        dest = geocode_point(dest)
+    rg = as_routing_graph(G)
+    tables = tables_for(rg)
+    with stage("snap"):
+        source, target = snap_points(rg, origin, dest, max_snap_distance)
+
+    key = None
+    if cache:
+        key = route_cache_key(rg, source, target, weather,
+                              ("alternative_routes", metric, k, max_stretch, max_overlap, min_plateau))
+        result = route_cache_for(rg).get(key)
+        if result is not None:
+            count(cache_hits=1)
+            return result
+
+    reduced = tables.reduced(weather, metric)
+    time_costs = tables.get(weather, "cost_time")
+    risk_costs = tables.get(weather, "cost_risk")
+    with stage("sweeps"):
+        dist_to, backward_pred, limit = _bounded_sweep(rg, reduced, source, target)
+        if not np.isfinite(dist_to[source]):
+            raise nx.NetworkXNoPath(f"No path between {origin} and {dest}")
+        optimum = float(dist_to[source])
+        bound = max_stretch * optimum
+        if limit < bound:
+            dist_to, backward_pred = dijkstra(reverse_cost_matrix(rg, reduced), indices=target,
+                                              return_predecessors=True, limit=bound)
+        dist_from, forward_pred = dijkstra(forward_cost_matrix(rg, reduced), indices=source,
+                                           return_predecessors=True, limit=bound)
+
+    with stage("candidates"):
+        ends, via_costs, plateau_costs = _plateaus(forward_pred, backward_pred, dist_from, dist_to, bound)
+
+    def make_route(pairs, cost, overlap):
+        route = _route(rg, source, pairs, reduced.best_edge, time_costs, risk_costs)
+        route.update(cost=cost, overlap=overlap)
+        return route
+
+    with stage("select"):
+        path_pairs = pairs_along(rg, _tree_path(backward_pred, source, target))
+        routes = [make_route(path_pairs, optimum, 0.0)]
+        used = set(path_pairs)
+        tried = 0
+        for end, via_cost, plateau_cost in zip(ends.tolist(), via_costs.tolist(), plateau_costs.tolist()):
+            if len(routes) == k or tried == MAX_CANDIDATES:
+                break
+            if plateau_cost < min_plateau * optimum or end in (source, target):
+                continue
+            nodes = _via_path(forward_pred, backward_pred, source, target, end)
+            if len(set(nodes)) < len(nodes):
+                continue  # the two tree paths cross: not a simple route
+            tried += 1
+            path_pairs = pairs_along(rg, nodes)
+            lengths = rg.edge_length[reduced.best_edge[path_pairs]]
+            shared = float(lengths[[p in used for p in path_pairs]].sum())
+            overlap = shared / float(lengths.sum()) if lengths.sum() > 0 else 1.0
+            if overlap > max_overlap:
+                continue
+            routes.append(make_route(path_pairs, via_cost, overlap))
+            used.update(path_pairs)
+    count(routes=len(routes), candidates=len(ends))
+
+    if key is not None:
+        route_cache_for(rg).put(key, routes)
+    return routes
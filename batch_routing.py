@@ -0,0 +1,162 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from routing_engine import ReducedCosts, as_routing_graph, astar
+from cost_tables import tables_for
+from graph_snapshot import load_snapshot
+from heuristics import distance_scale, scaled_haversine
+from spatial_index import spatial_index_for
+
+# Status codes of batch results
+OK = 0
+NO_PATH = 1
+NOT_SNAPPED = 2
+
+_worker = {}
+
+
+def _init_worker(rg, snapshot_path, cost_dir, scale):
+    # Graph and costs are memory-mapped read-only, so every worker shares the
+    # same pages; only the Python lists used by the search loop are private
+    if rg is None:
+        rg = load_snapshot(snapshot_path)
+    pair_cost = np.load(os.path.join(cost_dir, "pair_cost.npy"), mmap_mode="r")
+    best_edge = np.load(os.path.join(cost_dir, "best_edge.npy"), mmap_mode="r")
+    reduced = ReducedCosts(pair_cost, best_edge)
+    reduced.scale = scale
+    _worker.update(
+        rg=rg,
+        reduced=reduced,
+        edge_cost=np.load(os.path.join(cost_dir, "edge_cost.npy"), mmap_mode="r"),
+        edge_time=np.load(os.path.join(cost_dir, "edge_time.npy"), mmap_mode="r"),
+    )
+
+
+def _route_chunk(task):
+    rows, sources, targets, return_paths = task
+    rg, reduced = _worker["rg"], _worker["reduced"]
+    edge_cost, edge_time = _worker["edge_cost"], _worker["edge_time"]
+
+    n = len(rows)
+    status = np.full(n, NOT_SNAPPED, dtype=np.int8)
+    cost = np.full(n, np.nan)
+    time = np.full(n, np.nan)
+    count = np.zeros(n, dtype=np.int32)
+    paths = [np.empty(0, dtype=np.int64)] * n
+    for i, (s, t) in enumerate(zip(sources.tolist(), targets.tolist())):
+        if s < 0 or t < 0:
+            continue
+        pairs = astar(rg, s, t, reduced.cost_list, scaled_haversine(rg, t, reduced.scale))
+        if pairs is None:
+            status[i] = NO_PATH
+            continue
+        edges = np.asarray(reduced.best_edge[pairs], dtype=np.int64)
+        status[i] = OK
+        cost[i] = edge_cost[edges].sum()
+        time[i] = edge_time[edges].sum()
+        count[i] = len(edges)
+        if return_paths:
+            paths[i] = edges
+    return rows, status, cost, time, count, (paths if return_paths else None)
+
+
+def batch_route(G, origin_lat, origin_lng, dest_lat, dest_lng, weather, metric,
+                processes=None, return_paths=False, chunk_size=64, snapshot_path=None,
+                max_snap_distance=None):
+    """
+    Route many origin/destination pairs at once.
+
+    All points are snapped in one vectorized KD-tree query, then the searches
+    are spread over a process pool. Workers share one read-only copy of the
+    graph (memory-mapped from `snapshot_path` when given, otherwise inherited
+    from the parent on fork) and of the reduced cost vector.
+
+    Parameters:
+    - G: networkx.MultiDiGraph or RoutingGraph
+    - origin_lat, origin_lng, dest_lat, dest_lng: equal-length coordinate arrays
+    - weather, metric: cost table to route on (e.g. "Rain", "cost_risk")
+    - processes: pool size; None uses all cores, 1 runs in this process
+    - return_paths: also return the edge indices of every route
+    - chunk_size: number of trips per task sent to a worker
+    - snapshot_path: graph snapshot the workers memory-map instead of inheriting G;
+                     required with a process pool where fork is unavailable (Windows)
+    - max_snap_distance: see astar_route
+
+    Returns a dict of columns, one row per trip:
+    - status: OK, NO_PATH or NOT_SNAPPED
+    - cost: total cost in `metric`
+    - time: total travel time in hours
+    - edge_count: number of edges on the route
+    - path_offsets, path_edges (with return_paths): route i is
+      path_edges[path_offsets[i]:path_offsets[i + 1]], as RoutingGraph edge
+      indices (see RoutingGraph.edge_tuple)
+    """
+    rg = as_routing_graph(G)
+    tables = tables_for(rg)
+    reduced = tables.reduced(weather, metric)
+    scale = distance_scale(rg, reduced)
+
+    index = spatial_index_for(rg)
+    sources, _ = index.nearest_nodes(origin_lat, origin_lng, max_distance=max_snap_distance)
+    targets, _ = index.nearest_nodes(dest_lat, dest_lng, max_distance=max_snap_distance)
+    n = len(sources)
+
+    rows = np.arange(n)
+    tasks = [(rows[i:i + chunk_size], sources[i:i + chunk_size], targets[i:i + chunk_size], return_paths)
+             for i in range(0, n, chunk_size)]
+
+    if processes == 1:
+        # In this process the cost arrays are used as they are, without the
+        # round trip through files (e.g. batches served by routing_server)
+        _worker.update(rg=rg, reduced=reduced, edge_cost=tables.get(weather, metric),
+                       edge_time=tables.get(weather, "cost_time"))
+        try:
+            results = [_route_chunk(task) for task in tasks]
+        finally:
+            _worker.clear()
+    else:
+        # Only fork hands the in-memory graph to the workers; spawn would
+        # pickle it, with its cost tables and their lock
+        fork = "fork" in mp.get_all_start_methods()
+        if not fork and snapshot_path is None:
+            raise ValueError("batch_route needs snapshot_path for processes != 1 on platforms without fork "
+                             "(write one with graph_snapshot.write_snapshot)")
+        cost_dir = tempfile.mkdtemp(prefix="batch_costs_")
+        try:
+            np.save(os.path.join(cost_dir, "pair_cost.npy"), reduced.pair_cost)
+            np.save(os.path.join(cost_dir, "best_edge.npy"), reduced.best_edge)
+            np.save(os.path.join(cost_dir, "edge_cost.npy"), tables.get(weather, metric))
+            np.save(os.path.join(cost_dir, "edge_time.npy"), tables.get(weather, "cost_time"))
+            initargs = (None if snapshot_path else rg, snapshot_path, cost_dir, scale)
+            ctx = mp.get_context("fork" if fork else None)
+            with ctx.Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+                results = list(pool.imap_unordered(_route_chunk, tasks))
+        finally:
+            _worker.clear()
+            shutil.rmtree(cost_dir, ignore_errors=True)
+
+    status = np.full(n, NOT_SNAPPED, dtype=np.int8)
+    cost = np.full(n, np.nan)
+    time = np.full(n, np.nan)
+    count = np.zeros(n, dtype=np.int32)
+    paths = [None] * n
+    for chunk_rows, chunk_status, chunk_cost, chunk_time, chunk_count, chunk_paths in results:
+        status[chunk_rows] = chunk_status
+        cost[chunk_rows] = chunk_cost
+        time[chunk_rows] = chunk_time
+        count[chunk_rows] = chunk_count
+        if return_paths:
+            for r, p in zip(chunk_rows.tolist(), chunk_paths):
+                paths[r] = p
+
+    result = {"status": status, "cost": cost, "time": time, "edge_count": count}
+    if return_paths:
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(count)
+        result["path_offsets"] = offsets
+        result["path_edges"] = np.concatenate(paths) if n else np.empty(0, dtype=np.int64)
+    return result
@@ -0,0 +1,110 @@
+"""
+Correctness check of corridor_route against astar_route.
+
+Run from the repository root:
+    python -m benchmarks.corridor_check --nodes 2500
+
+benchmarks.run runs the same check before it times corridor_route. Every
+trip is routed in each of CORRIDOR_MODES; corridors are shared between the
+trips of a mode, so routes served by a reused corridor are checked too.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import routing_utils as ru
+from corridor import corridor_cache_for, corridor_route
+from routing import astar_route
+from routing_engine import as_routing_graph
+from benchmarks.synthetic import geometric_graph, grid_graph, od_pairs, write_risk_maps
+
+# corridor_route settings the check runs with: the defaults, a first
+# corridor that only just holds the straight line (so most routes need more
+# rounds) and corridors that are always too large (so every query falls
+# back to A* on the full graph)
+CORRIDOR_MODES = {
+    "default": {},
+    "narrow": {"initial_factor": 1.0, "min_margin": 0.0},
+    "fallback": {"max_share": 0.0},
+}
+
+
+def check_corridor_routes(G, trips, metric, weather):
+    """
+    Compare corridor_route with astar_route on `trips` in every
+    CORRIDOR_MODES setting. Returns a list of problems: route costs that
+    differ, or a mode that never took its path (no query needing a second
+    round, or one not falling back to the full graph).
+    """
+    problems = []
+    expected = [ru.route_cost(G, astar_route(G, o, d, metric, weather, cache=False)[1], metric, weather)
+                for o, d in trips]
+    corridors = corridor_cache_for(as_routing_graph(G))
+    for mode, settings in CORRIDOR_MODES.items():
+        corridors.clear()
+        regrown = 0
+        for (origin, dest), cost in zip(trips, expected):
+            trip = "({:.5f}, {:.5f}) -> ({:.5f}, {:.5f})".format(*origin, *dest)
+            stats = {}
+            _, edge_path, _ = corridor_route(G, origin, dest, metric, weather, stats=stats, cache=False,
+                                             **settings)
+            got = ru.route_cost(G, edge_path, metric, weather)
+            if not np.isclose(got, cost, rtol=1e-9, atol=0):
+                problems.append(f"{mode} {metric} {trip}: corridor {got!r}, A* {cost!r}")
+            if mode == "fallback" and stats["corridor_nodes"] != 0:
+                problems.append(f"{mode} {metric} {trip}: no fallback to the full graph")
+            regrown += stats["rounds"] > 1
+        if mode == "narrow" and trips and not regrown:
+            problems.append(f"{mode} {metric}: no query needed a second corridor")
+    corridors.clear()
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check corridor_route against astar_route.")
+    parser.add_argument("--graph", choices=("grid", "geometric"), default="grid")
+    parser.add_argument("--nodes", type=int, default=2500)
+    parser.add_argument("--trips", type=int, default=30)
+    parser.add_argument("--max-offset", type=float, default=1500, help="meters, see od_pairs")
+    parser.add_argument("--weather", default="Rain")
+    args = parser.parse_args(argv)
+
+    if args.graph == "grid":
+        G = grid_graph(int(round(np.sqrt(args.nodes))))
+    else:
+        G = geometric_graph(args.nodes)
+    rg = as_routing_graph(G)
+
+    # Risk maps are written to a scratch directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="corridor_check_")
+    try:
+        os.chdir(workdir)
+        write_risk_maps(rg.names, "risk_maps")
+        trips = []
+        for origin, dest in od_pairs(G, 4 * args.trips, max_offset=args.max_offset):
+            try:
+                astar_route(G, origin, dest, "cost_time", args.weather, cache=False)
+            except Exception:
+                continue
+            trips.append((origin, dest))
+            if len(trips) == args.trips:
+                break
+        problems = []
+        for metric in ("cost_time", "cost_risk"):
+            problems += check_corridor_routes(G, trips, metric, args.weather)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    print(f"{len(trips)} trips, {len(problems)} problems")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
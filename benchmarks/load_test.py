@@ -0,0 +1,287 @@
+"""
+Load test of routing_server on localhost.
+
+Run from the repository root:
+    python -m benchmarks.load_test --nodes 10000 --workers 4 --concurrency 16
+    python -m benchmarks.load_test --url http://127.0.0.1:8765 --endpoint batch
+
+Without --url a synthetic street grid, its snapshot and risk maps are
+written to a scratch directory and a server is started on a free local
+port for the run. --concurrency clients each send requests back to back on
+one keep-alive connection until --requests have been sent (a closed loop,
+so throughput is what the server sustains at that concurrency). Latency
+percentiles are over the successful requests; 503 answers (backpressure)
+are counted separately, as are the server's queue and compute times from
+the Server-Timing header. With --output the summary is also saved as JSON.
+
+Before the load, invalid requests (unknown weather, job or path, malformed
+JSON) are sent once; the run stops if any of them gets a status other than
+the expected 4xx.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEATHER = "Rain"
+LA_BOUNDS = (33.70, -118.67, 34.34, -118.15)  # (min_lat, min_lng, max_lat, max_lng)
+MAX_SNAP_DISTANCE = 500  # meters
+STARTUP_TIMEOUT = 300  # seconds for the server's workers to load
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, process=None, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Routing server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/health", timeout=5) as response:
+                return json.loads(response.read())
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Routing server at {url} did not start within {timeout} s")
+
+
+def start_synthetic_server(workdir, nodes, workers, queue):
+    """
+    Write a synthetic grid's snapshot and risk maps to `workdir` and start a
+    routing server on it; returns (process, url, bounds of the grid).
+    """
+    from benchmarks.run import make_graph
+    from benchmarks.synthetic import bounds, write_risk_maps
+    from graph_snapshot import write_snapshot
+    from routing_engine import as_routing_graph
+    from spatial_index import spatial_index_for
+
+    G = make_graph("grid", nodes)
+    rg = as_routing_graph(G)
+    snapshot = os.path.join(workdir, "synthetic.graph")
+    write_snapshot(rg, snapshot)
+    spatial_index_for(rg, snapshot + ".kdtree")
+    write_risk_maps(rg.names, os.path.join(workdir, "risk_maps"))
+
+    port = free_port()
+    command = [sys.executable, os.path.join(REPO, "routing_server.py"), "--port", str(port),
+               "--snapshot", snapshot, "--queue", str(queue), "--weathers", WEATHER]
+    if workers:
+        command += ["--workers", str(workers)]
+    # The server reads risk_maps/ from its working directory
+    process = subprocess.Popen(command, cwd=workdir)
+    return process, f"http://127.0.0.1:{port}", bounds(G)
+
+
+# (path, body, expected status) of requests the server must reject
+INVALID_REQUESTS = [
+    ("/route", {"origin": [0, 0], "dest": [0, 0], "weather": "No such weather"}, 400),
+    ("/batch", {"trips": [[0, 0, 0, 0]], "weather": "No such weather"}, 400),
+    ("/matrix", {"origins": [[0, 0]], "destinations": [[0, 0]], "weather": "No such weather"}, 400),
+    ("/route", {"origin": [0, 0], "dest": [0, 0], "weather": WEATHER, "job": "fastest"}, 400),
+    ("/route", {"origin": [0, 0], "dest": [0, 0], "weather": WEATHER, "job": "alternatives", "k": 0}, 400),
+    ("/route", {"origin": [0, 0], "dest": [0, 0], "weather": WEATHER, "job": "alternatives", "k": [3]}, 400),
+    ("/route", {"origin": [True, 0], "dest": [0, 0], "weather": WEATHER}, 400),
+    ("/route", {"origin": [0, 0], "dest": [0, 0], "weather": WEATHER, "max_snap_distance": -1}, 400),
+    ("/route", b"{not json", 400),
+    ("/nowhere", {}, 404),
+]
+
+
+def check_errors(url):
+    """Send INVALID_REQUESTS; raises RuntimeError when one is not answered with its expected status."""
+    failures = []
+    for path, body, expected in INVALID_REQUESTS:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        request = urllib.request.Request(url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        if status != expected:
+            failures.append(f"POST {path} {data[:80]!r}: {status}, expected {expected}")
+    if failures:
+        raise RuntimeError("Invalid requests answered wrongly:\n" + "\n".join(failures))
+
+
+def make_bodies(endpoint, count, area, job, batch_size, matrix_size, seed=0):
+    """`count` request bodies with random points inside `area` (min_lat, min_lng, max_lat, max_lng)."""
+    rng = np.random.default_rng(seed)
+    min_lat, min_lng, max_lat, max_lng = area
+
+    def points(n):
+        return np.column_stack((rng.uniform(min_lat, max_lat, n), rng.uniform(min_lng, max_lng, n))).tolist()
+
+    bodies = []
+    for _ in range(count):
+        if endpoint == "route":
+            origin, dest = points(2)
+            body = {"origin": origin, "dest": dest, "job": job}
+        elif endpoint == "batch":
+            body = {"trips": np.hstack((points(batch_size), points(batch_size))).tolist(), "metric": "cost_time"}
+        else:
+            body = {"origins": points(matrix_size), "destinations": points(matrix_size), "metric": "cost_time"}
+        body.update(weather=WEATHER, max_snap_distance=MAX_SNAP_DISTANCE)
+        bodies.append(json.dumps(body).encode())
+    return bodies
+
+
+def parse_server_timing(header):
+    """{name: milliseconds} from a Server-Timing header."""
+    timing = {}
+    for part in header.split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if dur:
+            timing[name] = float(dur)
+    return timing
+
+
+def run_load(url, endpoint, bodies, concurrency):
+    """
+    Send every body to `endpoint` from `concurrency` threads; returns a list
+    of (status, seconds, Server-Timing dict) per request.
+    """
+    parsed = urllib.parse.urlparse(url)
+    results = []
+    lock = threading.Lock()
+    remaining = iter(bodies)
+
+    def client():
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=120)
+        while True:
+            with lock:
+                body = next(remaining, None)
+            if body is None:
+                break
+            start = time.perf_counter()
+            try:
+                connection.request("POST", "/" + endpoint, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                status, timing = response.status, parse_server_timing(response.getheader("Server-Timing", ""))
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status, timing = "connection error", {}
+            elapsed = time.perf_counter() - start
+            with lock:
+                results.append((status, elapsed, timing))
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def summarize(results, wall):
+    statuses = Counter(status for status, _, _ in results)
+    ok = [(seconds, timing) for status, seconds, timing in results if status == 200]
+    latency = np.array([seconds for seconds, _ in ok]) * 1e3
+    summary = {
+        "requests": len(results),
+        "seconds": wall,
+        "throughput": len(ok) / wall if wall > 0 else 0.0,  # successful requests per second
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "rejected": statuses.get(503, 0),
+    }
+    if len(latency):
+        summary.update({f"p{q}_ms": float(np.percentile(latency, q)) for q in (50, 90, 95, 99)})
+        summary["max_ms"] = float(latency.max())
+        for name in ("queue", "compute"):
+            values = [timing[name] for _, timing in ok if name in timing]
+            if values:
+                summary[f"server_{name}_mean_ms"] = float(np.mean(values))
+    return summary
+
+
+def print_summary(summary):
+    print(f"{summary['requests']} requests in {summary['seconds']:.1f} s: "
+          f"{summary['throughput']:.1f} successful requests/s")
+    print("Statuses: " + ", ".join(f"{k}: {v}" for k, v in summary["statuses"].items()))
+    if "p50_ms" in summary:
+        print("Latency: " + ", ".join(f"p{q} {summary[f'p{q}_ms']:.1f} ms" for q in (50, 90, 95, 99))
+              + f", max {summary['max_ms']:.1f} ms")
+    if "server_compute_mean_ms" in summary:
+        print(f"Server: queue {summary.get('server_queue_mean_ms', 0):.1f} ms, "
+              f"compute {summary['server_compute_mean_ms']:.1f} ms on average")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of routing_server on localhost.")
+    parser.add_argument("--url", help="running server to test; default: start one on a synthetic grid")
+    parser.add_argument("--nodes", type=int, default=10_000, help="nodes of the synthetic grid")
+    parser.add_argument("--workers", type=int, help="worker processes of the started server")
+    parser.add_argument("--queue", type=int, default=32, help="queue slots of the started server")
+    parser.add_argument("--endpoint", choices=("route", "batch", "matrix"), default="route")
+    parser.add_argument("--job", default="cost_risk", help="job of /route requests")
+    parser.add_argument("--batch-size", type=int, default=100, help="trips per /batch request")
+    parser.add_argument("--matrix-size", type=int, default=10, help="origins and destinations per /matrix request")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent first and not measured")
+    parser.add_argument("--output", help="save the summary as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    process = workdir = None
+    try:
+        if args.url:
+            url, area = args.url.rstrip("/"), LA_BOUNDS
+        else:
+            workdir = tempfile.mkdtemp(prefix="load_test_")
+            print(f"Starting a routing server on a {args.nodes}-node synthetic grid...")
+            process, url, area = start_synthetic_server(workdir, args.nodes, args.workers, args.queue)
+        health = wait_for_server(url, process)
+        print(f"Server ready: {health['workers']} workers, {health['capacity']} requests at most")
+        check_errors(url)
+
+        bodies = make_bodies(args.endpoint, args.warmup + args.requests, area, args.job,
+                             args.batch_size, args.matrix_size)
+        run_load(url, args.endpoint, bodies[:args.warmup], args.concurrency)
+        start = time.perf_counter()
+        results = run_load(url, args.endpoint, bodies[args.warmup:], args.concurrency)
+        summary = summarize(results, time.perf_counter() - start)
+        summary.update(endpoint=args.endpoint, concurrency=args.concurrency, workers=health["workers"],
+                       capacity=health["capacity"])
+        print_summary(summary)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=1)
+            print(f"Saved: {args.output}")
+    finally:
+        if process is not None:
+            # SIGINT lets the server shut its worker pool down
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
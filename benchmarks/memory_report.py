@@ -0,0 +1,197 @@
+"""
+Resident memory of the routing app's graph, before and after the compact
+RoutingGraph store.
+
+Run from the repository root:
+    python -m benchmarks.memory_report --nodes 90000
+    python -m benchmarks.memory_report --graphml data/la.graphml --output memory.json
+
+A synthetic grid (or the given GraphML) is written as GraphML and as a
+graph snapshot to a scratch directory, then every scenario runs in its own
+fresh Python process:
+- networkx: load_graph(snapshot=False), i.e. the GraphML loaded into a
+  MultiDiGraph with a dict per edge, get_edge_data writing the cost
+  attributes, a route on the attributes and plot_route
+- snapshot: the memory-mapped RoutingGraph load_graph returns, with the
+  weather's cost table, a route and plot_route (the Streamlit process)
+- worker: a route_jobs worker, whose cost tables of all --weathers are
+  built up front, answering routes and route options for each of them
+
+After every step the process's RSS, its private (anonymous) memory and its
+peak RSS so far are recorded. Snapshot pages are file-backed and shared by
+every process that maps the snapshot, so private memory is what each extra
+worker costs. Linux only (/proc/self).
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("networkx", "snapshot", "worker")
+WEATHER = "Rain"
+WEATHERS = ("Clear", "Partially cloudy", "Overcast", "Rain")
+QUERIES = 5
+
+
+def memory():
+    """(rss, private, peak) of this process in MB."""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            values[name] = value
+    rss = int(values["VmRSS"].split()[0]) / 1024
+    private = rss
+    if os.path.exists("/proc/self/smaps_rollup"):
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Anonymous:"):
+                    private = int(line.split()[1]) / 1024
+    # VmHWM starts afresh with the process; ru_maxrss would include the parent's
+    peak = int(values["VmHWM"].split()[0]) / 1024
+    return rss, private, peak
+
+
+def run_scenario(scenario, workdir):
+    """Run one scenario in this process; returns [(step, rss, private, peak)]."""
+    import folium
+    import routing_utils as ru
+    import route_jobs
+    from graph_snapshot import load_snapshot, read_header
+    from routing import astar_route
+    from spatial_index import spatial_index_for
+
+    steps = []
+
+    def record(step):
+        gc.collect()
+        steps.append((step, *memory()))
+
+    graphml = os.path.join(workdir, "graph.graphml")
+    snapshot = os.path.join(workdir, "graph.snapshot")
+    pairs = [(tuple(o), tuple(d)) for o, d in read_header(snapshot)["meta"]["pairs"]]
+    record("imports")
+
+    if scenario == "networkx":
+        ru.GRAPHML_PATH = graphml
+        G = ru.load_graph(snapshot=False)
+        record("load")
+        ru.get_edge_data(G, WEATHER)
+        record("costs")
+        weight, weather = "cost_risk", None
+    else:
+        G = load_snapshot(snapshot)
+        spatial_index_for(G, snapshot + ".kdtree")
+        record("load")
+        if scenario == "worker":
+            route_jobs._init_worker(snapshot, snapshot + ".kdtree", WEATHERS)
+            G = route_jobs._worker["rg"]
+        else:
+            from cost_tables import tables_for
+            tables_for(G).get(WEATHER, "cost_risk")
+        record("costs")
+        weight, weather = "cost_risk", WEATHER
+
+    routes = []
+    for origin, dest in pairs:
+        try:
+            routes.append((origin, dest, astar_route(G, origin, dest, weight, weather, cache=False)[1]))
+        except Exception:
+            continue
+    if scenario == "worker":
+        for w in WEATHERS:
+            for origin, dest in pairs:
+                try:
+                    route_jobs.run_job("options", origin, dest, w)
+                    route_jobs.run_job("cost_time", origin, dest, w)
+                except Exception:
+                    continue
+    record("route")
+
+    for origin, dest, edge_path in routes:
+        m = folium.Map(location=origin, zoom_start=13)
+        ru.plot_route(G, edge_path, m, "cost_risk", origin, dest, weather)
+        m.get_root().render()
+    record("plot")
+    return steps
+
+
+def prepare(workdir, nodes, graphml=None):
+    """Write the GraphML, snapshot and risk maps the scenarios load."""
+    import osmnx as ox
+    from benchmarks.run import make_graph
+    from benchmarks.synthetic import od_pairs, write_risk_maps
+    from graph_snapshot import write_snapshot
+    from routing_engine import from_networkx
+    from spatial_index import spatial_index_for
+
+    G = ox.load_graphml(graphml) if graphml else make_graph("grid", nodes)
+    ox.save_graphml(G, os.path.join(workdir, "graph.graphml"))
+    rg = from_networkx(G)
+    snapshot = os.path.join(workdir, "graph.snapshot")
+    write_snapshot(rg, snapshot, meta={"pairs": od_pairs(G, QUERIES)})
+    spatial_index_for(rg, snapshot + ".kdtree")
+    write_risk_maps(rg.names, os.path.join(workdir, "risk_maps"))
+    return G.number_of_nodes(), G.number_of_edges()
+
+
+def print_report(results):
+    print(f"\n{'scenario':10s} {'step':8s} {'RSS MB':>9s} {'private MB':>11s} {'peak MB':>9s}")
+    for scenario, steps in results.items():
+        for step, rss, private, peak in steps:
+            print(f"{scenario:10s} {step:8s} {rss:9.1f} {private:11.1f} {peak:9.1f}")
+    if "networkx" in results and "snapshot" in results:
+        # Memory of the graph and its costs: growth over the imports
+        def graph_mb(steps, column):
+            return steps[-1][column] - steps[0][column]
+        for label, column in (("RSS", 1), ("private", 2), ("peak RSS", 3)):
+            before, after = graph_mb(results["networkx"], column), graph_mb(results["snapshot"], column)
+            ratio = f"{before / after:.1f}x less" if after > 0 else "n/a"
+            print(f"Graph {label}: networkx {before:.1f} MB, snapshot {after:.1f} MB ({ratio})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="RSS of the networkx graph vs the RoutingGraph snapshot.")
+    parser.add_argument("--nodes", type=int, default=90_000, help="nodes of the synthetic grid")
+    parser.add_argument("--graphml", help="measure this GraphML (e.g. data/la.graphml) instead")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--output", help="save the measurements as JSON")
+    parser.add_argument("--scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.scenario:
+        # Child process: one scenario, measurements as JSON on the last line
+        os.chdir(args.workdir)
+        print(json.dumps(run_scenario(args.scenario, args.workdir)))
+        return
+
+    graphml = os.path.abspath(args.graphml) if args.graphml else None
+    workdir = tempfile.mkdtemp(prefix="memory_report_")
+    try:
+        nodes, edges = prepare(workdir, args.nodes, graphml)
+        print(f"Graph: {nodes} nodes, {edges} edges")
+        results = {}
+        for scenario in args.scenarios:
+            out = subprocess.run([sys.executable, "-m", "benchmarks.memory_report", "--scenario", scenario,
+                                  "--workdir", workdir], cwd=REPO, capture_output=True, text=True, check=True)
+            results[scenario] = json.loads(out.stdout.strip().splitlines()[-1])
+        print_report(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"nodes": nodes, "edges": edges, "results": results}, f, indent=1)
+            print(f"Saved: {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
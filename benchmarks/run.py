@@ -0,0 +1,342 @@
+"""
+Offline benchmark suite.
+
+Run from the repository root:
+    python -m benchmarks.run --sizes small medium
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Every benchmark runs on synthetic OSMnx-style graphs (a street grid and a
+random geometric graph per size) with synthetic risk maps and accidents,
+so no network access or project data is needed. Timings are the best of
+--repeat runs; peak memory is what tracemalloc sees during one extra run
+(Python and NumPy allocations). Results are written as JSON and, with
+--baseline, compared against an earlier results file; the exit code is 1
+when a benchmark got slower than the tolerance allows. Before corridor_route
+is timed, its routes are checked against astar_route (see
+benchmarks/corridor_check.py), and alternative_routes is checked on the
+same trips and on an unreachable destination (see check_alternatives); the
+run stops on a failed check. It also stops when corridor_route is not
+faster than astar_route on short trips that mostly fit in a corridor.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import folium
+import numpy as np
+
+import risk_map_gen
+import routing_utils as ru
+from routing import astar_route
+import alternatives
+from corridor import corridor_cache_for, corridor_route
+from multi_objective import route_options
+from routing_engine import as_routing_graph, from_networkx, normalize_name
+from route_cache import route_cache_for
+from spatial_index import SpatialIndex
+from benchmarks.corridor_check import CORRIDOR_MODES, check_corridor_routes
+from benchmarks.synthetic import (add_island, geometric_graph, grid_graph, od_pairs, write_accidents,
+                                  write_risk_maps)
+
+SIZES = {
+    "small": {"nodes": 900, "accidents": 20_000, "queries": 20},
+    "medium": {"nodes": 10_000, "accidents": 200_000, "queries": 20},
+    "large": {"nodes": 90_000, "accidents": 1_000_000, "queries": 10},
+}
+GRAPHS = ("grid", "geometric")
+WEATHER = "Rain"
+SHORT_TRIP = 1500  # meters, largest north/south and east/west offset of short trips
+
+# Seconds a query to an unreachable destination may take before the check
+# reports it as hanging
+UNREACHABLE_TIMEOUT = 60
+
+
+def measure(fn, repeat=3, setup=None):
+    """
+    Time fn(*setup()) `repeat` times, then once more under tracemalloc.
+    Returns a dict with best and mean seconds and peak_mb.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"best": min(times), "mean": float(np.mean(times)), "peak_mb": peak / 2 ** 20}
+
+
+def make_graph(kind, nodes, seed=0):
+    if kind == "grid":
+        return grid_graph(int(round(np.sqrt(nodes))), seed=seed)
+    return geometric_graph(nodes, seed=seed)
+
+
+def routable_pairs(G, count, max_offset=None):
+    # Keep the pairs with a route, so every benchmark times the same trips
+    pairs = []
+    for origin, dest in od_pairs(G, 4 * count, max_offset=max_offset):
+        try:
+            astar_route(G, origin, dest, "cost_time", WEATHER, cache=False)
+        except Exception:
+            continue
+        pairs.append((origin, dest))
+        if len(pairs) == count:
+            break
+    return pairs
+
+
+def _outcome(fn, timeout=UNREACHABLE_TIMEOUT):
+    # Name of the exception fn() raises; run in a thread so that a search
+    # which never ends fails the check instead of hanging it
+    outcome = []
+
+    def run():
+        try:
+            fn()
+            outcome.append("a route")
+        except Exception as e:
+            outcome.append(type(e).__name__)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return outcome[0] if outcome else f"no answer within {timeout} s"
+
+
+def check_alternatives(G, trips, metric):
+    """
+    Check alternative_routes on `trips`: the first route is the astar_route
+    optimum, every route's cost is its edges' cost within MAX_STRETCH of the
+    optimum and its overlap within MAX_OVERLAP. Then route from the first
+    trip's origin to an island added to a copy of G: astar_route,
+    route_options and alternative_routes must all raise NetworkXNoPath.
+    Returns a list of problems.
+    """
+    problems = []
+    for origin, dest in trips:
+        trip = "({:.5f}, {:.5f}) -> ({:.5f}, {:.5f})".format(*origin, *dest)
+        optimum = ru.route_cost(G, astar_route(G, origin, dest, metric, WEATHER, cache=False)[1], metric, WEATHER)
+        routes = alternatives.alternative_routes(G, origin, dest, WEATHER, metric, cache=False)
+        if not np.isclose(routes[0]["cost"], optimum, rtol=1e-9, atol=0):
+            problems.append(f"{metric} {trip}: first route {routes[0]['cost']!r}, A* {optimum!r}")
+        for i, route in enumerate(routes):
+            cost = ru.route_cost(G, route["edge_path"], metric, WEATHER)
+            if not np.isclose(route["cost"], cost, rtol=1e-9, atol=0):
+                problems.append(f"{metric} {trip}: route {i} reports {route['cost']!r}, its edges cost {cost!r}")
+            if cost > alternatives.MAX_STRETCH * optimum * (1 + 1e-9) or route["overlap"] > alternatives.MAX_OVERLAP:
+                problems.append(f"{metric} {trip}: route {i} stretch {cost / optimum:.3f}, "
+                                f"overlap {route['overlap']:.3f}")
+
+    H = G.copy()
+    island = add_island(H)
+    origin = trips[0][0]
+    for name, fn in (("astar_route", lambda: astar_route(H, origin, island, metric, WEATHER, cache=False)),
+                     ("route_options", lambda: route_options(H, origin, island, WEATHER, cache=False)),
+                     ("alternative_routes", lambda: alternatives.alternative_routes(
+                         H, origin, island, WEATHER, metric, cache=False))):
+        outcome = _outcome(fn)
+        if outcome != "NetworkXNoPath":
+            problems.append(f"{metric} {name} to an unreachable point: {outcome}, expected NetworkXNoPath")
+    return problems
+
+
+def run_graph(kind, size, repeat, log):
+    """Run every benchmark on one synthetic graph; returns {name: result}."""
+    spec = SIZES[size]
+    G = make_graph(kind, spec["nodes"])
+    results = {}
+
+    def record(name, result, **extra):
+        result.update(extra)
+        results[name] = result
+        log(f"  {kind}-{size}/{name}: {result['best'] * 1e3:.1f} ms, peak {result['peak_mb']:.1f} MB")
+
+    log(f"{kind}-{size}: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges")
+    record("routing_graph", measure(lambda: from_networkx(G), repeat))
+    # The RoutingGraph cached for G is built here, so no later benchmark pays for it
+    rg = as_routing_graph(G)
+    record("spatial_index", measure(lambda: SpatialIndex(rg), repeat))
+
+    write_risk_maps(rg.names, "risk_maps")
+    record("get_edge_data", measure(lambda: ru.get_edge_data(G, WEATHER), repeat))
+
+    pairs = routable_pairs(G, spec["queries"])
+    cache = route_cache_for(rg)
+
+    def route_all(weight, weather, trips=pairs, route=astar_route):
+        for origin, dest in trips:
+            route(G, origin, dest, weight, weather, cache=False)
+
+    record("astar_route_attribute", measure(lambda: route_all("cost_risk", None), repeat), queries=len(pairs))
+    record("astar_route_tables", measure(lambda: route_all("cost_risk", WEATHER), repeat), queries=len(pairs))
+
+    short = routable_pairs(G, spec["queries"], max_offset=SHORT_TRIP)
+    for metric in ("cost_time", "cost_risk"):
+        # Timings of wrong routes are worthless: stop on any mismatch
+        problems = check_corridor_routes(G, short, metric, WEATHER)
+        if problems:
+            raise RuntimeError(f"corridor_route differs from astar_route on {kind}-{size}:\n" + "\n".join(problems))
+        log(f"  {kind}-{size}/corridor_check_{metric}: {len(short)} trips match astar_route "
+            f"in {', '.join(CORRIDOR_MODES)} corridors")
+        problems = check_alternatives(G, short, metric)
+        if problems:
+            raise RuntimeError(f"alternative_routes failed its check on {kind}-{size}:\n" + "\n".join(problems))
+        log(f"  {kind}-{size}/alternatives_check_{metric}: {len(short)} trips and an unreachable point pass")
+        record(f"astar_route_short_{metric}", measure(lambda: route_all(metric, WEATHER, short), repeat),
+               queries=len(short))
+
+        def corridor_all():
+            # Corridors are shared between trips; every run builds them again
+            corridor_cache_for(rg).clear()
+            route_all(metric, WEATHER, short, corridor_route)
+
+        record(f"corridor_route_short_{metric}", measure(corridor_all, repeat), queries=len(short))
+
+        # Corridors are for trips that are short next to the graph; where
+        # most of them are searched on one, they have to beat plain A*
+        corridor_cache_for(rg).clear()
+        searched = 0
+        for origin, dest in short:
+            stats = {}
+            corridor_route(G, origin, dest, metric, WEATHER, stats=stats, cache=False)
+            searched += stats["corridor_nodes"] > 0
+        astar_best = results[f"astar_route_short_{metric}"]["best"]
+        corridor_best = results[f"corridor_route_short_{metric}"]["best"]
+        if 2 * searched >= len(short) and corridor_best >= astar_best:
+            raise RuntimeError(f"corridor_route is not faster than astar_route on short {metric} trips "
+                               f"of {kind}-{size}: {corridor_best * 1e3:.1f} ms against {astar_best * 1e3:.1f} ms")
+        log(f"  {kind}-{size}/corridor_speedup_{metric}: {searched} of {len(short)} trips on a corridor, "
+            f"{astar_best / max(corridor_best, 1e-12):.2f}x astar_route")
+
+    def path_finding_all():
+        for origin, dest in pairs:
+            ru.path_finding(G, "cost_risk", origin, dest, WEATHER)
+
+    def clear_cache():
+        # path_finding goes through the route cache; every run must search
+        cache.clear()
+        return ()
+
+    record("path_finding", measure(path_finding_all, repeat, setup=clear_cache), queries=len(pairs))
+
+    _, edge_path, _ = astar_route(G, pairs[0][0], pairs[0][1], "cost_risk", WEATHER, cache=False)
+
+    def plot():
+        m = folium.Map(location=pairs[0][0], zoom_start=13)
+        ru.plot_route(G, edge_path, m, "cost_risk", pairs[0][0], pairs[0][1], WEATHER)
+        return m.get_root().render()
+
+    record("plot_route", measure(plot, repeat), edges=len(edge_path), html_kb=len(plot()) / 1024)
+
+    edge_to_name = {(u, v, k): normalize_name(d.get("name")) for u, v, k, d in G.edges(keys=True, data=True)}
+
+    def fill(names):
+        with contextlib.redirect_stdout(io.StringIO()):
+            risk_map_gen.fill_missing_edge_names_with_bfs(G, names)
+
+    record("fill_missing_edge_names", measure(fill, repeat, setup=lambda: (dict(edge_to_name),)),
+           unnamed=sum(name == "Unnamed Road" for name in edge_to_name.values()))
+
+    write_accidents(G, "accidents.csv", spec["accidents"])
+    index = SpatialIndex(rg)
+    road_names, edge_road = np.unique(np.array(rg.names, dtype=object)[rg.edge_name_id], return_inverse=True)
+    record("risk_aggregation", measure(
+        lambda: risk_map_gen.aggregate_accidents("accidents.csv", index, edge_road.astype(np.int32),
+                                                 risk_map_gen.TARGET_CONDITIONS), repeat),
+        accidents=spec["accidents"])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print new/baseline time ratios; returns the names that got slower than 1 + tolerance."""
+    regressions = []
+    print(f"\n{'benchmark':55s} {'baseline':>10s} {'now':>10s} {'ratio':>7s}")
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["best"] / base["best"] if base["best"] > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  SLOWER"
+        elif ratio < 1 / (1 + tolerance):
+            flag = "  faster"
+        print(f"{name:55s} {base['best'] * 1e3:9.1f}ms {result['best'] * 1e3:9.1f}ms {ratio:7.2f}{flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline routing and risk-map benchmarks.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--graphs", nargs="+", choices=GRAPHS, default=list(GRAPHS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline, as a fraction")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    results = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+        },
+        "results": {},
+    }
+
+    # Risk maps and accident files are written to a scratch directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="benchmarks_")
+    try:
+        os.chdir(workdir)
+        for size in args.sizes:
+            for kind in args.graphs:
+                for name, result in run_graph(kind, size, args.repeat, print).items():
+                    results["results"][f"{kind}-{size}/{name}"] = result
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved: {output}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
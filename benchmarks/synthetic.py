@@ -0,0 +1,170 @@
+import itertools
+import os
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from shapely.geometry import LineString
+
+from risk_map_gen import TARGET_CONDITIONS
+
+# Synthetic networks are laid out around central LA
+ORIGIN = (34.0, -118.4)  # (lat, lng) of the south-west corner
+METERS_PER_DEG_LAT = 111320
+METERS_PER_DEG_LNG = 111320 * np.cos(np.radians(ORIGIN[0]))
+
+ROAD_NAMES = ["Main Street", "Broadway", "Sunset Boulevard", "Olympic Boulevard", "Wilshire Boulevard",
+              "Figueroa Street", "Vermont Avenue", "Western Avenue", "Santa Monica Boulevard", "Pico Boulevard"]
+MAXSPEEDS = ["25 mph", "35 mph", "40 mph", ["40 mph", "45 mph"], "50", None]
+
+
+def _add_edge(G, rng, osmids, u, v, name, maxspeed):
+    # Edge in the OSMnx attribute schema; a third of the edges get a bent geometry.
+    # osmids is a shared counter: len(G.edges) would walk every edge each time
+    ux, uy, vx, vy = G.nodes[u]["x"], G.nodes[u]["y"], G.nodes[v]["x"], G.nodes[v]["y"]
+    length = float(np.hypot((vx - ux) * METERS_PER_DEG_LNG, (vy - uy) * METERS_PER_DEG_LAT))
+    data = {"osmid": next(osmids), "length": length * rng.uniform(1.0, 1.2), "highway": "residential",
+            "oneway": False, "reversed": False}
+    if name is not None:
+        data["name"] = name
+    if maxspeed is not None:
+        data["maxspeed"] = maxspeed
+    if rng.random() < 0.3:
+        mx, my = (ux + vx) / 2 + rng.normal(0, 1e-4), (uy + vy) / 2 + rng.normal(0, 1e-4)
+        data["geometry"] = LineString([(ux, uy), (mx, my), (vx, vy)])
+    G.add_edge(u, v, **data)
+
+
+def add_island(G, offset=500.0, seed=0):
+    """
+    Add two nodes `offset` meters north-east of G's bounds, joined by a
+    two-way street and to nothing else, so no route leads from G to them.
+    Returns the (lat, lng) of one of them.
+    """
+    rng = np.random.default_rng(seed)
+    osmids = itertools.count(max(d["osmid"] for *_, d in G.edges(data=True)) + 1)
+    min_lat, min_lng, max_lat, max_lng = bounds(G)
+    lat, lng = max_lat + offset / METERS_PER_DEG_LAT, max_lng + offset / METERS_PER_DEG_LNG
+    u, v = max(G.nodes) + 1, max(G.nodes) + 2
+    G.add_node(u, x=lng, y=lat, street_count=1)
+    G.add_node(v, x=lng + 100 / METERS_PER_DEG_LNG, y=lat, street_count=1)
+    _add_edge(G, rng, osmids, u, v, ROAD_NAMES[0], "25 mph")
+    _add_edge(G, rng, osmids, v, u, ROAD_NAMES[0], "25 mph")
+    return lat, lng
+
+
+def _largest_component(G):
+    # OSMnx drive networks are strongly connected; keep the largest component
+    return G.subgraph(max(nx.strongly_connected_components(G), key=len)).copy()
+
+
+def _road_attributes(rng, unnamed_share):
+    name = None if rng.random() < unnamed_share else ROAD_NAMES[rng.integers(len(ROAD_NAMES))]
+    if name is not None and rng.random() < 0.05:
+        name = [name, ROAD_NAMES[rng.integers(len(ROAD_NAMES))]]
+    return name, MAXSPEEDS[rng.integers(len(MAXSPEEDS))]
+
+
+def grid_graph(side, spacing=100.0, unnamed_share=0.2, one_way_share=0.1, seed=0):
+    """
+    side x side street grid as an OSMnx-style MultiDiGraph, `spacing` meters
+    apart with jittered nodes. Streets are named per row/column with random
+    unnamed gaps; a share of the streets is one-way. Only the largest
+    strongly connected component is kept.
+    """
+    rng = np.random.default_rng(seed)
+    osmids = itertools.count()
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(side):
+        for j in range(side):
+            G.add_node(1000 + i * side + j,
+                       x=ORIGIN[1] + (j + rng.uniform(-0.1, 0.1)) * spacing / METERS_PER_DEG_LNG,
+                       y=ORIGIN[0] + (i + rng.uniform(-0.1, 0.1)) * spacing / METERS_PER_DEG_LAT,
+                       street_count=4)
+    for i in range(side):
+        for j in range(side):
+            u = 1000 + i * side + j
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di >= side or j + dj >= side:
+                    continue
+                v = 1000 + (i + di) * side + j + dj
+                line = i if di == 0 else j
+                name = None if rng.random() < unnamed_share else f"{ROAD_NAMES[line % len(ROAD_NAMES)]} {line}"
+                maxspeed = MAXSPEEDS[line % len(MAXSPEEDS)]
+                _add_edge(G, rng, osmids, u, v, name, maxspeed)
+                if rng.random() >= one_way_share:
+                    _add_edge(G, rng, osmids, v, u, name, maxspeed)
+    return _largest_component(G)
+
+
+def geometric_graph(num_nodes, mean_degree=5.0, unnamed_share=0.3, one_way_share=0.2, seed=0):
+    """
+    Random geometric graph as an OSMnx-style MultiDiGraph: nodes uniform in
+    a square with the density of the 100 m grid, joined when closer than the
+    radius that gives `mean_degree` neighbours on average. Only the largest
+    strongly connected component is kept.
+    """
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(num_nodes) * 100.0  # meters
+    xy = rng.uniform(0, side, size=(num_nodes, 2))
+    radius = np.sqrt(mean_degree / (np.pi * num_nodes)) * side
+
+    osmids = itertools.count()
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i, (x, y) in enumerate(xy):
+        G.add_node(1000 + i, x=ORIGIN[1] + x / METERS_PER_DEG_LNG, y=ORIGIN[0] + y / METERS_PER_DEG_LAT,
+                   street_count=0)
+    for i, j in sorted(cKDTree(xy).query_pairs(radius)):
+        name, maxspeed = _road_attributes(rng, unnamed_share)
+        _add_edge(G, rng, osmids, 1000 + i, 1000 + j, name, maxspeed)
+        if rng.random() >= one_way_share:
+            _add_edge(G, rng, osmids, 1000 + j, 1000 + i, name, maxspeed)
+    return _largest_component(G)
+
+
+def bounds(G):
+    """(min_lat, min_lng, max_lat, max_lng) of the nodes of G."""
+    x = np.array([d["x"] for _, d in G.nodes(data=True)])
+    y = np.array([d["y"] for _, d in G.nodes(data=True)])
+    return y.min(), x.min(), y.max(), x.max()
+
+
+def od_pairs(G, count, seed=0, max_offset=None):
+    """
+    `count` random (origin, destination) pairs of (lat, lng) points inside
+    the graph's extent. With `max_offset` (meters) every destination is at
+    most that far north/south and east/west of its origin (short trips).
+    """
+    rng = np.random.default_rng(seed)
+    min_lat, min_lng, max_lat, max_lng = bounds(G)
+    points = np.column_stack((rng.uniform(min_lat, max_lat, 2 * count), rng.uniform(min_lng, max_lng, 2 * count)))
+    if max_offset is not None:
+        offset = rng.uniform(-max_offset, max_offset, (count, 2)) / [METERS_PER_DEG_LAT, METERS_PER_DEG_LNG]
+        points[1::2] = np.clip(points[0::2] + offset, [min_lat, min_lng], [max_lat, max_lng])
+    return [(tuple(points[2 * k]), tuple(points[2 * k + 1])) for k in range(count)]
+
+
+def write_accidents(G, path, count, seed=0):
+    """Accident CSV with the columns risk_map_gen reads, uniform over the graph's extent."""
+    rng = np.random.default_rng(seed)
+    min_lat, min_lng, max_lat, max_lng = bounds(G)
+    conditions = np.array(TARGET_CONDITIONS + ["Snow", None], dtype=object)
+    visibility = rng.choice([10.0, 9.0, 7.0, 5.0, 2.0, 0.5], count)
+    visibility[rng.random(count) < 0.05] = np.nan
+    pd.DataFrame({
+        "Start_Lat": rng.uniform(min_lat, max_lat, count),
+        "Start_Lng": rng.uniform(min_lng, max_lng, count),
+        "Visibility(mi)": visibility,
+        "conditions": rng.choice(conditions, count),
+    }).to_csv(path, index=False)
+
+
+def write_risk_maps(road_names, risk_dir, conditions=TARGET_CONDITIONS, seed=0):
+    """Risk tables in the risk_map_gen CSV format with random scores for `road_names`."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(risk_dir, exist_ok=True)
+    for condition in conditions:
+        scores = rng.random(len(road_names)) ** 3
+        pd.DataFrame({"road_name": road_names, "risk_score": scores / scores.max()}).to_csv(
+            os.path.join(risk_dir, f"{condition.replace(', ', '_').replace(' ', '_')}.csv"), index=False)
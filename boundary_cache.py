@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+BOUNDARY_DIR = "data/boundaries"
+
+# The study area; the road graph is downloaded for the same places
+PLACES = [
+    "Los Angeles, California, USA",
+    "Santa Monica, California, USA",
+    "Beverly Hills, California, USA",
+    "West Hollywood, California, USA",
+    "Culver City, California, USA",
+    "Inglewood, California, USA",
+    "Glendale, California, USA",
+    "Burbank, California, USA",
+    "Pasadena, California, USA"
+]
+
+# Simplification tolerances in degrees (about 10, 50 and 200 m); coordinates
+# are rounded to a tenth of the tolerance, which is far below what is visible
+TOLERANCES = (0.0001, 0.0005, 0.002)
+DEFAULT_TOLERANCE = 0.0005
+
+_layers = {}
+
+
+def layer_path(tolerance, boundary_dir=BOUNDARY_DIR):
+    return os.path.join(boundary_dir, f"boundaries_{tolerance:g}.geojson")
+
+
+def source_path(boundary_dir=BOUNDARY_DIR):
+    # Full-resolution polygons the simplified layers are built from
+    return os.path.join(boundary_dir, "boundaries.geojson")
+
+
+def build_layers(gdf, boundary_dir=BOUNDARY_DIR, tolerances=TOLERANCES):
+    """
+    Store full-resolution boundaries and one simplified GeoJSON layer per
+    tolerance.
+
+    Parameters:
+    - gdf: GeoDataFrame in EPSG:4326 with a 'name' column and one polygon per place
+    - boundary_dir: cache directory
+    - tolerances: simplification tolerances in degrees
+    """
+    os.makedirs(boundary_dir, exist_ok=True)
+    gdf = gdf.to_crs(epsg=4326)[["name", "geometry"]]
+    gdf.to_file(source_path(boundary_dir), driver="GeoJSON")
+
+    for tolerance in tolerances:
+        decimals = int(np.ceil(-np.log10(tolerance))) + 1
+        features = []
+        for name, geom in zip(gdf["name"], gdf.geometry):
+            geom = geom.simplify(tolerance, preserve_topology=True)
+            geom = shapely.transform(geom, lambda c: np.round(c, decimals))
+            features.append({"type": "Feature", "properties": {"name": name}, "geometry": mapping(geom)})
+        with open(layer_path(tolerance, boundary_dir), "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f, separators=(",", ":"))
+    print(f"Saved boundary layers to {boundary_dir}")
+
+
+def fetch_boundaries(places=PLACES, boundary_dir=BOUNDARY_DIR, tolerances=TOLERANCES):
+    """Geocode the place boundaries once with OSMnx and build the cache."""
+    import osmnx as ox
+    gdf = ox.geocode_to_gdf(places)
+    gdf["name"] = places
+    build_layers(gdf, boundary_dir, tolerances)
+
+
+def seed(gdf, boundary_dir=BOUNDARY_DIR, tolerances=TOLERANCES, name_column="name"):
+    """
+    Fill the cache from boundaries already in memory, e.g. a small
+    GeoDataFrame built by a test, so no network access is needed. Layers of
+    `boundary_dir` held in memory are dropped, so the next boundary_layer
+    call reads the new ones.
+    """
+    if name_column != "name":
+        gdf = gdf.rename(columns={name_column: "name"})
+    build_layers(gdf, boundary_dir, tolerances)
+    for path in [p for p in _layers if os.path.normpath(os.path.dirname(p)) == os.path.normpath(boundary_dir)]:
+        del _layers[path]
+
+
+def import_boundaries(path, boundary_dir=BOUNDARY_DIR, tolerances=TOLERANCES, name_column="name"):
+    """Build the cache from a local file readable by geopandas (GeoJSON, Shapefile, GeoPackage...)."""
+    import geopandas as gpd
+    seed(gpd.read_file(path), boundary_dir, tolerances, name_column)
+
+
+def boundary_layer(tolerance=DEFAULT_TOLERANCE, boundary_dir=BOUNDARY_DIR):
+    """
+    The merged boundary FeatureCollection (as a dict) at `tolerance`.
+
+    Read from the cache; the boundaries are fetched once if it is empty, and
+    a missing tolerance is built from the stored full-resolution polygons.
+    Layers are kept in memory, so repeated map builds read no files at all.
+    """
+    path = layer_path(tolerance, boundary_dir)
+    if not os.path.exists(path):
+        if os.path.exists(source_path(boundary_dir)):
+            # Only needed to build a layer, so plain map builds do not import it
+            import geopandas as gpd
+            build_layers(gpd.read_file(source_path(boundary_dir)), boundary_dir, [tolerance])
+        else:
+            fetch_boundaries(boundary_dir=boundary_dir, tolerances=sorted(set(TOLERANCES) | {tolerance}))
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = _layers.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = (mtime, json.load(f))
+        _layers[path] = cached
+    return cached[1]
+
+
+if __name__ == '__main__':
+    import sys
+    # python boundary_cache.py [local boundary file]
+    if len(sys.argv) > 1:
+        import_boundaries(sys.argv[1])
+    else:
+        fetch_boundaries()
@@ -0,0 +1,296 @@
+import math
+import os
+from heapq import heappush, heappop
+
+import numpy as np
+
+from cost_tables import tables_for
+
+CH_DIR = "data/ch"
+
+# Witness searches stop after settling this many nodes; a missed witness
+# only adds a redundant shortcut, it never makes queries wrong
+WITNESS_SETTLE_LIMIT = 60
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy for one metric of a RoutingGraph.
+
+    Attributes:
+    - rank: contraction order of every node
+    - up_indptr, up_dst, up_cost: CSR of upward edges v -> w (rank[w] > rank[v])
+    - down_indptr, down_src, down_cost: CSR of upward edges in the reverse
+      graph, i.e. edges u -> v with rank[u] > rank[v], stored at v
+    - shortcut_src, shortcut_dst, shortcut_mid: every shortcut u -> w and the
+      node it bypasses
+    - checksum: fingerprint of the pair costs the hierarchy was built for
+    """
+
+    def __init__(self, rank, up_indptr, up_dst, up_cost, down_indptr, down_src, down_cost,
+                 shortcut_src, shortcut_dst, shortcut_mid, checksum):
+        self.rank = rank
+        self.up_indptr = up_indptr
+        self.up_dst = up_dst
+        self.up_cost = up_cost
+        self.down_indptr = down_indptr
+        self.down_src = down_src
+        self.down_cost = down_cost
+        self.shortcut_src = shortcut_src
+        self.shortcut_dst = shortcut_dst
+        self.shortcut_mid = shortcut_mid
+        self.checksum = checksum
+        self._lists = None
+
+    def search_lists(self):
+        # Python lists for the query loop, built once
+        if self._lists is None:
+            self._lists = (
+                self.up_indptr.tolist(), self.up_dst.tolist(), self.up_cost.tolist(),
+                self.down_indptr.tolist(), self.down_src.tolist(), self.down_cost.tolist(),
+                dict(zip(zip(self.shortcut_src.tolist(), self.shortcut_dst.tolist()),
+                         self.shortcut_mid.tolist())),
+            )
+        return self._lists
+
+
+def _witness_search(out_edges, source, exclude, max_cost):
+    """Bounded Dijkstra from `source` that never passes through `exclude`."""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap and settled < WITNESS_SETTLE_LIMIT:
+        d, u = heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > max_cost:
+            break
+        settled += 1
+        for w, c in out_edges[u].items():
+            if w == exclude:
+                continue
+            nd = d + c
+            if nd < dist.get(w, math.inf):
+                dist[w] = nd
+                heappush(heap, (nd, w))
+    return dist
+
+
+def _shortcuts(out_edges, in_edges, v):
+    """Shortcuts (u, w, cost) needed when contracting v."""
+    needed = []
+    for u, cu in in_edges[v].items():
+        targets = {w: cu + cw for w, cw in out_edges[v].items() if w != u}
+        if not targets:
+            continue
+        dist = _witness_search(out_edges, u, v, max(targets.values()))
+        for w, c in targets.items():
+            if dist.get(w, math.inf) > c:
+                needed.append((u, w, c))
+    return needed
+
+
+def build_contraction_hierarchy(rg, reduced, verbose=True):
+    """
+    Contract every node of the pair graph of a RoutingGraph under the costs
+    of `reduced` (a ReducedCosts), in edge-difference order with lazy updates.
+    Pure Python; expect minutes on the full LA network.
+    """
+    n = rg.num_nodes
+    out_edges = [dict() for _ in range(n)]
+    in_edges = [dict() for _ in range(n)]
+    for u, w, c in zip(rg.pair_src.tolist(), rg.pair_dst.tolist(), reduced.cost_list):
+        if u != w:
+            out_edges[u][w] = c
+            in_edges[w][u] = c
+
+    middle = {}
+    deleted_neighbors = [0] * n
+
+    def priority(v):
+        return (len(_shortcuts(out_edges, in_edges, v)) - len(in_edges[v]) - len(out_edges[v])
+                + deleted_neighbors[v])
+
+    heap = [(priority(v), v) for v in range(n)]
+    heap.sort()
+    rank = np.empty(n, dtype=np.int64)
+    up = [None] * n
+    down = [None] * n
+    order = 0
+    while heap:
+        _, v = heappop(heap)
+        # Lazy update: re-evaluate and only contract if v is still the cheapest
+        p = priority(v)
+        if heap and p > heap[0][0]:
+            heappush(heap, (p, v))
+            continue
+
+        for u, w, c in _shortcuts(out_edges, in_edges, v):
+            if c < out_edges[u].get(w, math.inf):
+                out_edges[u][w] = c
+                in_edges[w][u] = c
+                middle[(u, w)] = v
+
+        # Remaining neighbours are all contracted later, so these are v's upward edges
+        up[v] = list(out_edges[v].items())
+        down[v] = list(in_edges[v].items())
+        for u in in_edges[v]:
+            del out_edges[u][v]
+            deleted_neighbors[u] += 1
+        for w in out_edges[v]:
+            del in_edges[w][v]
+            deleted_neighbors[w] += 1
+        out_edges[v] = {}
+        in_edges[v] = {}
+
+        rank[v] = order
+        order += 1
+        if verbose and order % 10000 == 0:
+            print(f"Contracted {order}/{n} nodes, {len(middle)} shortcuts")
+
+    def to_csr(adj):
+        counts = np.array([len(a) for a in adj], dtype=np.int64)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        nodes = np.array([x for a in adj for x, _ in a], dtype=np.int32)
+        costs = np.array([c for a in adj for _, c in a], dtype=np.float64)
+        return indptr, nodes, costs
+
+    keys = list(middle.keys())
+    return ContractionHierarchy(
+        rank, *to_csr(up), *to_csr(down),
+        np.array([k[0] for k in keys], dtype=np.int32),
+        np.array([k[1] for k in keys], dtype=np.int32),
+        np.array(list(middle.values()), dtype=np.int32),
+        [len(reduced.pair_cost), float(np.sum(reduced.pair_cost))],
+    )
+
+
+def ch_query(ch, source, target):
+    """
+    Bidirectional upward Dijkstra between two node indices.
+
+    Returns the list of node indices of the shortest path with shortcuts
+    unpacked, or None if target is unreachable.
+    """
+    up_indptr, up_dst, up_cost, down_indptr, down_src, down_cost, middle = ch.search_lists()
+    if source == target:
+        return [source]
+
+    dist = ({source: 0.0}, {target: 0.0})
+    parent = ({}, {})
+    heaps = ([(0.0, source)], [(0.0, target)])
+    adjacency = ((up_indptr, up_dst, up_cost), (down_indptr, down_src, down_cost))
+    best, meet = math.inf, None
+
+    while heaps[0] or heaps[1]:
+        # Both searches are done once neither frontier can improve the best meeting point
+        tops = [h[0][0] if h else math.inf for h in heaps]
+        if min(tops) >= best:
+            break
+        side = 0 if tops[0] <= tops[1] else 1
+        d, v = heappop(heaps[side])
+        if d > dist[side][v]:
+            continue
+        other = dist[1 - side].get(v)
+        if other is not None and d + other < best:
+            best, meet = d + other, v
+        indptr, nbrs, costs = adjacency[side]
+        for i in range(indptr[v], indptr[v + 1]):
+            w = nbrs[i]
+            nd = d + costs[i]
+            if nd < dist[side].get(w, math.inf):
+                dist[side][w] = nd
+                parent[side][w] = v
+                heappush(heaps[side], (nd, w))
+
+    if meet is None:
+        return None
+
+    # Hierarchy path source -> meet -> target
+    forward = [meet]
+    while forward[-1] != source:
+        forward.append(parent[0][forward[-1]])
+    path = forward[::-1]
+    while path[-1] != target:
+        path.append(parent[1][path[-1]])
+
+    # Unpack shortcuts (u, w) into (u, mid) + (mid, w) until only original pairs remain
+    nodes = [path[0]]
+    stack = list(zip(path[:-1], path[1:]))[::-1]
+    while stack:
+        u, w = stack.pop()
+        mid = middle.get((u, w))
+        if mid is None:
+            nodes.append(w)
+        else:
+            stack.append((mid, w))
+            stack.append((u, mid))
+    return nodes
+
+
+def pairs_along(rg, nodes):
+    """Pair indices connecting consecutive node indices of a path."""
+    pairs = []
+    for u, w in zip(nodes[:-1], nodes[1:]):
+        lo, hi = rg.pair_indptr[u], rg.pair_indptr[u + 1]
+        pairs.append(int(lo + np.flatnonzero(rg.pair_dst[lo:hi] == w)[0]))
+    return pairs
+
+
+def ch_path(weather, metric, ch_dir=CH_DIR):
+    return os.path.join(ch_dir, f"{weather.replace(', ', '_').replace(' ', '_')}_{metric}.npz")
+
+
+_FIELDS = ("rank", "up_indptr", "up_dst", "up_cost", "down_indptr", "down_src", "down_cost",
+           "shortcut_src", "shortcut_dst", "shortcut_mid")
+
+
+def save_contraction_hierarchy(ch, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, checksum=np.array(ch.checksum), **{f: getattr(ch, f) for f in _FIELDS})
+
+
+def load_contraction_hierarchy(path, reduced=None):
+    """Load a saved hierarchy; None if missing or built for different costs."""
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    checksum = data["checksum"].tolist()
+    if reduced is not None and not np.allclose(
+            checksum, [len(reduced.pair_cost), float(np.sum(reduced.pair_cost))], rtol=1e-12):
+        return None
+    return ContractionHierarchy(*(data[f] for f in _FIELDS), checksum)
+
+
+def ch_for(rg, reduced, path=None):
+    """
+    ContractionHierarchy attached to `reduced`, loaded from `path` when a
+    matching file exists, otherwise built (and saved to `path` when given).
+    """
+    if reduced.ch is None:
+        ch = load_contraction_hierarchy(path, reduced) if path else None
+        if ch is None:
+            ch = build_contraction_hierarchy(rg, reduced)
+            if path:
+                save_contraction_hierarchy(ch, path)
+        reduced.ch = ch
+    return reduced.ch
+
+
+def precompute_hierarchies(rg, weathers, metrics=("cost_risk", "cost_time"), ch_dir=CH_DIR):
+    """Build and store a contraction hierarchy for every (weather, metric) combination."""
+    for weather in weathers:
+        for metric in metrics:
+            print(f"Building contraction hierarchy for {weather} / {metric}...")
+            reduced = tables_for(rg).reduced(weather, metric)
+            reduced.ch = None
+            ch_for(rg, reduced, ch_path(weather, metric, ch_dir))
+
+
+if __name__ == '__main__':
+    import routing_utils as ru
+    precompute_hierarchies(ru.load_graph(), [
+        'Clear', 'Partially cloudy', 'Overcast', 'Rain',
+        'Rain, Overcast', 'Rain, Partially cloudy'
+    ])
@@ -0,0 +1,332 @@
+import math
+import threading
+import weakref
+from collections import OrderedDict
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+import metrics
+from heuristics import R, distance_scale, heuristic_for, pair_haversine
+from routing import _count_route, _metric_label, geocode_point, route_cache_key, snap_points
+from routing_engine import as_routing_graph, astar, costs_for_weight, route_from_pairs
+from route_cache import route_cache_for
+from spatial_index import spatial_index_for
+
+# First corridor: ellipse whose focal distance sum is INITIAL_FACTOR times
+# the straight-line distance, stretched by the metric's typical cost ratio
+# (see cost_ratio), plus MIN_MARGIN meters; it grows by GROWTH until the
+# route it holds is provably optimal
+INITIAL_FACTOR = 1.1
+MIN_MARGIN = 200.0
+GROWTH = 2.0
+
+# Above this share of the graph's nodes the full graph is searched instead;
+# checked on the expected corridor size before a corridor is built
+MAX_SHARE = 0.5
+
+MAX_CORRIDORS = 64
+
+# A cached corridor that holds a trip's ellipse is reused for it when it has
+# at most REUSE_FACTOR times the nodes expected in that ellipse (and at
+# least MIN_REUSE nodes may always be taken)
+REUSE_FACTOR = 4.0
+MIN_REUSE = 256
+
+# Margin on the KD-tree ball query: the index's local plane distorts
+# distances by well under 2% at city scale, the exact test is done after
+BALL_MARGIN = 1.02
+
+
+_ratios = weakref.WeakKeyDictionary()
+
+
+def cost_ratio(rg, reduced):
+    """
+    Median over the pairs of cost / (scale * great-circle length), for the
+    metric of `reduced`. A route costs about this ratio (plus its detour)
+    more than the lower bound, so the first corridor is sized with it and
+    most queries are proven optimal in one round.
+    """
+    ratio = _ratios.get(reduced)
+    if ratio is None:
+        scale = distance_scale(rg, reduced)
+        length = pair_haversine(rg)
+        mask = length > 0
+        ratio = float(np.median(reduced.pair_cost[mask] / (scale * length[mask]))) if scale > 0 and mask.any() else 1.0
+        _ratios[reduced] = max(ratio, 1.0)
+    return _ratios[reduced]
+
+
+def _haversine(rg, a, nodes):
+    # Great-circle distance in meters from node a to every node of `nodes`
+    lon, lat = np.radians(rg.x[nodes]), np.radians(rg.y[nodes])
+    lon_a, lat_a = math.radians(rg.x[a]), math.radians(rg.y[a])
+    h = np.sin((lat - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat) * np.sin((lon - lon_a) / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def expected_nodes(rg, straight, radius):
+    """
+    Nodes expected in the ellipse of focal distance sum `radius` around two
+    points `straight` meters apart: its area, capped at the area of the
+    graph's bounding box, times the graph's mean node density.
+    """
+    tree = spatial_index_for(rg).node_tree
+    box = max(float(np.prod(tree.maxes - tree.mins)), 1.0)
+    a = radius / 2
+    b = math.sqrt(max(a * a - straight * straight / 4, 0.0))
+    return rg.num_nodes * min(math.pi * a * b / box, 1.0)
+
+
+class Corridor:
+    """
+    Subgraph of the nodes inside an ellipse around two nodes of a RoutingGraph.
+
+    A node x is inside when the great-circle distances from the two foci
+    add up to at most `radius` meters. Every pair with both ends inside is
+    kept, so the corridor holds every route that never leaves the ellipse.
+
+    Attributes:
+    - source, target: the global node indices at the foci
+    - nodes: sorted global node indices; local node i is nodes[i]
+    - pairs: global pair index of every local pair, in CSR order
+    - indptr, dst: local CSR adjacency over the pairs
+    - radius: focal distance sum in meters
+    """
+
+    def __init__(self, rg, source, target, radius):
+        index = spatial_index_for(rg)
+        ends = index._project(rg.y[[source, target]], rg.x[[source, target]])
+        # Inside the ellipse means within radius / 2 of the midpoint
+        candidates = np.sort(np.asarray(
+            index.node_tree.query_ball_point(ends.mean(axis=0), radius / 2 * BALL_MARGIN), dtype=np.int64))
+        inside = _haversine(rg, source, candidates) + _haversine(rg, target, candidates) <= radius
+        inside[np.searchsorted(candidates, [source, target])] = True
+        nodes = candidates[inside]
+
+        # Out-pairs of the corridor nodes, then only those ending inside
+        start = np.asarray(rg.pair_indptr[nodes])
+        counts = np.asarray(rg.pair_indptr[nodes + 1]) - start
+        pairs = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        dst = np.asarray(rg.pair_dst[pairs], dtype=np.int64)
+        local_dst = np.minimum(np.searchsorted(nodes, dst), len(nodes) - 1)
+        keep = nodes[local_dst] == dst
+        local_src = np.repeat(np.arange(len(nodes)), counts)[keep]
+
+        self.source, self.target = source, target
+        self.nodes = nodes
+        self.pairs = pairs[keep]
+        self.dst = local_dst[keep]
+        self.indptr = np.searchsorted(local_src, np.arange(len(nodes) + 1))
+        self.radius = radius
+        self._matrices = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    def local(self, node):
+        """Local index of a global node index."""
+        return int(np.searchsorted(self.nodes, node))
+
+    def contains(self, node):
+        i = self.local(node)
+        return i < len(self.nodes) and self.nodes[i] == node
+
+    def matrix(self, reduced):
+        """Pair costs of `reduced` on the corridor as a scipy CSR matrix; cached per ReducedCosts."""
+        with self._lock:
+            matrix = self._matrices.get(reduced)
+            if matrix is None:
+                n = len(self.nodes)
+                # csgraph treats stored zeros as edges, but keep every weight strictly positive anyway
+                data = np.maximum(reduced.pair_cost[self.pairs], 1e-12)
+                matrix = csr_matrix((data, self.dst, self.indptr), shape=(n, n))
+                self._matrices[reduced] = matrix
+            return matrix
+
+    def route_pairs(self, local_pred, local_target):
+        """Global pair indices along the predecessor tree of a search from the corridor's source."""
+        pairs = []
+        v = local_target
+        while local_pred[v] >= 0:
+            u = int(local_pred[v])
+            lo, hi = self.indptr[u], self.indptr[u + 1]
+            pairs.append(int(self.pairs[lo + np.searchsorted(self.dst[lo:hi], v)]))
+            v = u
+        return pairs[::-1]
+
+
+class CorridorCache:
+    """
+    Bounded LRU cache of corridors. Safe to share between threads.
+
+    A corridor of radius R around nodes a, b also serves a trip from s to t:
+    a node x outside it has d(a, x) + d(x, b) > R, so by the triangle
+    inequality d(s, x) + d(x, t) > R - d(s, a) - d(t, b). The corridor thus
+    proves routes up to the bound R - d(s, a) - d(t, b), and holds s and t
+    whenever that bound is at least d(s, t). Nearby trips share corridors
+    this way, and a trip's later rounds can reuse a larger corridor.
+    """
+
+    def __init__(self, max_entries=MAX_CORRIDORS):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, rg, source, target, radius, max_nodes=None):
+        """
+        A corridor that proves routes from source to target up to focal
+        distance sum `radius`: the smallest cached one with at most
+        `max_nodes` nodes, or a new one of exactly that radius.
+        Returns (corridor, bound), bound being the focal distance sum the
+        corridor proves for this trip (at least `radius`).
+        """
+        with self._lock:
+            cached = list(self._entries.values())
+        if cached:
+            detour = (_haversine(rg, source, [c.source for c in cached])
+                      + _haversine(rg, target, [c.target for c in cached]))
+            # The slack keeps rounding in the distances on the safe side
+            bounds = (np.array([c.radius for c in cached]) - detour) * (1 - 1e-12)
+            best = None
+            for corridor, bound in zip(cached, bounds.tolist()):
+                if bound < radius or (max_nodes is not None and corridor.num_nodes > max_nodes):
+                    continue
+                if best is None or corridor.num_nodes < best[0].num_nodes:
+                    best = (corridor, bound)
+            if best is not None and best[0].contains(source) and best[0].contains(target):
+                with self._lock:
+                    key = (best[0].source, best[0].target, best[0].radius)
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return best
+        corridor = Corridor(rg, source, target, radius)
+        with self._lock:
+            self._entries[(source, target, radius)] = corridor
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return corridor, radius
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def corridor_cache_for(rg):
+    """The CorridorCache attached to a RoutingGraph, created on first use."""
+    cache = getattr(rg, "corridor_cache", None)
+    if cache is None:
+        cache = CorridorCache()
+        rg.corridor_cache = cache
+    return cache
+
+
+def corridor_route(G, origin_point, destination_point, weight='cost_risk', weather=None,
+                   max_snap_distance=None, stats=None, cache=True, initial_factor=INITIAL_FACTOR,
+                   min_margin=MIN_MARGIN, max_share=MAX_SHARE):
+    """
+    Shortest route searched on a corridor around the origin and destination
+    instead of the whole graph; same parameters and result as astar_route
+    (without alt).
+
+    A path that leaves the corridor passes through a node x outside the
+    ellipse, so it costs at least s * (d(source, x) + d(x, target)) >
+    s * radius, where s is the metric's cost per meter of great-circle
+    distance (heuristics.distance_scale). A route found in the corridor
+    within that cost is therefore optimal on the full graph. The corridor is
+    searched with scipy's Dijkstra. A route costing C > s * radius is not
+    proven optimal, but the corridor of radius C / s is sure to prove its
+    own best route, so it is searched next; without any route the corridor
+    grows by GROWTH. Corridors come from the graph's CorridorCache, which
+    reuses any cached corridor that proves the trip's radius.
+
+    The full graph is searched with A* once the corridor would hold more
+    than max_share of the nodes; expected_nodes is checked before a
+    corridor is built, so a trip spanning most of the graph goes to A*
+    without building one. initial_factor and min_margin size the first
+    corridor (see INITIAL_FACTOR).
+
+    `stats` receives 'expanded' (nodes reached), 'corridor_nodes' (size of
+    the last corridor, 0 on the full graph) and 'rounds' (corridors tried).
+    """
+    with metrics.trace("corridor_route", weather=weather, metric=_metric_label(weight)) as t:
+        with t.stage("geocode"):
+            origin_point = geocode_point(origin_point)
+            destination_point = geocode_point(destination_point)
+
+        rg = as_routing_graph(G)
+        with t.stage("costs"):
+            reduced = costs_for_weight(G, rg, weight, weather)
+
+        with t.stage("snap"):
+            source, target = snap_points(rg, origin_point, destination_point, max_snap_distance)
+
+        key = route_cache_key(rg, source, target, weather, weight) if cache else None
+        if key is not None:
+            result = route_cache_for(rg).get(key)
+            if result is not None:
+                t.count(cache_hits=1, route_edges=len(result[1]))
+                if stats is not None:
+                    stats.update(expanded=0, corridor_nodes=0, rounds=0)
+                return result
+
+        scale = distance_scale(rg, reduced)
+        straight = float(_haversine(rg, source, [target])[0])
+        radius = initial_factor * cost_ratio(rg, reduced) * straight + min_margin
+        corridors = corridor_cache_for(rg)
+        max_nodes = max_share * rg.num_nodes
+        pairs = None
+        rounds = 0
+        search = {"expanded": 0, "corridor_nodes": 0}
+        # Without a positive scale no corridor route can be proven optimal
+        while scale > 0:
+            rounds += 1
+            expected = expected_nodes(rg, straight, radius)
+            if expected > max_nodes:
+                break
+            with t.stage("corridor"):
+                corridor, bound = corridors.get(rg, source, target, radius,
+                                                max(REUSE_FACTOR * expected, MIN_REUSE))
+            if corridor.num_nodes > max_nodes or corridor.num_nodes == rg.num_nodes:
+                break
+            with t.stage("search"):
+                local_source, local_target = corridor.local(source), corridor.local(target)
+                dist, pred = dijkstra(corridor.matrix(reduced), indices=local_source, return_predecessors=True)
+            search = {"expanded": int(np.isfinite(dist).sum()), "corridor_nodes": corridor.num_nodes}
+            cost = dist[local_target]
+            if cost <= scale * bound:
+                with t.stage("reconstruct"):
+                    pairs = corridor.route_pairs(pred, local_target)
+                break
+            # A corridor of radius cost / s holds a route at most this
+            # expensive, so it proves its best route optimal (the slack
+            # keeps rounding from failing the test again)
+            radius = cost / scale * (1 + 1e-9) if np.isfinite(cost) else bound * GROWTH
+
+        if pairs is None:
+            # Fall back to A* on the full graph
+            with t.stage("search"):
+                full = {}
+                pairs = astar(rg, source, target, reduced.cost_list, heuristic_for(rg, reduced, target), full)
+            search = {"expanded": full["expanded"], "corridor_nodes": 0}
+        t.count(rounds=rounds, **search)
+        if stats is not None:
+            stats.update(rounds=rounds, **search)
+
+        if pairs is not None:
+            with t.stage("reconstruct"):
+                result = route_from_pairs(rg, source, pairs, reduced.best_edge)
+            _count_route(t, rg, reduced, pairs)
+            if key is not None:
+                route_cache_for(rg).put(key, result)
+            return result
+
+    raise nx.NetworkXNoPath(f"No path between {origin_point} and {destination_point}")
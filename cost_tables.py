@@ -0,0 +1,152 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from spatial_index import graph_signature
+
+RISK_DIR = "risk_maps"
+DEFAULT_SPEED = 50  # km/h, used where maxspeed is missing (same as get_edge_data)
+METRICS = ("cost_distance", "cost_risk", "cost_time")
+UNNAMED = "Unnamed Road"  # name normalize_name gives edges without one
+
+
+def edge_risk_path(weather, risk_dir=RISK_DIR):
+    return os.path.join(risk_dir, weather.replace(', ', '_').replace(' ', '_') + ".edges.npz")
+
+
+def area_prior_path(weather, risk_dir=RISK_DIR):
+    # Per-edge risk of the area around every edge, written by hex_grid prior
+    return os.path.join(risk_dir, weather.replace(', ', '_').replace(' ', '_') + ".prior.npz")
+
+
+def risk_table_path(weather, risk_dir=RISK_DIR):
+    # risk_map_gen writes CSV by default and Parquet on request, and with
+    # --level edge also a per-edge risk vector, which takes precedence
+    if os.path.exists(edge_risk_path(weather, risk_dir)):
+        return edge_risk_path(weather, risk_dir)
+    base = os.path.join(risk_dir, weather.replace(', ', '_').replace(' ', '_'))
+    if not os.path.exists(base + ".csv") and os.path.exists(base + ".parquet"):
+        return base + ".parquet"
+    return base + ".csv"
+
+
+def read_risk_table(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def load_edge_risk(path, rg):
+    """Per-edge risk scores in RoutingGraph edge order, as written by risk_map_gen --level edge or hex_grid prior."""
+    data = np.load(path)
+    if not np.array_equal(data["signature"], np.array(graph_signature(rg), dtype=np.float64)):
+        raise ValueError(f"{path} was built for a different graph; rerun risk_map_gen")
+    return data["risk"].astype(np.float64)
+
+
+def compute_cost_table(rg, weather, risk_dir=RISK_DIR):
+    """
+    Compute the cost vectors of one weather condition for every edge of a RoutingGraph.
+    Gives the same values get_edge_data writes into the graph, but as arrays
+    in RoutingGraph edge order.
+
+    Returns a dict metric -> float64 array with keys cost_distance, cost_risk and cost_time.
+    """
+    path = risk_table_path(weather, risk_dir)
+    if path.endswith(".edges.npz"):
+        # Edge-level risk is already aligned with the edges
+        risk = load_edge_risk(path, rg)
+    else:
+        risk_df = read_risk_table(path)
+        risk_lookup = dict(zip(risk_df["road_name"], risk_df["risk_score"]))
+
+        # Names are interned, so the string lookup runs once per distinct road name
+        name_risk = np.array([risk_lookup.get(name, np.nan) for name in rg.names], dtype=np.float64)
+        risk = name_risk[rg.edge_name_id]
+        # Edges without a named road take the area prior when one was written.
+        # Named roads missing from the table had no accidents and keep 0; the
+        # "Unnamed Road" entry pools every unnamed edge, so it is no match
+        prior_path = area_prior_path(weather, risk_dir)
+        if UNNAMED in rg.names and os.path.exists(prior_path):
+            unmatched = rg.edge_name_id == rg.names.index(UNNAMED)
+            if unmatched.any():
+                risk[unmatched] = load_edge_risk(prior_path, rg)[unmatched]
+        risk = np.nan_to_num(risk, nan=0.0)
+
+    length = rg.edge_length
+    maxspeed = rg.edge_maxspeed.astype(np.float64)
+    maxspeed = np.where(np.isnan(maxspeed) | (maxspeed <= 0), DEFAULT_SPEED, maxspeed)
+    return {
+        "cost_distance": length,
+        "cost_risk": length * (1 + risk),
+        "cost_time": (length / 1000) / maxspeed,  # travel time in hours
+    }
+
+
+class CostTables:
+    """
+    In-memory cache of per-weather cost vectors for one RoutingGraph.
+
+    A weather's table is computed on first use and recomputed when the
+    modification time of its risk_maps file (or of its area prior) changes. The graph itself is
+    never written to, so sessions routing under different weathers can
+    share it safely.
+    """
+
+    def __init__(self, rg, risk_dir=RISK_DIR):
+        self.rg = rg
+        self.risk_dir = risk_dir
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, weather):
+        path = risk_table_path(weather, self.risk_dir)
+        prior = area_prior_path(weather, self.risk_dir)
+        mtime = (os.stat(path).st_mtime_ns, os.stat(prior).st_mtime_ns if os.path.exists(prior) else 0)
+        entry = self._tables.get(weather)
+        if entry is None or entry["mtime"] != mtime:
+            with self._lock:
+                entry = self._tables.get(weather)
+                if entry is None or entry["mtime"] != mtime:
+                    entry = {
+                        "mtime": mtime,
+                        "costs": compute_cost_table(self.rg, weather, self.risk_dir),
+                        "reduced": {},
+                    }
+                    self._tables[weather] = entry
+        return entry
+
+    def get(self, weather, metric):
+        """Per-edge cost vector for (weather, metric)."""
+        return self._entry(weather)["costs"][metric]
+
+    def reduced(self, weather, metric):
+        """ReducedCosts for (weather, metric), see RoutingGraph.reduced_costs."""
+        entry = self._entry(weather)
+        reduced = entry["reduced"].get(metric)
+        if reduced is None:
+            reduced = self.rg.reduced_costs(entry["costs"][metric])
+            entry["reduced"][metric] = reduced
+        return reduced
+
+    def version(self, weather):
+        """Identifier that changes whenever the weather's table is recomputed."""
+        return self._entry(weather)["mtime"]
+
+    def invalidate(self, weather=None):
+        with self._lock:
+            if weather is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(weather, None)
+
+
+def tables_for(rg):
+    """The CostTables instance attached to a RoutingGraph, created on first use."""
+    tables = getattr(rg, "cost_tables", None)
+    if tables is None:
+        tables = CostTables(rg)
+        rg.cost_tables = tables
+    return tables
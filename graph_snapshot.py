@@ -0,0 +1,100 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from routing_engine import RoutingGraph
+
+# Binary snapshot of a RoutingGraph.
+#
+# Layout: 8-byte magic, uint32 format version, uint32 header length, a JSON
+# header describing every array (dtype, shape, byte offset), then the raw
+# arrays, each aligned to ALIGN bytes. Arrays are opened with np.memmap, so
+# loading only maps the file and processes opening the same snapshot share
+# its pages through the OS page cache.
+
+MAGIC = b"LAGRAPH\0"
+VERSION = 1
+ALIGN = 64
+
+
+def _pack_names(names):
+    encoded = [name.encode("utf-8") for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_names(blob, offsets):
+    data = bytes(blob)
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def write_snapshot(rg, path, meta=None):
+    """
+    Write a RoutingGraph to `path` in the snapshot format.
+
+    Parameters:
+    - rg: RoutingGraph
+    - path: output file
+    - meta: optional JSON-serializable dict stored in the header
+    """
+    arrays = {name: np.ascontiguousarray(getattr(rg, name))
+              for name in RoutingGraph.BASE_ARRAYS + RoutingGraph.DERIVED_ARRAYS}
+    arrays["name_blob"], arrays["name_offsets"] = _pack_names(rg.names)
+
+    # Offsets are relative to the end of the header, which is aligned as well
+    entries = {}
+    offset = 0
+    for name, arr in arrays.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        entries[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+
+    header = json.dumps({"arrays": entries, "meta": meta or {}}).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", VERSION, len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(arr.tobytes())
+    # Rename into place so readers never see a half-written snapshot
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a graph snapshot")
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version != VERSION:
+            raise ValueError(f"{path} has snapshot version {version}, expected {VERSION}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    header["data_start"] = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+    return header
+
+
+def load_snapshot(path):
+    """Memory-map a snapshot written by write_snapshot and return it as a RoutingGraph."""
+    header = read_header(path)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=entry["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=entry["dtype"], mode="r",
+                                     offset=header["data_start"] + entry["offset"], shape=shape)
+
+    names = _unpack_names(arrays.pop("name_blob"), arrays.pop("name_offsets"))
+    derived = {name: arrays[name] for name in RoutingGraph.DERIVED_ARRAYS}
+    base = {name: arrays[name] for name in RoutingGraph.BASE_ARRAYS}
+    rg = RoutingGraph(names=names, derived=derived, **base)
+    rg.meta = header["meta"]
+    return rg
@@ -0,0 +1,229 @@
+import math
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from cost_tables import tables_for
+
+R = 6371000  # Earth radius in meters
+
+LANDMARK_DIR = "data/landmarks"
+NUM_LANDMARKS = 16
+
+# Relative slack applied to lower bounds so floating point rounding never
+# makes a heuristic overestimate
+SLACK = 1e-6
+
+
+def pair_haversine(rg):
+    """Great-circle length in meters of every pair (u, v) of a RoutingGraph."""
+    lon, lat = np.radians(rg.x), np.radians(rg.y)
+    u, v = rg.pair_src, rg.pair_dst
+    a = (np.sin((lat[v] - lat[u]) / 2) ** 2
+         + np.cos(lat[u]) * np.cos(lat[v]) * np.sin((lon[v] - lon[u]) / 2) ** 2)
+    return 2 * R * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distance_scale(rg, reduced):
+    """
+    Largest factor s such that s * great-circle distance never exceeds the
+    cost of an edge, for the metric of `reduced`.
+
+    Any path is at least as long as the straight line between its ends, so
+    s * haversine(u, target) is an admissible and consistent heuristic. For
+    cost_distance s is about 1, for cost_time it is 1 / (1000 * max speed in
+    km/h), i.e. distance divided by the fastest speed in the network, and
+    for cost_risk it follows whatever the risk model produces instead of
+    relying on cost_risk >= length.
+    """
+    if reduced.scale is None:
+        dist = pair_haversine(rg)
+        mask = dist > 0
+        ratio = reduced.pair_cost[mask] / dist[mask]
+        scale = float(ratio.min()) if len(ratio) else 0.0
+        reduced.scale = max(scale, 0.0) * (1 - SLACK)
+    return reduced.scale
+
+
+def scaled_haversine(rg, target, scale):
+    """Heuristic callable: scale * great-circle distance in meters to `target`."""
+    _, _, lon, lat = rg.adjacency()
+    lon2, lat2 = lon[target], lat[target]
+    cos_lat2 = math.cos(lat2)
+    k = 2 * R * scale
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+
+    def h(u):
+        a = sin((lat2 - lat[u]) / 2) ** 2 + cos(lat[u]) * cos_lat2 * sin((lon2 - lon[u]) / 2) ** 2
+        return k * asin(sqrt(min(a, 1.0)))
+    return h
+
+
+class LandmarkTables:
+    """
+    ALT (A*, landmarks, triangle inequality) preprocessing for one metric.
+
+    Attributes:
+    - landmarks: node indices of the landmarks
+    - from_landmark: (n, k) float32 costs d(L, v)
+    - to_landmark: (n, k) float32 costs d(v, L)
+    - checksum: fingerprint of the pair costs the tables were built for
+
+    Unreachable entries are stored as a large finite value, so differences
+    stay well defined. Tables are float32, so every bound is lowered by the
+    worst-case rounding error of the stored values.
+    """
+
+    UNREACHABLE = np.float32(1e30)
+
+    def __init__(self, landmarks, from_landmark, to_landmark, checksum):
+        self.landmarks = landmarks
+        self.from_landmark = from_landmark
+        self.to_landmark = to_landmark
+        self.checksum = checksum
+        finite = [t[t < self.UNREACHABLE] for t in (from_landmark, to_landmark)]
+        largest = max((float(t.max()) for t in finite if t.size), default=0.0)
+        self.tolerance = 4 * largest * float(np.finfo(np.float32).eps)
+
+    def heuristic(self, target):
+        """
+        Heuristic callable for `target`:
+        max over landmarks of d(L, t) - d(L, v) and d(v, L) - d(t, L).
+        """
+        fwd, bwd = self.from_landmark, self.to_landmark
+        fwd_t = fwd[target].astype(np.float64)
+        bwd_t = bwd[target].astype(np.float64)
+        factor = 1 - SLACK
+        tolerance = self.tolerance
+
+        def h(u):
+            lower = max((fwd_t - fwd[u]).max(), (bwd[u] - bwd_t).max()) - tolerance
+            return float(lower) * factor if lower > 0 else 0.0
+        return h
+
+
+def cost_checksum(reduced):
+    return [len(reduced.pair_cost), float(np.sum(reduced.pair_cost))]
+
+
+def cost_matrix(rg, reduced):
+    """The pair costs as a scipy CSR matrix for scipy.sparse.csgraph."""
+    n = rg.num_nodes
+    # csgraph treats stored zeros as edges, but keep every weight strictly positive anyway
+    data = np.maximum(reduced.pair_cost, 1e-12)
+    return csr_matrix((data, np.asarray(rg.pair_dst), np.asarray(rg.pair_indptr)), shape=(n, n))
+
+
+def forward_cost_matrix(rg, reduced):
+    """CSR matrix of the graph, for sweeps from a source; cached on `reduced`."""
+    if reduced.matrix is None:
+        reduced.matrix = cost_matrix(rg, reduced)
+    return reduced.matrix
+
+
+def reverse_cost_matrix(rg, reduced):
+    """CSR matrix of the reversed graph, for sweeps towards a target; cached on `reduced`."""
+    if reduced.reverse_matrix is None:
+        reduced.reverse_matrix = cost_matrix(rg, reduced).T.tocsr()
+    return reduced.reverse_matrix
+
+
+def select_landmarks(rg, reduced, num_landmarks=NUM_LANDMARKS, seed=0):
+    """
+    Farthest-point landmark selection: start from a random node and keep
+    adding the node farthest (in cost) from all landmarks chosen so far.
+    """
+    matrix = cost_matrix(rg, reduced)
+    rng = np.random.default_rng(seed)
+    landmarks = [int(rng.integers(rg.num_nodes))]
+    best = np.full(rg.num_nodes, np.inf)
+    for _ in range(num_landmarks):
+        dist = dijkstra(matrix, directed=False, indices=landmarks[-1])
+        best = np.minimum(best, dist)
+        reachable = np.where(np.isfinite(best), best, -1)
+        nxt = int(np.argmax(reachable))
+        if nxt in landmarks:
+            break
+        landmarks.append(nxt)
+    # The random starting node is only used to find the periphery
+    return landmarks[1:num_landmarks + 1]
+
+
+def build_landmarks(rg, reduced, num_landmarks=NUM_LANDMARKS):
+    """Compute LandmarkTables for the metric of `reduced`."""
+    matrix = cost_matrix(rg, reduced)
+    landmarks = np.array(select_landmarks(rg, reduced, num_landmarks), dtype=np.int64)
+    from_landmark = dijkstra(matrix, directed=True, indices=landmarks)
+    to_landmark = dijkstra(reverse_cost_matrix(rg, reduced), directed=True, indices=landmarks)
+
+    def pack(dist):
+        dist = np.where(np.isfinite(dist), dist, LandmarkTables.UNREACHABLE)
+        return np.ascontiguousarray(dist.T, dtype=np.float32)
+
+    return LandmarkTables(landmarks, pack(from_landmark), pack(to_landmark), cost_checksum(reduced))
+
+
+def landmark_path(weather, metric, landmark_dir=LANDMARK_DIR):
+    return os.path.join(landmark_dir, f"{weather.replace(', ', '_').replace(' ', '_')}_{metric}.npz")
+
+
+def save_landmarks(tables, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, landmarks=tables.landmarks, from_landmark=tables.from_landmark,
+             to_landmark=tables.to_landmark, checksum=np.array(tables.checksum))
+
+
+def load_landmarks(path, reduced=None):
+    """Load saved LandmarkTables; None if missing or built for different costs."""
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    checksum = data["checksum"].tolist()
+    if reduced is not None and not np.allclose(checksum, cost_checksum(reduced), rtol=1e-12):
+        return None
+    return LandmarkTables(data["landmarks"], data["from_landmark"], data["to_landmark"], checksum)
+
+
+def landmarks_for(rg, reduced, path=None):
+    """
+    LandmarkTables attached to `reduced`, loaded from `path` when a matching
+    file exists, otherwise built (and saved to `path` when given).
+    """
+    if reduced.landmarks is None:
+        tables = load_landmarks(path, reduced) if path else None
+        if tables is None:
+            tables = build_landmarks(rg, reduced)
+            if path:
+                save_landmarks(tables, path)
+        reduced.landmarks = tables
+    return reduced.landmarks
+
+
+def heuristic_for(rg, reduced, target, landmarks=None):
+    """
+    Admissible heuristic for the metric of `reduced`: ALT when landmark
+    tables are given, otherwise the scaled great-circle distance.
+    """
+    if landmarks is not None:
+        return landmarks.heuristic(target)
+    return scaled_haversine(rg, target, distance_scale(rg, reduced))
+
+
+def precompute_landmarks(rg, weathers, metrics=("cost_risk", "cost_time"), landmark_dir=LANDMARK_DIR):
+    """Build and store landmark tables for every (weather, metric) combination."""
+    for weather in weathers:
+        for metric in metrics:
+            print(f"Building landmarks for {weather} / {metric}...")
+            reduced = tables_for(rg).reduced(weather, metric)
+            reduced.landmarks = None
+            landmarks_for(rg, reduced, landmark_path(weather, metric, landmark_dir))
+
+
+if __name__ == '__main__':
+    import routing_utils as ru
+    precompute_landmarks(ru.load_graph(), [
+        'Clear', 'Partially cloudy', 'Overcast', 'Rain',
+        'Rain, Overcast', 'Rain, Partially cloudy'
+    ])
@@ -0,0 +1,400 @@
+import argparse
+import math
+import os
+
+import folium
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from cost_tables import area_prior_path
+from risk_map_gen import ACCIDENT_COLUMNS, TARGET_CONDITIONS
+from spatial_index import graph_signature
+
+ACCIDENTS_PATH = "data/merged_data.csv"
+HEXBIN_PATH = "data/hexbins.npz"
+CACHE_VERSION = 1
+
+# Hexagons are laid out on an equirectangular plane with true scale at
+# ORIGIN_LAT (central LA), which distorts distances by well under 1% over
+# the study area. A level-0 hexagon measures BASE_SIZE meters from its
+# center to a corner, and every level doubles the size of the one below
+ORIGIN_LAT = 34.05
+BASE_SIZE = 100.0
+LEVELS = 8
+
+HEX_PIXELS = 20  # on-screen width of a hexagon the level is chosen for
+VIEWPORT = (1200, 800)  # pixels, the map size of interactive_route
+PRIOR_LEVEL = 3  # hexagons of about 800 m for the area risk prior
+
+R = 6371000.0
+SQRT3 = math.sqrt(3)
+_SCALE_X = R * math.cos(math.radians(ORIGIN_LAT))
+
+# Cells are packed as (condition, q, r) into one int64 to group them with
+# np.unique; axial coordinates fit in KEY_BITS bits after the offset
+KEY_BITS = 21
+KEY_OFFSET = 2 ** (KEY_BITS - 1)
+
+_cmap = plt.get_cmap("YlOrRd")
+HEAT_COLORS = ['#{:02x}{:02x}{:02x}'.format(*(int(c * 255) for c in _cmap(i)[:3])) for i in range(_cmap.N)]
+
+
+def hex_size(level):
+    """Center-to-corner size in meters of the hexagons of `level`."""
+    return BASE_SIZE * 2.0 ** level
+
+
+def project(lat, lng):
+    """(x, y) in meters on the grid's plane."""
+    return (np.radians(np.asarray(lng, dtype=np.float64)) * _SCALE_X,
+            np.radians(np.asarray(lat, dtype=np.float64)) * R)
+
+
+def unproject(x, y):
+    """(lat, lng) of points on the grid's plane."""
+    return np.degrees(np.asarray(y) / R), np.degrees(np.asarray(x) / _SCALE_X)
+
+
+def _axial(x, y, size):
+    # Axial coordinates of the pointy-top hexagons holding the points: the
+    # fractional cube coordinates are rounded, then the one that moved most
+    # is recomputed from the other two so that q + r + s stays 0
+    q = (SQRT3 / 3 * x - y / 3) / size
+    r = (2 / 3 * y) / size
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int32), rr.astype(np.int32)
+
+
+def _center(q, r, size):
+    return size * SQRT3 * (q + r / 2), size * 1.5 * r
+
+
+def hex_cells(lat, lng, level=0):
+    """Axial (q, r) int32 arrays of the hexagons of `level` holding the points."""
+    return _axial(*project(lat, lng), hex_size(level))
+
+
+def hex_centers(q, r, level=0):
+    """(lat, lng) arrays of the centers of hexagons."""
+    return unproject(*_center(np.asarray(q), np.asarray(r), hex_size(level)))
+
+
+def hex_polygons(q, r, level=0):
+    """Closed (lng, lat) rings of hexagons, as an (n, 7, 2) array ready for GeoJSON."""
+    size = hex_size(level)
+    cx, cy = _center(np.asarray(q, dtype=np.float64), np.asarray(r, dtype=np.float64), size)
+    angles = np.radians(30 + 60 * np.arange(7))
+    lat, lng = unproject(cx[:, None] + size * np.cos(angles), cy[:, None] + size * np.sin(angles))
+    return np.stack((lng, lat), axis=-1)
+
+
+def _pack(q, r, condition=0):
+    key = np.asarray(condition, dtype=np.int64) << KEY_BITS
+    key = (key + (q.astype(np.int64) + KEY_OFFSET)) << KEY_BITS
+    return key + (r.astype(np.int64) + KEY_OFFSET)
+
+
+def _unpack(key):
+    mask = (1 << KEY_BITS) - 1
+    r = (key & mask) - KEY_OFFSET
+    q = ((key >> KEY_BITS) & mask) - KEY_OFFSET
+    return (key >> (2 * KEY_BITS)).astype(np.int16), q.astype(np.int32), r.astype(np.int32)
+
+
+def _group(keys, *values):
+    # Sum every value column per distinct key
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return (unique,) + tuple(np.bincount(inverse, v, minlength=len(unique)) for v in values)
+
+
+class HexAggregates:
+    """
+    Accident counts per weather condition and level-0 hexagon. Coarser
+    levels are binned from the level-0 cell centers on demand, which only
+    touches the cells, never the accidents again.
+
+    Attributes:
+    - conditions: list of weather conditions; 'nan' for accidents without one
+    - condition: int16 index into conditions, per cell
+    - q, r: int32 axial coordinates of the level-0 cells
+    - count: accidents per cell
+    - vis_count, vis_sum: accidents with a visibility value and the sum of it
+    - v_max: maximum visibility over all accidents
+    - source: dict with path, size and mtime of the accident CSV
+    """
+
+    def __init__(self, conditions, condition, q, r, count, vis_count, vis_sum, v_max, source=None):
+        self.conditions = list(conditions)
+        self.condition = condition
+        self.q = q
+        self.r = r
+        self.count = count
+        self.vis_count = vis_count
+        self.vis_sum = vis_sum
+        self.v_max = v_max
+        self.source = source or {}
+        self._levels = {}
+
+    @property
+    def num_cells(self):
+        return len(self.q)
+
+    def cells(self, level=0, condition=None):
+        """
+        Aggregates of one condition (None: all accidents) on `level`.
+
+        Returns (q, r, count, weight) arrays, one entry per non-empty
+        hexagon. weight is the visibility-weighted count: every accident with
+        a visibility value weighs 1 + v_max - visibility, as in risk_map_gen.
+        """
+        key = (level, condition)
+        if key not in self._levels:
+            if condition is None:
+                mask = slice(None)
+            elif condition in self.conditions:
+                mask = self.condition == self.conditions.index(condition)
+            else:
+                mask = np.zeros(self.num_cells, dtype=bool)
+            q, r = self.q[mask], self.r[mask]
+            if level > 0:
+                q, r = _axial(*_center(q, r, BASE_SIZE), hex_size(level))
+            cells, count, vis_count, vis_sum = _group(_pack(q, r), self.count[mask], self.vis_count[mask],
+                                                      self.vis_sum[mask])
+            _, q, r = _unpack(cells)
+            self._levels[key] = (q, r, count, vis_count * (1 + self.v_max) - vis_sum)
+        return self._levels[key]
+
+    def matches(self, path):
+        """True if the aggregates were built from the current version of `path`."""
+        stat = os.stat(path)
+        return (self.source.get("path") == os.path.abspath(path) and self.source.get("size") == stat.st_size
+                and self.source.get("mtime") == stat.st_mtime_ns)
+
+    def save(self, path=HEXBIN_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, version=CACHE_VERSION, base_size=BASE_SIZE, origin_lat=ORIGIN_LAT,
+                     conditions=np.array(self.conditions, dtype=str), condition=self.condition,
+                     q=self.q, r=self.r, count=self.count, vis_count=self.vis_count, vis_sum=self.vis_sum,
+                     v_max=self.v_max, source=np.array([self.source.get("path", ""), self.source.get("size", -1),
+                                                        self.source.get("mtime", -1)], dtype=str))
+        os.replace(path + ".tmp", path)
+        print(f"Saved: {path}")
+
+    @classmethod
+    def load(cls, path=HEXBIN_PATH):
+        """Load saved aggregates; None if missing or built for another grid."""
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        if (int(data["version"]) != CACHE_VERSION or float(data["base_size"]) != BASE_SIZE
+                or float(data["origin_lat"]) != ORIGIN_LAT):
+            return None
+        source_path, size, mtime = data["source"].tolist()
+        return cls(data["conditions"].tolist(), data["condition"], data["q"], data["r"], data["count"],
+                   data["vis_count"], data["vis_sum"], float(data["v_max"]),
+                   {"path": source_path, "size": int(size), "mtime": int(mtime)})
+
+
+def aggregate_hexbins(path=ACCIDENTS_PATH, chunksize=500_000):
+    """
+    Stream the accident CSV (the columns risk_map_gen reads) in chunks and
+    count the accidents per condition and level-0 hexagon. Every chunk is
+    binned and grouped with NumPy, so memory stays flat and millions of
+    accidents take seconds, most of it CSV parsing.
+
+    Returns a HexAggregates.
+    """
+    lookup = {}
+    partials = []
+    v_max = -np.inf
+    reader = pd.read_csv(path, usecols=list(ACCIDENT_COLUMNS), dtype=ACCIDENT_COLUMNS, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk['Start_Lat'].notna() & chunk['Start_Lng'].notna()]
+        vis = chunk['Visibility(mi)'].values.astype(np.float64)
+        has_vis = ~np.isnan(vis)
+        if has_vis.any():
+            v_max = max(v_max, float(vis[has_vis].max()))
+        codes, names = pd.factorize(chunk['conditions'].fillna('nan').astype(str))
+        condition = np.array([lookup.setdefault(name, len(lookup)) for name in names], dtype=np.int64)[codes]
+        q, r = hex_cells(chunk['Start_Lat'].values, chunk['Start_Lng'].values)
+        partials.append(_group(_pack(q, r, condition), np.ones(len(q)), has_vis, np.where(has_vis, vis, 0.0)))
+
+    if partials:
+        keys, count, vis_count, vis_sum = _group(*(np.concatenate(p) for p in zip(*partials)))
+    else:
+        keys, count, vis_count, vis_sum = (np.empty(0, dtype=np.int64),) + (np.empty(0),) * 3
+    condition, q, r = _unpack(keys)
+    stat = os.stat(path)
+    return HexAggregates(list(lookup), condition, q, r, count.astype(np.int64), vis_count.astype(np.int64),
+                         vis_sum, v_max, {"path": os.path.abspath(path), "size": stat.st_size,
+                                          "mtime": stat.st_mtime_ns})
+
+
+def hexbins_for(path=ACCIDENTS_PATH, cache_path=HEXBIN_PATH):
+    """HexAggregates of the accident CSV, read from `cache_path` unless the CSV changed since."""
+    agg = HexAggregates.load(cache_path)
+    if agg is None or not agg.matches(path):
+        print("Binning accidents into hexagons...")
+        agg = aggregate_hexbins(path)
+        agg.save(cache_path)
+    return agg
+
+
+def zoom_level(zoom, lat=ORIGIN_LAT):
+    """Grid level whose hexagons are about HEX_PIXELS wide at a web-map zoom level."""
+    meters_per_pixel = 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom
+    size = HEX_PIXELS * meters_per_pixel / SQRT3  # a hexagon is sqrt(3) * size wide
+    return int(min(max(round(math.log2(size / BASE_SIZE)), 0), LEVELS - 1))
+
+
+def viewport_bounds(center, zoom, viewport=VIEWPORT):
+    """(south, west, north, east) of a map of `viewport` pixels centered on (lat, lng) at `zoom`."""
+    lat, lng = center
+    meters_per_pixel = 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom
+    dlat = viewport[1] / 2 * meters_per_pixel / 111320
+    dlng = viewport[0] / 2 * meters_per_pixel / (111320 * math.cos(math.radians(lat)))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+
+def hex_choropleth(agg, m, condition=None, zoom=None, bounds=None, value="count", name=None):
+    """
+    Add the accident hexagons of one condition to a folium map as a single
+    GeoJSON layer.
+
+    Parameters:
+    - agg: HexAggregates
+    - m: folium.Map
+    - condition: weather condition, None for all accidents
+    - zoom: zoom level the grid level is chosen for (default: the map's)
+    - bounds: (south, west, north, east) of the cells to draw (default: the
+      map's viewport at `zoom`, see VIEWPORT)
+    - value: 'count' or 'weight' (visibility-weighted count) to color by
+    - name: layer name
+
+    Colors follow log(1 + value) relative to the largest cell of the whole
+    level, so they do not change when the map is panned. Returns the level.
+    """
+    zoom = m.options.get("zoom", 12) if zoom is None else zoom
+    level = zoom_level(zoom, m.location[0])
+    if bounds is None:
+        bounds = viewport_bounds(m.location, zoom)
+    q, r, count, weight = agg.cells(level, condition)
+    values = count if value == "count" else weight
+    scale = np.log1p(values.max()) if len(values) and values.max() > 0 else 1.0
+
+    # Cells whose center is within one hexagon of the bounds
+    lat, lng = hex_centers(q, r, level)
+    south, west, north, east = bounds
+    margin_lat = hex_size(level) / 111320
+    margin_lng = margin_lat / math.cos(math.radians((south + north) / 2))
+    keep = ((lat >= south - margin_lat) & (lat <= north + margin_lat) & (lng >= west - margin_lng)
+            & (lng <= east + margin_lng) & (values > 0))
+    rings = np.round(hex_polygons(q[keep], r[keep], level), 5).tolist()
+    shades = np.minimum((np.log1p(values[keep]) / scale * len(HEAT_COLORS)).astype(int), len(HEAT_COLORS) - 1)
+    features = [
+        {"type": "Feature",
+         "properties": {"color": HEAT_COLORS[c], "count": int(n), "weight": round(float(w), 1)},
+         "geometry": {"type": "Polygon", "coordinates": [ring]}}
+        for ring, c, n, w in zip(rings, shades.tolist(), count[keep].tolist(), weight[keep].tolist())
+    ]
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name or f"Accidents ({condition or 'all'})",
+        style_function=lambda f: {
+            'fillColor': f['properties']['color'],
+            'fillOpacity': 0.6,
+            'weight': 0
+        },
+        tooltip=folium.GeoJsonTooltip(fields=["count", "weight"], aliases=["Accidents", "Visibility-weighted"]),
+    ).add_to(m)
+    return level
+
+
+def write_heatmaps(agg, output_dir="Visualizations", conditions=None, location=(34.05, -118.25), zoom=10):
+    """
+    Write accident_heatmap_<condition>.html for every condition (default:
+    all of them, plus 'all' for every accident) as hexagon choropleths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for condition in (conditions or agg.conditions + [None]):
+        m = folium.Map(location=location, zoom_start=zoom)
+        hex_choropleth(agg, m, condition, zoom)
+        filename = os.path.join(output_dir, f"accident_heatmap_{condition or 'all'}.html")
+        m.save(filename)
+        print(f"Saved: {filename}")
+
+
+def area_prior(agg, rg, condition, level=PRIOR_LEVEL):
+    """
+    Area-level risk of every RoutingGraph edge for one condition: the
+    visibility-weighted accident count of the hexagon holding the edge's
+    midpoint, divided by the largest one, so it is on the same 0-1 scale as
+    the road risk scores. cost_tables uses it only for edges without a road
+    name. Returns a float32 array in edge order.
+    """
+    q, r, _, weight = agg.cells(level, condition)
+    if not len(q):
+        print(f"No accidents for {condition}; its area prior is 0 everywhere")
+        return np.zeros(rg.num_edges, dtype=np.float32)
+    lat = (rg.y[rg.edge_src] + rg.y[rg.edge_dst]) / 2
+    lng = (rg.x[rg.edge_src] + rg.x[rg.edge_dst]) / 2
+    edge_cells = _pack(*hex_cells(lat, lng, level))
+    cells = _pack(q, r)  # sorted, as np.unique returned them
+    pos = np.minimum(np.searchsorted(cells, edge_cells), len(cells) - 1)
+    prior = np.where(cells[pos] == edge_cells, weight[pos], 0.0)
+    max_weight = prior.max() if len(prior) else 0.0
+    return (prior / max_weight if max_weight > 0 else prior).astype(np.float32)
+
+
+def write_area_prior(rg, prior, condition, output_dir='risk_maps'):
+    filename = area_prior_path(condition, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, risk=prior, signature=np.array(graph_signature(rg), dtype=np.float64))
+    os.replace(filename + ".tmp", filename)
+    print(f"Saved: {filename}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hexagon grid aggregates of the accident data.")
+    parser.add_argument('command', choices=['build', 'heatmaps', 'prior'],
+                        help="build: bin the accidents and cache the counts; heatmaps: write hexagon "
+                             "choropleths per condition; prior: write the area risk prior of every edge")
+    parser.add_argument('--input', default=ACCIDENTS_PATH, help="accident CSV")
+    parser.add_argument('--cache', default=HEXBIN_PATH, help="binned counts kept between runs")
+    parser.add_argument('--conditions', nargs='+', help="weather conditions (default: all for heatmaps, "
+                                                       "the risk_map_gen conditions for the prior)")
+    parser.add_argument('--output-dir', help="default: Visualizations for heatmaps, risk_maps for the prior")
+    parser.add_argument('--zoom', type=int, default=10, help="zoom level of the heatmaps")
+    parser.add_argument('--level', type=int, default=PRIOR_LEVEL, help="grid level of the prior")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'build' and os.path.exists(args.cache):
+        os.remove(args.cache)  # bin again even if the input looks unchanged
+    agg = hexbins_for(args.input, args.cache)
+    print(f"{agg.count.sum():.0f} accidents in {agg.num_cells} cells, {len(agg.conditions)} conditions")
+
+    if args.command == 'heatmaps':
+        write_heatmaps(agg, args.output_dir or "Visualizations", args.conditions, zoom=args.zoom)
+    elif args.command == 'prior':
+        from routing_utils import load_graph
+        rg = load_graph()
+        for condition in args.conditions or TARGET_CONDITIONS:
+            write_area_prior(rg, area_prior(agg, rg, condition, args.level), condition,
+                             args.output_dir or "risk_maps")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 import streamlit as st
 import folium
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_folium import st_folium
 import routing_utils as ru
+import metrics
+import route_jobs
+import route_client
 
 # Load the graph once
 @st.cache_resource
@@ -9,10 +13,31 @@ def load_helper():
     G = ru.load_graph()
     return G
 
+# Route searches run in one process pool shared by all sessions, so the
+# routes of a request are computed in parallel and concurrent users queue
+# instead of oversubscribing the CPU. With ROUTING_SERVER_URL set the app is
+# a thin client: the jobs are requests to routing_server, made from threads
+@st.cache_resource
+def route_pool():
+    if route_client.SERVER_URL:
+        client = route_client.RoutingClient(route_client.SERVER_URL)
+        return ThreadPoolExecutor(max_workers=8), client.run_job
+    return route_jobs.route_pool(ru.SNAPSHOT_PATH, ru.SPATIAL_INDEX_PATH), route_jobs.run_job
+
+# Routing metrics of every session go to one ring buffer and one Prometheus
+# dump, registered once per server process
+@st.cache_resource
+def metrics_sinks():
+    ring = metrics.add_sink(metrics.RingBufferSink(capacity=200))
+    prometheus = metrics.add_sink(metrics.PrometheusSink())
+    return ring, prometheus
+
 # Streamlit interface
 st.info("Loading the graph...")
 st.info("On a first load this can take 2-5 minutes, depending on computer processing power...")
 G = load_helper()
+ring_sink, prometheus_sink = metrics_sinks()
+show_metrics = st.sidebar.checkbox("Show routing metrics")
 st.title("Click to Select Origin and Destination in LA")
 st.markdown("Click once inside the marked area to set the origin, and again to set the destination.")
 
@@ -53,24 +78,95 @@ weather_options = [
 weather = st.selectbox("🌤️ Select current weather condition:", weather_options)
 
 
-# Run routing if both points are selected
+# Clicks farther than this from any road (outside the LA area) are rejected
+MAX_SNAP_DISTANCE = 500  # meters
+
+# Seconds between checks for finished routing jobs
+POLL_INTERVAL = 0.25
+
+# Submit the routing jobs once both points are selected; jobs of an earlier
+# origin/destination/weather are cancelled (or ignored if already running)
+request = None
 if st.session_state.origin and st.session_state.destination:
-    try:
-        # Get the path for both cost_risk and cost_time
-        edge_path_risk = ru.path_finding(G, "cost_risk", st.session_state.origin, st.session_state.destination, weather=weather)
-        edge_path_time = ru.path_finding(G, "cost_time", st.session_state.origin, st.session_state.destination, weather=weather)
-        
-        # Calculate total travel time for each route (in minutes)
-        ru.plot_route(G, edge_path_risk, m, "cost_risk", st.session_state.origin, st.session_state.destination)
-        ru.plot_route(G, edge_path_time, m, "cost_time", st.session_state.origin, st.session_state.destination)
-
-        st.session_state.last_routed = (st.session_state.origin, st.session_state.destination, weather)
-        
-    except Exception as e:
-        st.error(f"Routing failed: {e}")
+    request = (st.session_state.origin, st.session_state.destination, weather)
+jobs = st.session_state.get("route_jobs")
+if jobs is not None and jobs["request"] != request:
+    for future in jobs["futures"].values():
+        future.cancel()
+    jobs = None
+if request is not None and jobs is None:
+    pool, run_job = route_pool()
+    jobs = {
+        "request": request,
+        "futures": {job: pool.submit(run_job, job, *request, MAX_SNAP_DISTANCE, **options)
+                    for job, options in route_jobs.JOBS.items()},
+        "emitted": set(),
+    }
+st.session_state.route_jobs = jobs
+
+# Draw whatever routes are ready; the script reruns as the others finish
+route_table = None
+pending = []
+if jobs is not None:
+    results = {}
+    for job, future in jobs["futures"].items():
+        if not future.done():
+            pending.append(future)
+            continue
+        try:
+            result, trace = future.result()
+        except Exception as e:
+            st.error(f"Routing failed: {e}")
+            continue
+        if job not in jobs["emitted"]:
+            metrics.emit(trace)
+            jobs["emitted"].add(job)
+        results[job] = result
+
+    if "cost_risk" in results:
+        ru.plot_route(G, results["cost_risk"][1], m, "cost_risk", st.session_state.origin, st.session_state.destination, weather)
+    if "cost_time" in results:
+        ru.plot_route(G, results["cost_time"][1], m, "cost_time", st.session_state.origin, st.session_state.destination, weather)
+    if "options" in results:
+        pareto = results["options"]["pareto"]
+        route_table = [
+            {"Route": "Fastest" if i == 0 else "Safest" if i == len(pareto) - 1 else "Trade-off",
+             "Time (min)": round(r["total_time"] * 60, 1),
+             "Risk-weighted km": round(r["total_risk"] / 1000, 2)}
+            for i, r in enumerate(pareto)
+        ]
+    if pending:
+        st.info("Calculating routes...")
+    else:
+        st.session_state.last_routed = request
 
 # Show the map and get click data
-click_data = st_folium(m, height=800, width=1200)
+with metrics.trace("render_map", weather=weather), metrics.stage("render"):
+    click_data = st_folium(m, height=800, width=1200)
+
+# Time/risk options of the current route
+if route_table:
+    st.markdown("### Route options")
+    st.table(route_table)
+
+# Debug panel: stage timings and counters of the latest routing calls
+if show_metrics:
+    st.markdown("### Routing metrics")
+    recent = [
+        {"op": trace.op, **trace.labels, "total (ms)": round(trace.total * 1e3, 1),
+         **{f"{name} (ms)": round(seconds * 1e3, 1) for name, seconds in trace.stages.items()},
+         **trace.counters}
+        for trace in reversed(ring_sink.traces()[-20:])
+    ]
+    st.dataframe(recent)
+    st.markdown("Stage timings over the last calls")
+    st.dataframe([
+        {"op": row["op"], "stage": row["stage"], "calls": row["count"],
+         "mean (ms)": round(row["mean"] * 1e3, 1), "max (ms)": round(row["max"] * 1e3, 1)}
+        for row in ring_sink.summary()
+    ])
+    with st.expander("Prometheus metrics"):
+        st.code(prometheus_sink.render(), language="text")
 
 # Handle new click
 if click_data and click_data.get("last_clicked"):
@@ -91,3 +187,15 @@ if st.button("Reset - Clear Origin and Destination"):
     st.session_state.origin = None
     st.session_state.destination = None
     st.rerun()
+
+# Poll for the next route to finish, then redraw with it. Only the fragment
+# reruns meanwhile, so the script is never blocked and a new click is
+# handled (and the stale jobs cancelled) right away
+@st.fragment(run_every=POLL_INTERVAL)
+def poll_routes(futures):
+    if any(future.done() for future in futures):
+        st.rerun()
+
+
+if pending:
+    poll_routes(pending)
@@ -0,0 +1,232 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("routing_trace", default=None)
+_sinks = []
+_sinks_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Measurements of one routing call.
+
+    Attributes:
+    - op: name of the call, e.g. 'astar_route'
+    - labels: dict of call parameters such as weather and metric
+    - stages: dict stage name -> seconds, in the order the stages ran
+    - counters: dict counter name -> value (nodes expanded, heap pushes, route length...)
+    - total: wall time of the whole call in seconds
+    - started: time.time() at the start of the call
+    """
+
+    def __init__(self, op, **labels):
+        self.op = op
+        self.labels = labels
+        self.stages = {}
+        self.counters = {}
+        self.total = 0.0
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, **counters):
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        return {"op": self.op, "labels": dict(self.labels), "started": self.started, "total": self.total,
+                "stages": dict(self.stages), "counters": dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild a Trace from as_dict() output, e.g. one sent by the routing server."""
+        t = cls(d["op"], **d.get("labels", {}))
+        t.started = d.get("started", t.started)
+        t.total = d.get("total", 0.0)
+        t.stages = dict(d.get("stages", {}))
+        t.counters = dict(d.get("counters", {}))
+        return t
+
+    def __str__(self):
+        parts = [self.op] + [f"{k}={v}" for k, v in self.labels.items()]
+        parts.append(f"total={self.total * 1e3:.1f}ms")
+        parts += [f"{k}={v * 1e3:.1f}ms" for k, v in self.stages.items()]
+        parts += [f"{k}={v}" for k, v in self.counters.items()]
+        return " ".join(parts)
+
+
+@contextmanager
+def trace(op, **labels):
+    """
+    Trace a routing call. Nested calls (e.g. astar_route inside path_finding)
+    add their stages and counters to the outermost trace, which is sent to
+    every registered sink when it ends.
+    """
+    outer = _current.get()
+    if outer is not None:
+        yield outer
+        return
+    t = Trace(op, **labels)
+    token = _current.set(t)
+    start = time.perf_counter()
+    try:
+        yield t
+    except Exception as e:
+        t.labels["error"] = type(e).__name__
+        raise
+    finally:
+        t.total = time.perf_counter() - start
+        _current.reset(token)
+        emit(t)
+
+
+def traced(op):
+    """Decorator form of trace() for a whole function."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(op):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def label(**labels):
+    """Set labels of the active trace that are not set yet."""
+    t = _current.get()
+    if t is not None:
+        for name, value in labels.items():
+            t.labels.setdefault(name, value)
+
+
+def current():
+    """The active Trace, or None outside a traced call."""
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the active trace; does nothing outside a traced call."""
+    t = _current.get()
+    if t is None:
+        yield
+    else:
+        with t.stage(name):
+            yield
+
+
+def count(**counters):
+    """Add to counters of the active trace, if any."""
+    t = _current.get()
+    if t is not None:
+        t.count(**counters)
+
+
+def add_sink(sink):
+    """Register a sink: any object with a record(trace) method."""
+    with _sinks_lock:
+        if sink not in _sinks:
+            _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+def emit(t):
+    for sink in list(_sinks):
+        sink.record(t)
+
+
+class LoggingSink:
+    """Writes one line per trace to a logger."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("routing.metrics")
+        self.level = level
+
+    def record(self, t):
+        self.logger.log(self.level, "%s", t)
+
+
+class RingBufferSink:
+    """Keeps the last `capacity` traces in memory, e.g. for a debug panel."""
+
+    def __init__(self, capacity=200):
+        self._traces = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def record(self, t):
+        with self._lock:
+            self._traces.append(t)
+
+    def traces(self):
+        """Recorded traces, newest last."""
+        with self._lock:
+            return list(self._traces)
+
+    def summary(self):
+        """Per (op, stage) count, mean and maximum seconds over the buffer."""
+        times = defaultdict(list)
+        for t in self.traces():
+            times[(t.op, "total")].append(t.total)
+            for name, seconds in t.stages.items():
+                times[(t.op, name)].append(seconds)
+        return [{"op": op, "stage": name, "count": len(v), "mean": sum(v) / len(v), "max": max(v)}
+                for (op, name), v in times.items()]
+
+
+class PrometheusSink:
+    """
+    Accumulates traces into counters rendered in the Prometheus text
+    exposition format by render():
+    - routing_requests_total{op}
+    - routing_seconds_sum / routing_seconds_count{op, stage}
+    - routing_<counter>_total{op}, e.g. routing_expanded_total
+    """
+
+    def __init__(self, prefix="routing"):
+        self.prefix = prefix
+        self._requests = defaultdict(int)
+        self._seconds = defaultdict(lambda: [0.0, 0])
+        self._counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def record(self, t):
+        with self._lock:
+            self._requests[t.op] += 1
+            for name, seconds in [("total", t.total)] + list(t.stages.items()):
+                entry = self._seconds[(t.op, name)]
+                entry[0] += seconds
+                entry[1] += 1
+            for name, value in t.counters.items():
+                self._counters[(name, t.op)] += value
+
+    def render(self):
+        p = self.prefix
+        with self._lock:
+            lines = [f"# TYPE {p}_requests_total counter"]
+            lines += [f'{p}_requests_total{{op="{op}"}} {n}' for op, n in sorted(self._requests.items())]
+            lines.append(f"# TYPE {p}_seconds summary")
+            for (op, name), (total, n) in sorted(self._seconds.items()):
+                lines.append(f'{p}_seconds_sum{{op="{op}",stage="{name}"}} {total:.6f}')
+                lines.append(f'{p}_seconds_count{{op="{op}",stage="{name}"}} {n}')
+            for counter in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {p}_{counter}_total counter")
+                lines += [f'{p}_{counter}_total{{op="{op}"}} {value:g}'
+                          for (name, op), value in sorted(self._counters.items()) if name == counter]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,237 @@
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from routing import geocode_point, route_cache_key, snap_points
+from route_cache import route_cache_for
+from routing_engine import as_routing_graph, astar, route_from_pairs
+from cost_tables import tables_for
+from heuristics import distance_scale, reverse_cost_matrix, R
+from contraction_hierarchy import pairs_along
+from metrics import count, label, stage, traced
+
+
+def _tree_path(pred, source, target):
+    # Predecessors of a sweep on the reversed graph point towards the target
+    nodes = [source]
+    while nodes[-1] != target:
+        nodes.append(int(pred[nodes[-1]]))
+    return nodes
+
+
+def _bounded_sweep(rg, reduced, source, target):
+    """
+    Dijkstra from `target` on the reversed graph, limited to the smallest
+    cost radius (doubling from the straight-line bound) that reaches `source`.
+    Returns (dist, pred, limit); nodes beyond the radius have dist inf, and
+    `limit` is a valid lower bound for them. When a doubled radius reaches
+    no new node, one unbounded sweep is run instead: `source` is then either
+    reached or cannot reach `target` at all, and neither can the other nodes
+    left at inf, so `limit` still bounds them.
+    """
+    lon, lat = np.radians(rg.x[[source, target]]), np.radians(rg.y[[source, target]])
+    a = (np.sin((lat[1] - lat[0]) / 2) ** 2
+         + np.cos(lat[0]) * np.cos(lat[1]) * np.sin((lon[1] - lon[0]) / 2) ** 2)
+    lower = 2 * R * np.arcsin(np.sqrt(min(a, 1.0))) * distance_scale(rg, reduced)
+    limit = max(1.5 * lower, float(np.median(reduced.pair_cost)) * 10)
+    matrix = reverse_cost_matrix(rg, reduced)
+    reached = -1
+    while True:
+        dist, pred = dijkstra(matrix, indices=target, return_predecessors=True, limit=limit)
+        found = np.isfinite(dist)
+        if found[source] or found.all():
+            return dist, pred, limit
+        if found.sum() == reached:
+            # Either a gap in costs or the end of what can reach the target
+            # (the graph is only weakly connected): settle it in one sweep
+            dist, pred = dijkstra(matrix, indices=target, return_predecessors=True)
+            return dist, pred, limit
+        reached = found.sum()
+        limit *= 2
+
+
+def _route(rg, source, pairs, best_edge, time_costs, risk_costs):
+    node_path, edge_path, road_names = route_from_pairs(rg, source, pairs, best_edge)
+    edges = np.array([best_edge[p] for p in pairs], dtype=np.int64)
+    return {
+        "node_path": node_path,
+        "edge_path": edge_path,
+        "road_names": road_names,
+        "total_time": float(time_costs[edges].sum()),  # hours
+        "total_risk": float(risk_costs[edges].sum()),  # risk-weighted meters (cost_risk)
+    }
+
+
+def _parallel_edges(pair_start, time_costs, risk_costs):
+    # (time, risk) of every edge of the pairs that have parallel edges; the
+    # other pairs' single edge is the one of both reduced cost lists
+    pair_end = np.append(pair_start[1:], len(time_costs))
+    parallel = {}
+    for p in np.flatnonzero(pair_end - pair_start > 1).tolist():
+        lo, hi = pair_start[p], pair_end[p]
+        parallel[p] = list(zip(time_costs[lo:hi].tolist(), risk_costs[lo:hi].tolist()))
+    return parallel
+
+
+class _WeightedCosts:
+    """
+    Pair costs of w_time * time + w_risk * risk for astar, computed per pair
+    on lookup from the reduced time and risk cost lists. Pairs with parallel
+    edges take their cheapest edge on the combined cost.
+    """
+
+    def __init__(self, w_time, w_risk, time_list, risk_list, parallel):
+        self.w_time = w_time
+        self.w_risk = w_risk
+        self.time_list = time_list
+        self.risk_list = risk_list
+        self.parallel = parallel
+
+    def __getitem__(self, p):
+        edges = self.parallel.get(p)
+        if edges is None:
+            return self.w_time * self.time_list[p] + self.w_risk * self.risk_list[p]
+        return min(self.w_time * t + self.w_risk * r for t, r in edges)
+
+    def best_offset(self, p):
+        """Position of the pair's cheapest edge among its parallel edges."""
+        edges = self.parallel.get(p)
+        if edges is None:
+            return 0
+        costs = [self.w_time * t + self.w_risk * r for t, r in edges]
+        return costs.index(min(costs))
+
+
+@traced("route_options")
+def route_options(G, origin, dest, weather, metrics=("cost_time", "cost_risk"), weighting=None,
+                  max_routes=5, max_snap_distance=None, cache=True):
+    """
+    Fastest, safest and trade-off routes between two points in one call.
+
+    The origin and destination are snapped once. One backward Dijkstra sweep
+    per metric from the destination, bounded to the region the trip needs,
+    gives every metric's optimal route directly and exact distances-to-target,
+    which then serve as heuristic for the weighted time/risk searches, so
+    those expand little more than the route itself. Trade-offs are found by dichotomic weighted-sum search
+    between the fastest and the safest route, which yields the supported
+    points of the time/risk Pareto frontier.
+
+    Parameters:
+    - G: networkx.MultiDiGraph or RoutingGraph
+    - origin, dest: (lat, lng) tuples or address strings
+    - weather: weather condition of the cost tables
+    - metrics: metrics to return the optimal route for
+    - weighting: optional share of risk in [0, 1]; adds the route minimizing
+                 (1 - weighting) * time + weighting * risk, each normalized by
+                 the value of its optimal route
+    - max_routes: maximum number of routes on the Pareto frontier
+    - max_snap_distance: see astar_route
+    - cache: use the graph's RouteCache; the key covers the snapped nodes, weather,
+             every argument above and the cost-table version. Cached results
+             are shared, so treat the returned dicts and lists as read-only
+
+    Returns a dict with:
+    - best: metric -> route of the optimal route for that metric
+    - pareto: routes on the time/risk frontier, fastest first
+    - weighted: route for `weighting`, or None
+    Every route is a dict with node_path, edge_path, road_names, total_time
+    (hours) and total_risk (sum of cost_risk).
+    """
+    label(weather=weather)
+    with stage("geocode"):
+        origin = geocode_point(origin)
+        dest = geocode_point(dest)
+    rg = as_routing_graph(G)
+    tables = tables_for(rg)
+    with stage("snap"):
+        source, target = snap_points(rg, origin, dest, max_snap_distance)
+
+    key = None
+    if cache:
+        metric = ("route_options", tuple(metrics), weighting, max_routes)
+        key = route_cache_key(rg, source, target, weather, metric)
+        result = route_cache_for(rg).get(key)
+        if result is not None:
+            count(cache_hits=1)
+            return result
+
+    time_costs = tables.get(weather, "cost_time")
+    risk_costs = tables.get(weather, "cost_risk")
+
+    # One sweep per metric, shared by the optimal routes and the heuristics
+    sweeps = {}
+    with stage("sweeps"):
+        for metric in dict.fromkeys(tuple(metrics) + ("cost_time", "cost_risk")):
+            reduced = tables.reduced(weather, metric)
+            dist, pred, limit = _bounded_sweep(rg, reduced, source, target)
+            if not np.isfinite(dist[source]):
+                raise nx.NetworkXNoPath(f"No path between {origin} and {dest}")
+            sweeps[metric] = (reduced, dist, pred, limit)
+
+    def extreme(metric):
+        reduced, _, pred, _ = sweeps[metric]
+        pairs = pairs_along(rg, _tree_path(pred, source, target))
+        return _route(rg, source, pairs, reduced.best_edge, time_costs, risk_costs)
+
+    with stage("reconstruct"):
+        best = {metric: extreme(metric) for metric in metrics}
+        fastest = best.get("cost_time") or extreme("cost_time")
+        safest = best.get("cost_risk") or extreme("cost_risk")
+
+    # Outside a sweep's radius its limit is still a valid lower bound
+    _, time_dist, _, time_limit = sweeps["cost_time"]
+    _, risk_dist, _, risk_limit = sweeps["cost_risk"]
+    time_dist = np.where(np.isfinite(time_dist), time_dist, time_limit).tolist()
+    risk_dist = np.where(np.isfinite(risk_dist), risk_dist, risk_limit).tolist()
+    pair_start = rg.pair_start
+    parallel = _parallel_edges(pair_start, time_costs, risk_costs)
+    time_list = sweeps["cost_time"][0].cost_list
+    risk_list = sweeps["cost_risk"][0].cost_list
+
+    def weighted(w_time, w_risk):
+        # Minimize w_time * time + w_risk * risk; the combined pair costs are
+        # computed as the search reaches them, not for the whole graph
+        pair_cost = _WeightedCosts(w_time, w_risk, time_list, risk_list, parallel)
+        search = {}
+        pairs = astar(rg, source, target, pair_cost,
+                      lambda u: w_time * time_dist[u] + w_risk * risk_dist[u], search)
+        count(**search)
+        # Best parallel edge only needs resolving along the route
+        best_edge = {p: pair_start[p] + pair_cost.best_offset(p) for p in pairs}
+        return _route(rg, source, pairs, best_edge, time_costs, risk_costs)
+
+    # Dichotomic search: between two frontier routes, weight the objectives by
+    # the normal of the segment joining them; a route strictly below that
+    # segment is a new supported Pareto point
+    with stage("frontier"):
+        frontier = [fastest]
+        if (safest["total_time"], safest["total_risk"]) != (fastest["total_time"], fastest["total_risk"]):
+            frontier.append(safest)
+            stack = [(fastest, safest)]
+            while stack and len(frontier) < max_routes:
+                a, b = stack.pop()
+                w_time = a["total_risk"] - b["total_risk"]
+                w_risk = b["total_time"] - a["total_time"]
+                if w_time <= 0 or w_risk <= 0:
+                    continue
+                candidate = weighted(w_time, w_risk)
+                line = w_time * a["total_time"] + w_risk * a["total_risk"]
+                value = w_time * candidate["total_time"] + w_risk * candidate["total_risk"]
+                if value < line * (1 - 1e-9):
+                    frontier.append(candidate)
+                    stack.append((candidate, b))
+                    stack.append((a, candidate))
+    frontier.sort(key=lambda r: r["total_time"])
+
+    weighted_route = None
+    if weighting is not None:
+        t0 = max(fastest["total_time"], 1e-12)
+        r0 = max(safest["total_risk"], 1e-12)
+        with stage("weighted"):
+            weighted_route = weighted((1 - weighting) / t0, weighting / r0)
+
+    count(routes=len(frontier))
+    result = {"best": best, "pareto": frontier, "weighted": weighted_route}
+    if key is not None:
+        route_cache_for(rg).put(key, result)
+    return result
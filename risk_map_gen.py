@@ -1,13 +1,96 @@
+import argparse
+import hashlib
 import os
+import numpy as np
 import pandas as pd
-import osmnx as ox
-from collections import defaultdict, deque
-import math
+from routing_engine import as_routing_graph
+from cost_tables import edge_risk_path
+from routing_utils import load_graph, SNAPSHOT_PATH
+from risk_store import RiskStore, RISK_STORE_DIR
+from spatial_index import graph_signature, spatial_index_for
+
+def propagate_edge_names(rg, name_id, unnamed_id, max_depth=None, edge_rank=None):
+    """
+    Give every unnamed edge the name of its nearest named edge, in one
+    multi-source sweep over the whole graph.
+
+    A node is labelled by the first of its outgoing edges (n, w, key) that is
+    named or whose opposite edge (w, n, key) is named, the outgoing edge's
+    name winning. A breadth-first sweep backwards from all labelled nodes
+    then gives every node the hop distance to, and the label of, the nearest
+    labelled node reachable from it, ties going to the first outgoing edge
+    into a closer node. An unnamed edge (u, v) takes the label of whichever
+    end is closer (u on ties).
+
+    "First" is by edge_rank, or by RoutingGraph edge order (end node, then
+    key) when it is None. fill_missing_edge_names_with_bfs passes G's
+    adjacency order, the order in which the per-edge BFS checks a node's
+    edges, so both label a node with the same name.
+
+    Parameters:
+    - rg: RoutingGraph
+    - name_id: int array with a name index per edge
+    - unnamed_id: index that marks an unnamed edge
+    - max_depth: Optional[int] max BFS depth; None for unlimited
+    - edge_rank: Optional int array with the tie-break rank of every edge
+
+    Returns a new name_id array.
+    """
+    n, m = rg.num_nodes, rg.num_edges
+    src = np.asarray(rg.edge_src)
+    dst = np.asarray(rg.edge_dst)
+    name_id = np.asarray(name_id)
+    named = name_id != unnamed_id
+    if m == 0 or named.all() or not named.any():
+        return name_id.copy()
+
+    rev = rg.reverse_edges()
+    has_rev = rev >= 0
+    candidate = np.where(named, name_id, np.where(has_rev & named[rev], name_id[rev], -1))
+
+    rank = np.arange(m) if edge_rank is None else np.asarray(edge_rank)
+
+    # Label of a node: its first outgoing edge with a candidate name
+    dist = np.full(n, -1, dtype=np.int64)
+    label = np.full(n, -1, dtype=name_id.dtype)
+    labelled = np.flatnonzero(candidate >= 0)
+    labelled = labelled[np.argsort(rank[labelled], kind="stable")]
+    frontier, first = np.unique(src[labelled], return_index=True)
+    dist[frontier] = 0
+    label[frontier] = candidate[labelled[first]]
+
+    # Incoming edges of every node, in edge order
+    in_order = np.argsort(dst, kind="stable")
+    in_indptr = np.zeros(n + 1, dtype=np.int64)
+    in_indptr[1:] = np.cumsum(np.bincount(dst, minlength=n))
+
+    depth = 0
+    while len(frontier) and (max_depth is None or depth < max_depth):
+        starts, counts = in_indptr[frontier], in_indptr[frontier + 1] - in_indptr[frontier]
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        edges = in_order[offsets + np.arange(counts.sum())]
+        edges = edges[dist[src[edges]] < 0]
+        edges = edges[np.argsort(rank[edges], kind="stable")]
+        # Each new node follows its first edge into the frontier
+        frontier, first = np.unique(src[edges], return_index=True)
+        depth += 1
+        dist[frontier] = depth
+        label[frontier] = label[dst[edges[first]]]
+
+    result = name_id.copy()
+    unnamed = np.flatnonzero(~named)
+    du, dv = dist[src[unnamed]], dist[dst[unnamed]]
+    end = np.where((du >= 0) & ((dv < 0) | (du <= dv)), src[unnamed], dst[unnamed])
+    found = dist[end] >= 0
+    result[unnamed[found]] = label[end[found]]
+    return result
+
 
 def fill_missing_edge_names_with_bfs(G, edge_to_name, max_depth=None):
     """
-    Replaces 'Unnamed Road' edges with names from nearby connected edges via BFS.
-    Modifies edge_to_name in-place.
+    Replaces 'Unnamed Road' edges with names from nearby connected edges.
+    Modifies edge_to_name in-place. Runs as a single sweep, see
+    propagate_edge_names, with ties broken in G's adjacency order.
 
     Parameters:
     - G: networkx.MultiDiGraph from OSMnx
@@ -16,143 +99,298 @@ def fill_missing_edge_names_with_bfs(G, edge_to_name, max_depth=None):
     """
     print("Filling in unnamed roads using BFS...")
 
-    # Precompute named and unnamed edge sets
-    named_edges = {edge for edge, name in edge_to_name.items() if name != 'Unnamed Road'}
-    unnamed_edges = [edge for edge, name in edge_to_name.items() if name == 'Unnamed Road']
+    rg = as_routing_graph(G)
+    names = np.array([edge_to_name[edge] for edge in G.edges(keys=True)], dtype=object)
+    road_names, name_id = np.unique(names[rg.nx_edge_order], return_inverse=True)
+    if 'Unnamed Road' in road_names:
+        unnamed_id = int(np.searchsorted(road_names, 'Unnamed Road'))
+        # nx_edge_order ranks the edges in G.edges() (adjacency) order
+        filled = propagate_edge_names(rg, name_id, unnamed_id, max_depth, rg.nx_edge_order)
+        for e in np.flatnonzero(filled != name_id).tolist():
+            edge_to_name[rg.edge_tuple(e)] = road_names[filled[e]]
 
-    for u, v, k in unnamed_edges:
-        visited = set()
-        queue = deque([(u, 0), (v, 0)])  # start from both endpoints
-        found_name = None
+    print("Unnamed roads updated.")
 
-        while queue:
-            node, depth = queue.popleft()
-            if node in visited:
-                continue
-            visited.add(node)
 
-            if max_depth is not None and depth > max_depth:
-                continue
+def edge_names_cache_key(rg, max_depth):
+    # Graph, input names and depth the filled names were computed for
+    digest = hashlib.sha1(np.ascontiguousarray(rg.edge_name_id).tobytes())
+    digest.update("\0".join(rg.names).encode())
+    return np.array([*graph_signature(rg), -1 if max_depth is None else max_depth, digest.hexdigest()])
 
-            # Explore connected edges
-            for nbr in G.neighbors(node):
-                for key, data in G[node][nbr].items():
-                    candidate = (node, nbr, key)
-                    reverse = (nbr, node, key)
 
-                    if candidate in named_edges:
-                        found_name = edge_to_name[candidate]
-                    elif reverse in named_edges:
-                        found_name = edge_to_name[reverse]
+def filled_edge_names(rg, max_depth=None, path=None):
+    """
+    Name index into rg.names for every edge of a RoutingGraph, with unnamed
+    edges filled by propagate_edge_names. Loaded from `path` when a file
+    computed for the same graph and names exists, otherwise computed (and
+    saved to `path` when given).
+    """
+    cache_key = edge_names_cache_key(rg, max_depth)
+    if path and os.path.exists(path):
+        data = np.load(path)
+        if np.array_equal(data["key"], cache_key):
+            return data["name_id"]
 
-                    if found_name:
-                        break
-                if found_name:
-                    break
+    print("Filling in unnamed roads using BFS...")
+    unnamed = rg.names.index('Unnamed Road') if 'Unnamed Road' in rg.names else -1
+    name_id = propagate_edge_names(rg, rg.edge_name_id, unnamed, max_depth)
+    if path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, key=cache_key, name_id=name_id)
+    print("Unnamed roads updated.")
+    return name_id
 
-                if nbr not in visited:
-                    queue.append((nbr, depth + 1))
 
-            if found_name:
-                break
+# Weather conditions that get their own risk table
+TARGET_CONDITIONS = [
+    'Clear', 'Partially cloudy', 'Overcast', 'Rain',
+    'Rain, Overcast', 'Rain, Partially cloudy'
+]
 
-        if found_name:
-            edge_to_name[(u, v, k)] = found_name
+# Filled-in road names of the snapshot graph, see filled_edge_names
+EDGE_NAMES_PATH = SNAPSHOT_PATH + ".names.npz"
 
-    print("Unnamed roads updated.")
+# Only these columns of the accident CSV are read
+ACCIDENT_COLUMNS = {
+    'Start_Lat': 'float64',
+    'Start_Lng': 'float64',
+    'Visibility(mi)': 'float32',
+    'conditions': 'object',
+}
 
 
-def main():
-    # --- 1. Load accident data ---
-    df = pd.read_csv('data/merged_data.csv')
-
-    # --- 2. Load the road network graph ---
-    places = [
-    "Los Angeles, California, USA",
-    "Santa Monica, California, USA",
-    "Beverly Hills, California, USA",
-    "West Hollywood, California, USA",
-    "Culver City, California, USA",
-    "Inglewood, California, USA",
-    "Glendale, California, USA",
-    "Burbank, California, USA",
-    "Pasadena, California, USA"]
-
-    if not os.path.exists("data/la.graphml"):
-        # Download the graph and save it to a file
-        G = ox.graph_from_place(places, network_type="drive")
-        ox.save_graphml(G, "data/la.graphml")
-    else:
-        G = ox.load_graphml("data/la.graphml")
+def edge_road_names(rg, max_depth=None, path=EDGE_NAMES_PATH):
+    """
+    Road name of every RoutingGraph edge, with unnamed edges filled in
+    (cached at `path`, see filled_edge_names).
 
-    # --- 3. Match accidents to nearest road edges ---
-    print("Matching accidents to roads...")
-    edges = ox.distance.nearest_edges(
-        G, X=df['Start_Lng'].values, Y=df['Start_Lat'].values
-    )
-    df['edge'] = list(edges)
-
-    # --- 4. Build edge-to-name mapping ---
-    edge_to_name = {}
-    for u, v, k, data in G.edges(keys=True, data=True):
-        name = data.get('name')
-        if isinstance(name, list):
-            name = name[0]
-        elif not name:
-            name = 'Unnamed Road'
-        edge_to_name[(u, v, k)] = name
-
-    # --- 5. Fill missing names via BFS ---
-    fill_missing_edge_names_with_bfs(G, edge_to_name)
-
-    # --- 6. Map edges to road names in DataFrame ---
-    df['road_name'] = df['edge'].map(edge_to_name)
-
-    # --- 7. Define target weather conditions ---
-    target_conditions = [
-        'Clear', 'Partially cloudy', 'Overcast', 'Rain',
-        'Rain, Overcast', 'Rain, Partially cloudy'
-    ]
-
-    # --- 8. Ensure output directory exists ---
-    output_dir = 'risk_maps'
+    Returns (road_names, edge_road): the list of distinct names and an int32
+    array with the index into road_names for every edge.
+    """
+    name_id = filled_edge_names(rg, max_depth, path)
+    names = np.array(rg.names, dtype=object)[name_id]
+    road_names, edge_road = np.unique(names, return_inverse=True)
+    return list(road_names), edge_road.astype(np.int32)
+
+
+def aggregate_accidents(path, index, edge_road, conditions, chunksize=200_000, assignments=None):
+    """
+    Stream the accident CSV in chunks and aggregate it per (condition, road).
+
+    Every chunk is snapped to edges with the spatial index and reduced to
+    per-(condition, road) counts and visibility sums with one group-by, so
+    memory stays flat no matter how many years of accidents the file holds.
+
+    With `assignments` (a dict) given, the matched edge, condition and
+    visibility of every accident are also collected into it as arrays, the
+    condition as an int8 code into `conditions` (stored under 'conditions').
+
+    Returns (agg, v_max): a DataFrame indexed by (condition, road) with
+    columns count and vis_sum (accidents with a visibility value only), and
+    the maximum visibility over all accidents.
+    """
+    partials = []
+    matched = []
+    v_max = -np.inf
+    conditions = list(conditions)
+    if assignments is not None and len(conditions) > np.iinfo(np.int8).max:
+        raise ValueError(f"At most {np.iinfo(np.int8).max} conditions can be assigned")
+    reader = pd.read_csv(path, usecols=list(ACCIDENT_COLUMNS), dtype=ACCIDENT_COLUMNS,
+                         chunksize=chunksize)
+    for chunk in reader:
+        # The visibility scale is taken over all accidents, as before
+        v_max = max(v_max, float(chunk['Visibility(mi)'].max()))
+        chunk = chunk[chunk['conditions'].isin(conditions) & chunk['Visibility(mi)'].notna()]
+        if chunk.empty:
+            continue
+
+        edges, _ = index.nearest_edges(chunk['Start_Lat'].values, chunk['Start_Lng'].values)
+        keep = edges >= 0
+        if assignments is not None:
+            # Codes rather than strings: a unicode condition per accident took 88 bytes
+            codes = pd.Categorical(chunk['conditions'].values[keep], categories=conditions).codes
+            matched.append((edges[keep].astype(np.int32), codes.astype(np.int8),
+                            chunk['Visibility(mi)'].values[keep]))
+        grouped = pd.DataFrame({
+            'condition': chunk['conditions'].values[keep],
+            'road': edge_road[edges[keep]],
+            'vis': chunk['Visibility(mi)'].values[keep].astype(np.float64),
+        }).groupby(['condition', 'road'])['vis'].agg(['count', 'sum'])
+        partials.append(grouped.rename(columns={'sum': 'vis_sum'}))
+
+    if assignments is not None:
+        assignments['conditions'] = conditions
+        for key, dtype, i in (('edge', np.int32, 0), ('condition', np.int8, 1), ('vis', np.float32, 2)):
+            assignments[key] = (np.concatenate([m[i] for m in matched]).astype(dtype, copy=False)
+                                if matched else np.empty(0, dtype=dtype))
+
+    if not partials:
+        empty = pd.MultiIndex.from_arrays([[], []], names=['condition', 'road'])
+        return pd.DataFrame({'count': [], 'vis_sum': []}, index=empty), v_max
+    agg = pd.concat(partials).groupby(level=['condition', 'road']).sum()
+    return agg, v_max
+
+
+def risk_tables(agg, v_max, road_names, conditions):
+    """
+    Risk score per road for every condition.
+
+    Each accident weighs vis_weight = 1 + v_max - visibility, so the summed
+    weight of a road is count * (1 + v_max) - vis_sum. Scores are the summed
+    weights normalized by the largest one of the condition.
+    """
+    agg = agg.assign(weight=agg['count'] * (1 + v_max) - agg['vis_sum'])
+    tables = {}
+    for condition in conditions:
+        if condition in agg.index.get_level_values('condition'):
+            weights = agg.loc[condition, 'weight']
+        else:
+            weights = pd.Series(dtype=np.float64)
+        max_weight = weights.max() if len(weights) else 1.0
+        tables[condition] = pd.DataFrame({
+            'road_name': [road_names[r] for r in weights.index],
+            'risk_score': (weights / max_weight).values,
+        }).sort_values(by='risk_score', ascending=False)
+    return tables
+
+
+def smooth_edge_values(rg, values, alpha=0.5, iterations=1):
+    """
+    Blend every edge's value with the mean over the edges sharing one of its
+    end nodes: (1 - alpha) * own + alpha * mean, repeated `iterations` times.
+    """
+    n = rg.num_nodes
+    src, dst = rg.edge_src, rg.edge_dst
+    degree = np.bincount(src, minlength=n) + np.bincount(dst, minlength=n)
+    neighbours = degree[src] + degree[dst] - 2
+    values = np.asarray(values, dtype=np.float64)
+    for _ in range(iterations):
+        node_sum = np.bincount(src, values, minlength=n) + np.bincount(dst, values, minlength=n)
+        mean = np.divide(node_sum[src] + node_sum[dst] - 2 * values, neighbours,
+                         out=values.copy(), where=neighbours > 0)
+        values = (1 - alpha) * values + alpha * mean
+    return values
+
+
+def edge_risk(rg, assignments, v_max, condition, smoothing=0.0, iterations=1):
+    """
+    Risk score per RoutingGraph edge for one condition, from the accident
+    assignments of a RiskStore.
+
+    Accidents on a two-way street snap to either direction, so an edge and
+    its opposite edge share their summed weight. With `smoothing` > 0 the
+    weights are blended with adjacent edges (see smooth_edge_values).
+    Scores are normalized by the largest one, like the road tables.
+
+    Returns a float32 array in edge order.
+    """
+    conditions = list(assignments['conditions'])
+    code = conditions.index(condition) if condition in conditions else -1
+    mask = assignments['condition'] == code
+    weight = np.bincount(assignments['edge'][mask],
+                         weights=(1 + v_max) - assignments['vis'][mask].astype(np.float64),
+                         minlength=rg.num_edges)
+    rev = rg.reverse_edges()
+    weight = weight + np.where(rev >= 0, weight[rev], 0.0)
+    if smoothing > 0:
+        weight = smooth_edge_values(rg, weight, smoothing, iterations)
+    max_weight = weight.max() if len(weight) else 0.0
+    return (weight / max_weight if max_weight > 0 else weight).astype(np.float32)
+
+
+def write_edge_risk(rg, risk, condition, output_dir='risk_maps'):
+    filename = edge_risk_path(condition, output_dir)
     os.makedirs(output_dir, exist_ok=True)
-    v_min, v_max = df['Visibility(mi)'].min(), df['Visibility(mi)'].max()
-    df['vis_weight'] = 1 + v_max - df['Visibility(mi)']
-    # --- 9. Compute and export risk maps per condition ---
-    for condition_filter in target_conditions:
-        print(f"Processing condition: {condition_filter}")
-
-        # Filter rows exactly matching the condition
-        df_filtered = df[df['conditions'] == condition_filter].copy()
-
-        
-        # Sum weights per road
-        road_risk_weight = defaultdict(float)
-        for road, weight in zip(df_filtered['road_name'], df_filtered['vis_weight']):
-            if not math.isnan(weight):
-                road_risk_weight[road] += weight
-        # Normalize risk scores between 0 and 1
-        max_weight = max(road_risk_weight.values(), default=1.0)
-        road_risk_score = {
-            road: weight / max_weight
-            for road, weight in road_risk_weight.items()
-        }
-
-         # Build DataFrame and save
-        risk_df = pd.DataFrame(
-            [{'road_name': road, 'risk_score': score}
-            for road, score in road_risk_score.items()]
-        ).sort_values(by='risk_score', ascending=False)
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, risk=risk, signature=np.array(graph_signature(rg), dtype=np.float64))
+    os.replace(filename + ".tmp", filename)
+    print(f"Saved: {filename}")
 
 
+def write_risk_tables(tables, output_dir='risk_maps', fmt='csv'):
+    # Each file is replaced atomically; a running router picks the new table
+    # up on its next request, since CostTables watches the file's mtime
+    os.makedirs(output_dir, exist_ok=True)
+    for condition, risk_df in tables.items():
         filename = os.path.join(
             output_dir,
-            f"{condition_filter.replace(', ', '_').replace(' ', '_')}.csv"
+            f"{condition.replace(', ', '_').replace(' ', '_')}.{fmt}"
         )
-        risk_df.to_csv(filename, index=False)
+        tmp = filename + ".tmp"
+        if fmt == 'parquet':
+            risk_df.to_parquet(tmp, index=False)
+        else:
+            risk_df.to_csv(tmp, index=False)
+        os.replace(tmp, filename)
         print(f"Saved: {filename}")
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build per-weather road risk tables from accident data.")
+    parser.add_argument('command', nargs='?', choices=['build', 'update'], default='build',
+                        help="build: rebuild everything from --input; "
+                             "update: add the accidents in --input to the risk store")
+    parser.add_argument('--input', default='data/merged_data.csv', help="accident CSV")
+    parser.add_argument('--store-dir', default=RISK_STORE_DIR, help="raw aggregates kept between updates")
+    parser.add_argument('--output-dir', default='risk_maps')
+    parser.add_argument('--conditions', nargs='+', default=TARGET_CONDITIONS,
+                        help="weather conditions to build tables for")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--chunksize', type=int, default=200_000, help="accident rows per chunk")
+    parser.add_argument('--level', choices=['road', 'edge'], default='road',
+                        help="edge: also write per-edge risk, which the router then uses instead of road names")
+    parser.add_argument('--smoothing', type=float, default=0.0,
+                        help="share of the adjacent edges' mean in per-edge risk (0 to 1)")
+    parser.add_argument('--smoothing-iterations', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # --- 1. Load the road network graph ---
+    rg = load_graph()
+    index = spatial_index_for(rg)
+
+    # --- 2. Road name of every edge, unnamed ones filled via BFS ---
+    road_names, edge_road = edge_road_names(rg)
+
+    if args.command == 'update':
+        store = RiskStore.load(args.store_dir)
+        if store is None or not store.matches(rg):
+            raise SystemExit(f"No risk store for this graph in {args.store_dir}; run a build first")
+        if store.has_batch(args.input):
+            print(f"{args.input} was already ingested, nothing to do")
+            return
+    else:
+        store = RiskStore.create(args.store_dir)
+
+    # --- 3. Stream accidents, match them to roads and aggregate ---
+    # Only the new batch is snapped; earlier ones live on in the store
+    print("Matching accidents to roads...")
+    assignments = {}
+    agg, v_max = aggregate_accidents(args.input, index, edge_road, args.conditions, args.chunksize,
+                                     assignments)
+    store.add_batch(args.input, rg, agg, v_max, road_names, assignments)
+    # A rebuilt store replaces the old one only now that it is complete
+    store.publish()
+
+    # --- 4. Compute and export risk maps per condition ---
+    agg, names = store.aggregates()
+    tables = risk_tables(agg, store.v_max, names, args.conditions)
+    write_risk_tables(tables, args.output_dir, args.format)
+
+    assignments = store.assignments() if args.level == 'edge' else None
+    for condition in args.conditions:
+        if assignments is not None:
+            risk = edge_risk(rg, assignments, store.v_max, condition,
+                             args.smoothing, args.smoothing_iterations)
+            write_edge_risk(rg, risk, condition, args.output_dir)
+        elif os.path.exists(edge_risk_path(condition, args.output_dir)):
+            # A stale edge-level file would take precedence over the new road table
+            os.remove(edge_risk_path(condition, args.output_dir))
+
+
 if __name__ == '__main__':
     main()
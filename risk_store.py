@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from spatial_index import graph_signature
+
+RISK_STORE_DIR = "data/risk_store"
+
+
+def _replace(path, write):
+    # Write to a temporary file first, so readers never see a partial file
+    tmp = path + ".tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+class RiskStore:
+    """
+    Persistent raw accident aggregates behind the risk tables.
+
+    Risk tables are normalized weight sums, which cannot be updated in
+    place, so the store keeps what they are computed from:
+    - sums: DataFrame with columns condition, road_name, count and vis_sum
+    - v_max: maximum visibility over all ingested accidents
+    - batches: list of ingested inputs (path, size, mtime, rows)
+    - conditions: condition names the stored condition codes index into
+    - one assignments file per batch with the edge index, condition code and
+      visibility of every matched accident, so accidents never have to be
+      snapped to the graph again
+
+    Files live in `store_dir`: store.json, sums.csv and assignments/<n>.npz.
+    A store from create() is written to `<store_dir>.building` until
+    publish() moves it into place.
+    """
+
+    def __init__(self, store_dir=RISK_STORE_DIR):
+        self.store_dir = store_dir
+        self.target_dir = None  # where publish() moves a store from create()
+        self.signature = None
+        self.v_max = -np.inf
+        self.batches = []
+        self.conditions = []
+        self.sums = pd.DataFrame({'condition': [], 'road_name': [], 'count': [], 'vis_sum': []})
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.store_dir, "store.json")
+
+    @property
+    def sums_path(self):
+        return os.path.join(self.store_dir, "sums.csv")
+
+    def assignments_path(self, batch):
+        return os.path.join(self.store_dir, "assignments", f"{batch}.npz")
+
+    @classmethod
+    def load(cls, store_dir=RISK_STORE_DIR):
+        """Load a store; None if `store_dir` holds none."""
+        store = cls(store_dir)
+        if not os.path.exists(store.meta_path):
+            return None
+        with open(store.meta_path) as f:
+            meta = json.load(f)
+        store.signature = meta["signature"]
+        store.v_max = meta["v_max"]
+        store.batches = meta["batches"]
+        store.conditions = meta.get("conditions", [])
+        store.sums = pd.read_csv(store.sums_path)
+        return store
+
+    def matches(self, rg):
+        return self.signature == list(graph_signature(rg))
+
+    def has_batch(self, path):
+        stat = os.stat(path)
+        return any(b["path"] == os.path.abspath(path) and b["size"] == stat.st_size
+                   and b["mtime"] == stat.st_mtime_ns for b in self.batches)
+
+    def add_batch(self, path, rg, agg, v_max, road_names, assignments):
+        """
+        Add the aggregates of one accident batch.
+
+        Parameters:
+        - path: input file of the batch, recorded so it is not ingested twice
+        - rg: RoutingGraph the accidents were matched to
+        - agg: DataFrame indexed by (condition, road) with count and vis_sum,
+               as returned by risk_map_gen.aggregate_accidents
+        - v_max: maximum visibility of the batch
+        - road_names: names the road level of `agg` indexes into
+        - assignments: dict with edge, condition and vis arrays and the
+                       conditions list the condition codes index into
+        """
+        if self.signature is None:
+            self.signature = list(graph_signature(rg))
+        elif not self.matches(rg):
+            raise ValueError("Risk store was built for a different graph; rebuild it")
+
+        batch = len(self.batches)
+        new = agg.reset_index()
+        new = pd.DataFrame({
+            'condition': new['condition'],
+            'road_name': [road_names[r] for r in new['road']],
+            'count': new['count'],
+            'vis_sum': new['vis_sum'],
+        })
+        self.sums = (pd.concat([self.sums, new])
+                     .groupby(['condition', 'road_name'], as_index=False)[['count', 'vis_sum']].sum())
+        self.v_max = max(self.v_max, float(v_max))
+
+        os.makedirs(os.path.dirname(self.assignments_path(batch)), exist_ok=True)
+        codes = self._condition_codes(assignments["conditions"])[assignments["condition"]]
+
+        def write(p):
+            # A file object, as np.savez would append .npz to the temporary name
+            with open(p, "wb") as f:
+                np.savez(f, edge=assignments["edge"], condition=codes, vis=assignments["vis"])
+        _replace(self.assignments_path(batch), write)
+        stat = os.stat(path)
+        self.batches.append({"path": os.path.abspath(path), "size": stat.st_size,
+                             "mtime": stat.st_mtime_ns, "rows": int(len(assignments["edge"]))})
+        self.save()
+
+    def _condition_codes(self, conditions):
+        # Store code of each of `conditions`, adding the ones not seen yet
+        for condition in conditions:
+            if condition not in self.conditions:
+                self.conditions.append(condition)
+        if len(self.conditions) > np.iinfo(np.int8).max:
+            raise ValueError(f"At most {np.iinfo(np.int8).max} conditions can be stored")
+        return np.array([self.conditions.index(c) for c in conditions], dtype=np.int8)
+
+    def assignments(self):
+        """Concatenated accident assignments of every batch, in the form aggregate_accidents collects."""
+        parts = {"edge": [], "condition": [], "vis": []}
+        for b in range(len(self.batches)):
+            data = np.load(self.assignments_path(b))
+            condition = data["condition"]
+            if condition.dtype.kind == "U":
+                # Stores written before condition codes kept the names
+                names, inverse = np.unique(condition, return_inverse=True)
+                condition = self._condition_codes(list(names))[inverse]
+            parts["edge"].append(data["edge"])
+            parts["condition"].append(condition)
+            parts["vis"].append(data["vis"])
+        assignments = {k: np.concatenate(v) if v else np.empty(0, dtype=dtype)
+                       for (k, v), dtype in zip(parts.items(), (np.int32, np.int8, np.float32))}
+        assignments["conditions"] = list(self.conditions)
+        return assignments
+
+    def aggregates(self):
+        """(agg, road_names) in the form risk_map_gen.risk_tables takes."""
+        road, road_names = pd.factorize(self.sums['road_name'])
+        agg = pd.DataFrame({'count': self.sums['count'].values, 'vis_sum': self.sums['vis_sum'].values},
+                           index=pd.MultiIndex.from_arrays([self.sums['condition'].values, road],
+                                                           names=['condition', 'road']))
+        return agg, list(road_names)
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        _replace(self.sums_path, lambda p: self.sums.to_csv(p, index=False))
+        meta = {"signature": self.signature, "v_max": self.v_max, "batches": self.batches,
+                "conditions": self.conditions}
+
+        def write(p):
+            with open(p, "w") as f:
+                json.dump(meta, f, indent=1)
+        _replace(self.meta_path, write)
+
+    @classmethod
+    def create(cls, store_dir=RISK_STORE_DIR):
+        """
+        Empty store that replaces any existing one in `store_dir` when
+        published. Until then it is written next to it, so a failed build
+        leaves the existing store intact.
+        """
+        store = cls(store_dir + ".building")
+        # Left over from a build that failed
+        shutil.rmtree(store.store_dir, ignore_errors=True)
+        store.target_dir = store_dir
+        return store
+
+    def publish(self):
+        """Move a store from create() into place; nothing to do for a loaded store."""
+        if self.target_dir is None:
+            return
+        self.save()
+        # A non-empty directory cannot be replaced in one rename
+        old = self.target_dir + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.target_dir):
+            os.replace(self.target_dir, old)
+        os.replace(self.store_dir, self.target_dir)
+        shutil.rmtree(old, ignore_errors=True)
+        self.store_dir, self.target_dir = self.target_dir, None
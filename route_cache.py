@@ -0,0 +1,100 @@
+import sys
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 10000
+MAX_BYTES = 64 * 1024 * 1024
+
+# Rough footprint of one edge of a cached route: the (u, v, key) tuple with
+# its ints, the node id and the list slots for node, edge and road name
+BYTES_PER_EDGE = 220
+
+
+def route_nbytes(value):
+    """Approximate memory held by a cached route result."""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(route_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], tuple):
+            return sys.getsizeof(value) + BYTES_PER_EDGE * len(value)
+        return sys.getsizeof(value) + sum(route_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class RouteCache:
+    """
+    Bounded LRU cache of route results.
+
+    Keys are (source node, target node, weather, metric, cost-table version)
+    tuples, so refreshed cost tables never serve old routes; their entries
+    just age out. Entries are evicted least recently used first once either
+    `max_entries` or `max_bytes` (approximate, see route_nbytes) is exceeded.
+    Safe to share between threads.
+
+    Counters: hits, misses, evictions.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = route_nbytes(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Counters and size as a dict, e.g. for a debug panel."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def route_cache_for(rg):
+    """The RouteCache attached to a RoutingGraph, created on first use."""
+    cache = getattr(rg, "route_cache", None)
+    if cache is None:
+        cache = RouteCache()
+        rg.route_cache = cache
+    return cache
@@ -0,0 +1,112 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+import networkx as nx
+
+import metrics
+
+# Base URL of a routing_server, e.g. http://127.0.0.1:8765; when set,
+# interactive_route sends its routing jobs there instead of to its own pool
+SERVER_URL = os.environ.get("ROUTING_SERVER_URL")
+
+
+class ServerBusy(RuntimeError):
+    """The server answered 503: all its workers and queue slots are taken."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Routing server busy, retry in {retry_after} s")
+        self.retry_after = retry_after
+
+
+def _route(route):
+    # JSON turns the (u, v, key) edge tuples into lists; plot_route wants tuples
+    route["edge_path"] = [tuple(e) for e in route["edge_path"]]
+    return route
+
+
+class RoutingClient:
+    """
+    Client of routing_server, with the same job interface as route_jobs.
+
+    Parameters:
+    - url: base URL of the server
+    - timeout: seconds to wait for a response
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def post(self, path, body):
+        """
+        POST a JSON body; returns (response body, Server-Timing header).
+
+        Raises ServerBusy on 503, the server's error message as
+        networkx.NetworkXNoPath on 404 and as ValueError on 400/413/422, and
+        RuntimeError on other errors.
+        """
+        request = urllib.request.Request(self.url + path, data=json.dumps(body).encode(),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read()), response.headers.get("Server-Timing", "")
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", e.reason)
+            except ValueError:
+                message = e.reason
+            if e.code == 503:
+                raise ServerBusy(int(e.headers.get("Retry-After", 1)))
+            if e.code == 404:
+                raise nx.NetworkXNoPath(message)
+            if e.code in (400, 413, 422):
+                raise ValueError(message)
+            raise RuntimeError(f"Routing server error {e.code}: {message}")
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+            data = response.read()
+            if response.headers.get_content_type() == "application/json":
+                return json.loads(data)
+            return data.decode()
+
+    def health(self):
+        return self.get("/health")
+
+    def run_job(self, job, origin, dest, weather, max_snap_distance=None, **options):
+        """
+        Same contract as route_jobs.run_job: returns (result, trace), where
+        the trace is the one measured by the server's worker.
+        """
+        body = {"job": job, "origin": origin, "dest": dest, "weather": weather,
+                "max_snap_distance": max_snap_distance, **options}
+        response, _ = self.post("/route", body)
+        trace = metrics.Trace.from_dict(response.pop("trace")[0])
+        if job == "options":
+            result = response
+            result["best"] = {metric: _route(r) for metric, r in result["best"].items()}
+            result["pareto"] = [_route(r) for r in result["pareto"]]
+            if result["weighted"] is not None:
+                result["weighted"] = _route(result["weighted"])
+        elif job == "alternatives":
+            result = [_route(r) for r in response["routes"]]
+        else:
+            result = (response["node_path"], _route(response)["edge_path"], response["road_names"])
+        return result, trace
+
+    def batch(self, trips, weather, metric="cost_time", paths=False, max_snap_distance=None):
+        """Route (origin_lat, origin_lng, dest_lat, dest_lng) trips; returns the /batch response."""
+        response, _ = self.post("/batch", {"trips": trips, "weather": weather,
+                                           "metric": metric, "paths": paths,
+                                           "max_snap_distance": max_snap_distance})
+        return response
+
+    def matrix(self, origins, destinations, weather, metric="cost_time", max_cost=None,
+               max_snap_distance=None):
+        """Cost matrix between (lat, lng) points; unreachable pairs are None."""
+        response, _ = self.post("/matrix", {"origins": origins, "destinations": destinations,
+                                            "weather": weather, "metric": metric, "max_cost": max_cost,
+                                            "max_snap_distance": max_snap_distance})
+        return response["matrix"]
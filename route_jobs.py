@@ -0,0 +1,148 @@
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from alternatives import alternative_routes
+from batch_routing import batch_route
+from cost_tables import tables_for
+from graph_snapshot import load_snapshot
+from heuristics import distance_scale, reverse_cost_matrix
+from multi_objective import route_options
+from routing import astar_route
+from spatial_index import spatial_index_for
+from travel_matrix import many_to_many
+
+# Jobs submitted for one origin/destination, with their run_job options: the
+# two optimal routes and the time/risk alternatives. The jobs run in
+# parallel, so the options job leaves the optimal routes to the other two
+# (its sweeps still run, as heuristics of the trade-off searches)
+JOBS = {"cost_time": {}, "cost_risk": {}, "options": {"metrics": ()}}
+
+# Metrics routed on, whose reduced costs workers build up front
+ROUTE_METRICS = ("cost_time", "cost_risk")
+
+_worker = {}
+
+
+def _init_worker(snapshot_path, index_path, weathers=()):
+    # Every worker memory-maps the same snapshot, so the graph pages are
+    # shared; cost tables and the route cache are built per worker, on first
+    # use or up front for `weathers` (except the Python cost lists of A*,
+    # which are built by the first search that needs them)
+    rg = load_snapshot(snapshot_path)
+    spatial_index_for(rg, index_path)
+    _worker["rg"] = rg
+    tables = tables_for(rg)
+    for weather in weathers:
+        for metric in ROUTE_METRICS:
+            reduced = tables.reduced(weather, metric)
+            distance_scale(rg, reduced)
+            reverse_cost_matrix(rg, reduced)
+
+
+def ping(delay=0.0):
+    """No-op job returning the worker's pid; `delay` keeps the worker busy so idle ones take the next ping."""
+    time.sleep(delay)
+    return os.getpid()
+
+
+def warm_pool(pool, workers, delay=0.05):
+    """
+    Block until every one of the pool's `workers` processes has run its
+    initializer (loaded the graph and built its cost tables) and answered a
+    ping. A fast worker can answer several pings of a round, so rounds are
+    sent until `workers` distinct pids have answered.
+    """
+    pids = set()
+    while len(pids) < workers:
+        pids.update(f.result() for f in [pool.submit(ping, delay) for _ in range(workers)])
+    return pids
+
+
+def run_job(job, origin, dest, weather, max_snap_distance=None, **options):
+    """
+    Run one routing job in a worker.
+
+    Parameters:
+    - job: 'cost_time', 'cost_risk', 'options' or 'alternatives';
+      'cost_time' and 'cost_risk' return the astar_route result for that
+      metric, 'options' the route_options result and 'alternatives' the
+      alternative_routes result
+    - origin, dest: (lat, lng) tuples
+    - weather: weather condition of the cost tables
+    - max_snap_distance: see astar_route
+    - options: keyword arguments of route_options or alternative_routes (e.g. k)
+
+    Returns (result, trace); the trace is sent to the sinks of the calling
+    process with metrics.emit, as worker processes have none registered.
+    """
+    rg = _worker["rg"]
+    if job == "options":
+        with metrics.trace("route_options", weather=weather) as t:
+            result = route_options(rg, origin, dest, weather, max_snap_distance=max_snap_distance, **options)
+    elif job == "alternatives":
+        with metrics.trace("alternative_routes", weather=weather) as t:
+            result = alternative_routes(rg, origin, dest, weather, max_snap_distance=max_snap_distance, **options)
+    else:
+        with metrics.trace("astar_route", weather=weather, metric=job) as t:
+            result = astar_route(rg, origin, dest, job, weather, max_snap_distance=max_snap_distance)
+    return result, t
+
+
+def run_batch(trips, weather, metric, max_snap_distance=None, return_paths=False):
+    """
+    Route a list of (origin_lat, origin_lng, dest_lat, dest_lng) trips in a
+    worker with batch_route.
+
+    Returns (columns, trace): the batch_route columns, where with
+    return_paths the routes are given as 'edge_paths', one list of (u, v, key)
+    tuples per trip, instead of path_offsets/path_edges.
+    """
+    rg = _worker["rg"]
+    trips = np.asarray(trips, dtype=np.float64).reshape(-1, 4)
+    with metrics.trace("batch_route", weather=weather, metric=metric) as t:
+        result = batch_route(rg, *trips.T, weather, metric, processes=1,
+                             return_paths=return_paths, max_snap_distance=max_snap_distance)
+        if return_paths:
+            offsets, edges = result.pop("path_offsets"), result.pop("path_edges")
+            result["edge_paths"] = [[rg.edge_tuple(e) for e in edges[offsets[i]:offsets[i + 1]].tolist()]
+                                    for i in range(len(trips))]
+        t.count(trips=len(trips))
+    return result, t
+
+
+def run_matrix(origins, destinations, weather, metric, max_cost=None, max_snap_distance=None):
+    """Cost matrix between (lat, lng) points in a worker with many_to_many; returns (matrix, trace)."""
+    with metrics.trace("many_to_many", weather=weather, metric=metric) as t:
+        result = many_to_many(_worker["rg"], origins, destinations, weather, metric, max_cost, max_snap_distance)
+        t.count(cells=result.size)
+    return result, t
+
+
+def default_workers():
+    # One core is left to the web server and map rendering
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def route_pool(snapshot_path, index_path, processes=None, weathers=()):
+    """
+    Process pool that runs route jobs.
+
+    The searches are pure-Python loops, so separate processes are needed for
+    the jobs of one request to run in parallel. The pool is meant to be
+    shared by all sessions: `processes` (default: all cores but one) bounds
+    the CPU used however many users are routing at once.
+
+    Parameters:
+    - snapshot_path: graph snapshot the workers memory-map
+    - index_path: saved spatial index of the snapshot
+    - processes: number of worker processes
+    - weathers: weather conditions whose cost tables every worker builds at start
+    """
+    # spawn: the web server runs threads, which fork does not copy safely
+    return ProcessPoolExecutor(processes or default_workers(), mp_context=mp.get_context("spawn"),
+                               initializer=_init_worker, initargs=(snapshot_path, index_path, tuple(weathers)))
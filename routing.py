@@ -1,19 +1,13 @@
 import networkx as nx
 import osmnx as ox
 import math
-from heapq import heappush, heappop
-
-def haversine_distance(u, v, G):
-    lon1, lat1 = G.nodes[u]['x'], G.nodes[u]['y']
-    lon2, lat2 = G.nodes[v]['x'], G.nodes[v]['y']
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-
-    a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    R = 6371000
-    return R * c
+from routing_engine import as_routing_graph, costs_for_weight, astar, route_from_pairs
+from spatial_index import spatial_index_for
+from heuristics import heuristic_for, landmark_path, landmarks_for
+from contraction_hierarchy import ch_for, ch_path, ch_query, pairs_along
+from cost_tables import tables_for
+from route_cache import route_cache_for
+import metrics
 
 def geocode_point(point):
     if isinstance(point, str):
@@ -24,83 +18,163 @@ def geocode_point(point):
     else:
         raise ValueError("Input must be an address string or (lat, lng) tuple")
 
-def astar_route(G, origin_point, destination_point, weight='weighted_length'):
+def snap_points(rg, origin_point, destination_point, max_snap_distance=None):
+    # Snap both (lat, lng) points in one batched query against the persistent KD-tree
+    nodes, _ = spatial_index_for(rg).nearest_nodes(
+        [origin_point[0], destination_point[0]],
+        [origin_point[1], destination_point[1]],
+        max_distance=max_snap_distance,
+    )
+    for node, point in zip(nodes, (origin_point, destination_point)):
+        if node < 0:
+            raise snap_error(point, max_snap_distance)
+    return int(nodes[0]), int(nodes[1])
+
+def snap_error(point, max_snap_distance=None):
+    # ValueError for a (lat, lng) point the spatial index could not snap
+    if not all(math.isfinite(v) for v in point):
+        return ValueError(f"Point {tuple(point)} has no valid coordinates")
+    label = "({:.6f}, {:.6f})".format(*point)
+    if max_snap_distance is None:
+        # Only a graph without nodes leaves a valid point unsnapped
+        return ValueError(f"Point {label} could not be snapped: the road network is empty")
+    return ValueError(f"Point {label} is more than {max_snap_distance:g} m away from the road network")
+
+def route_cache_key(rg, source, target, weather, metric):
+    # Routes on precomputed cost tables are cacheable; the table version in
+    # the key makes a refreshed risk map miss instead of serving stale routes
+    if weather is None or not isinstance(metric, (str, tuple)):
+        return None
+    return (source, target, weather, metric, tables_for(rg).version(weather))
+
+def _metric_label(weight):
+    return weight if isinstance(weight, str) else "custom"
+
+def _count_route(t, rg, reduced, pairs):
+    # Route length counters of a trace
+    edges = [reduced.best_edge[p] for p in pairs]
+    t.count(route_edges=len(edges), route_meters=round(float(rg.edge_length[edges].sum()), 1))
+
+def astar_route(G, origin_point, destination_point, weight='weighted_length', weather=None,
+                max_snap_distance=None, alt=False, stats=None, cache=True):
     """
     Perform A* search on graph G from origin_point to destination_point.
 
     Parameters:
     - G: networkx.MultiDiGraph with nodes having 'x','y',
-         and edges having a numerical attribute `weight` (e.g. 'weighted_length').
+         and edges having a numerical attribute `weight` (e.g. 'weighted_length'),
+         or a RoutingGraph (e.g. loaded from a graph snapshot)
     - origin_point: tuple (lat, lng) or address string
     - destination_point: tuple (lat, lng) or address string
-    - weight: edge attribute name to use as cost
+    - weight: edge attribute name to use as cost, or a per-edge cost vector
+              in RoutingGraph edge order
+    - weather: optional weather condition; if given, `weight` is a metric
+               ('cost_distance', 'cost_risk', 'cost_time') looked up in the
+               precomputed cost tables instead of the edge attributes
+    - max_snap_distance: optional distance in meters; points farther than this
+                         from the nearest node are rejected with a ValueError
+    - alt: use ALT landmark bounds as heuristic; tables are loaded from
+           data/landmarks when precomputed (python heuristics.py), else built
+    - stats: optional dict that receives the search counters ('expanded', 'pushes');
+             both are 0 when the route came from the cache
+    - cache: look routes on cost tables up in, and store them into, the
+             graph's RouteCache (see route_cache.py); cached results are
+             shared, so treat them as read-only
 
     Returns:
     - node_path: list of node IDs from origin to destination
     - edge_path: list of (u, v, key) tuples representing the route's edges
     - road_names: list of road names to follow along the path
     """
-    origin_point = geocode_point(origin_point)
-    destination_point = geocode_point(destination_point)
-
-    orig_node = ox.distance.nearest_nodes(G, X=origin_point[1], Y=origin_point[0])
-    dest_node = ox.distance.nearest_nodes(G, X=destination_point[1], Y=destination_point[0])
-
-    open_set = []
-    heappush(open_set, (0, orig_node))
-    came_from = {}
-
-    g_score = {node: float('inf') for node in G.nodes}
-    g_score[orig_node] = 0
-
-    f_score = {node: float('inf') for node in G.nodes}
-    f_score[orig_node] = haversine_distance(orig_node, dest_node, G)
-
-    closed_set = set()
-
-    while open_set:
-        current_f, current = heappop(open_set)
-
-        if current == dest_node:
-            node_path = [current]
-            while current in came_from:
-                current = came_from[current]
-                node_path.append(current)
-            node_path = node_path[::-1]
-
-            edge_path = []
-            road_names = []
-            for i in range(len(node_path) - 1):
-                u, v = node_path[i], node_path[i + 1]
-                min_key = min(G[u][v], key=lambda k: G[u][v][k].get(weight, G[u][v][k].get('length', 1)))
-                edge_path.append((u, v, min_key))
-
-                # Get road name
-                name = G[u][v][min_key].get("name")
-                if isinstance(name, list):
-                    name = name[0]
-                if not name:
-                    name = "Unnamed Road"
-                road_names.append(name)
-
-            return node_path, edge_path, road_names
-
-        closed_set.add(current)
-
-        for nbr in G.neighbors(current):
-            if nbr in closed_set:
-                continue
-
-            cost = float('inf')
-            for key, data in G[current][nbr].items():
-                edge_cost = data.get(weight, data.get('length', 1))
-                cost = min(cost, edge_cost)
-
-            tentative_g = g_score[current] + cost
-            if tentative_g < g_score.get(nbr, float('inf')):
-                came_from[nbr] = current
-                g_score[nbr] = tentative_g
-                f_score[nbr] = tentative_g + haversine_distance(nbr, dest_node, G)
-                heappush(open_set, (f_score[nbr], nbr))
+    with metrics.trace("astar_route", weather=weather, metric=_metric_label(weight)) as t:
+        with t.stage("geocode"):
+            origin_point = geocode_point(origin_point)
+            destination_point = geocode_point(destination_point)
+
+        # The array-backed graph is built once per G and reused by every query
+        rg = as_routing_graph(G)
+        with t.stage("costs"):
+            reduced = costs_for_weight(G, rg, weight, weather)
+
+        with t.stage("snap"):
+            source, target = snap_points(rg, origin_point, destination_point, max_snap_distance)
+
+        key = route_cache_key(rg, source, target, weather, weight) if cache else None
+        if key is not None:
+            result = route_cache_for(rg).get(key)
+            if result is not None:
+                t.count(cache_hits=1, route_edges=len(result[1]))
+                if stats is not None:
+                    stats.update(expanded=0, pushes=0)
+                return result
+
+        # Heuristic bounds match the metric, so the route is optimal for every cost
+        with t.stage("heuristic"):
+            landmarks = None
+            if alt:
+                path = landmark_path(weather, weight) if weather is not None and isinstance(weight, str) else None
+                landmarks = landmarks_for(rg, reduced, path)
+            heuristic = heuristic_for(rg, reduced, target, landmarks)
+
+        search = {}
+        with t.stage("search"):
+            pairs = astar(rg, source, target, reduced.cost_list, heuristic, search)
+        t.count(**search)
+        if stats is not None:
+            stats.update(search)
+
+        if pairs is not None:
+            with t.stage("reconstruct"):
+                result = route_from_pairs(rg, source, pairs, reduced.best_edge)
+            _count_route(t, rg, reduced, pairs)
+            if key is not None:
+                route_cache_for(rg).put(key, result)
+            return result
+
+    raise nx.NetworkXNoPath(f"No path between {origin_point} and {destination_point}")
+
+
+def ch_route(G, origin_point, destination_point, weight='cost_risk', weather='Clear',
+             max_snap_distance=None, cache=True):
+    """
+    Same as astar_route, but answered by a bidirectional upward search in the
+    contraction hierarchy of (weather, weight). Hierarchies are loaded from
+    data/ch when precomputed (python contraction_hierarchy.py), otherwise
+    built on first use, which takes minutes on the full graph.
+
+    Returns the same (node_path, edge_path, road_names) triple, with shortcuts
+    unpacked into the original (u, v, key) edges. Shares the route cache
+    with astar_route, since both return an optimal route.
+    """
+    with metrics.trace("ch_route", weather=weather, metric=_metric_label(weight)) as t:
+        with t.stage("geocode"):
+            origin_point = geocode_point(origin_point)
+            destination_point = geocode_point(destination_point)
+
+        rg = as_routing_graph(G)
+        with t.stage("costs"):
+            reduced = costs_for_weight(G, rg, weight, weather)
+        with t.stage("snap"):
+            source, target = snap_points(rg, origin_point, destination_point, max_snap_distance)
+
+        key = route_cache_key(rg, source, target, weather, weight) if cache else None
+        if key is not None:
+            result = route_cache_for(rg).get(key)
+            if result is not None:
+                t.count(cache_hits=1, route_edges=len(result[1]))
+                return result
+
+        with t.stage("hierarchy"):
+            ch = ch_for(rg, reduced, ch_path(weather, weight))
+        with t.stage("search"):
+            nodes = ch_query(ch, source, target)
+        if nodes is not None:
+            with t.stage("reconstruct"):
+                pairs = pairs_along(rg, nodes)
+                result = route_from_pairs(rg, source, pairs, reduced.best_edge)
+            _count_route(t, rg, reduced, pairs)
+            if key is not None:
+                route_cache_for(rg).put(key, result)
+            return result
 
     raise nx.NetworkXNoPath(f"No path between {origin_point} and {destination_point}")
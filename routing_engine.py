@@ -0,0 +1,408 @@
+import math
+import weakref
+import regex as re
+from heapq import heappush, heappop
+
+import numpy as np
+
+from cost_tables import tables_for
+
+
+def normalize_name(name):
+    # Same rule as get_edge_data / astar_route: first entry of lists, fallback for missing names
+    if isinstance(name, list):
+        name = name[0] if name else None
+    if not name or (isinstance(name, float) and math.isnan(name)):
+        name = "Unnamed Road"
+    return name
+
+
+def parse_maxspeed(value):
+    if isinstance(value, list):
+        value = value[0]
+    if isinstance(value, str):
+        match = re.search(r"\d+", value)
+        if match:
+            return float(match.group())
+    elif isinstance(value, (int, float)):
+        return float(value)
+    return None
+
+
+class ReducedCosts:
+    """
+    One metric's costs reduced to the cheapest edge per pair.
+
+    Attributes:
+    - pair_cost: float64 cost per pair
+    - best_edge: edge index chosen for every pair
+    - cost_list: pair_cost as a Python list, for the search loop (built on first use)
+    - scale: lower bound of cost per meter of great-circle distance (see heuristics)
+    - landmarks: optional LandmarkTables for ALT searches
+    - ch: optional ContractionHierarchy for this metric
+    - matrix: cached scipy CSR matrix of the graph
+    - reverse_matrix: cached scipy CSR matrix of the reversed graph
+    """
+
+    def __init__(self, pair_cost, best_edge):
+        self.pair_cost = pair_cost
+        self.best_edge = best_edge
+        self._cost_list = None
+        self.scale = None
+        self.landmarks = None
+        self.ch = None
+        self.matrix = None
+        self.reverse_matrix = None
+
+    @property
+    def cost_list(self):
+        # Built on first use: only the pure-Python searches need it, and as
+        # Python floats it takes four times the memory of pair_cost
+        if self._cost_list is None:
+            self._cost_list = self.pair_cost.tolist()
+        return self._cost_list
+
+
+class RoutingGraph:
+    """
+    Compact, array-backed copy of an osmnx MultiDiGraph used for routing.
+
+    Nodes are renumbered 0..n-1 (sorted by OSM id) and edges are stored in CSR
+    order, sorted by (source, target, key). Parallel edges are grouped into
+    "pairs" (one per (u, v)), so a search only ever sees one cheapest edge per
+    pair for the metric it runs on.
+
+    Attributes:
+    - node_ids: int64 OSM ids, sorted
+    - x, y: float64 longitude / latitude per node
+    - edge_src, edge_dst: int32 node indices per edge
+    - edge_key: int64 multigraph key per edge
+    - edge_length: float64 edge length in meters
+    - edge_maxspeed: float32 parsed maxspeed, NaN where the tag is missing
+    - edge_name_id: int32 index into `names` per edge
+    - names: list of road names (interned)
+    - geom_offsets, geom_coords: edge geometries packed as one (k, 2) lon/lat
+      array; edge e spans geom_coords[geom_offsets[e]:geom_offsets[e + 1]]
+    - edge_indptr: CSR offsets of each node's edges into the edge arrays
+    - pair_src, pair_dst: int32 node indices per pair
+    - pair_indptr: CSR offsets of each node's pairs into the pair arrays
+    - edge_pair: pair index of every edge
+    """
+
+    # Arrays that define the graph; everything else is derived from them
+    BASE_ARRAYS = ("node_ids", "x", "y", "edge_src", "edge_dst", "edge_key", "edge_length",
+                   "edge_maxspeed", "edge_name_id", "geom_offsets", "geom_coords")
+    DERIVED_ARRAYS = ("edge_indptr", "pair_start", "edge_pair", "pair_src", "pair_dst", "pair_indptr")
+
+    def __init__(self, node_ids, x, y, edge_src, edge_dst, edge_key, edge_length,
+                 edge_maxspeed, edge_name_id, names, geom_offsets, geom_coords, derived=None):
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.edge_key = edge_key
+        self.edge_length = edge_length
+        self.edge_maxspeed = edge_maxspeed
+        self.edge_name_id = edge_name_id
+        self.names = names
+        self.geom_offsets = geom_offsets
+        self.geom_coords = geom_coords
+
+        if derived is None:
+            derived = self._derive()
+        for name in self.DERIVED_ARRAYS:
+            setattr(self, name, derived[name])
+
+        self._lists = None
+        self._reduced = {}
+
+    def _derive(self):
+        n = len(self.node_ids)
+        edge_src, edge_dst = self.edge_src, self.edge_dst
+        # A new pair starts wherever (src, dst) changes in the sorted edge list
+        new_pair = np.ones(len(edge_src), dtype=bool)
+        if len(edge_src) > 1:
+            new_pair[1:] = (edge_src[1:] != edge_src[:-1]) | (edge_dst[1:] != edge_dst[:-1])
+        pair_start = np.flatnonzero(new_pair)
+        pair_src = edge_src[pair_start]
+        return {
+            "edge_indptr": np.searchsorted(edge_src, np.arange(n + 1)).astype(np.int64),
+            "pair_start": pair_start,
+            "edge_pair": (np.cumsum(new_pair) - 1).astype(np.int32),
+            "pair_src": pair_src,
+            "pair_dst": edge_dst[pair_start],
+            "pair_indptr": np.searchsorted(pair_src, np.arange(n + 1)).astype(np.int64),
+        }
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_src)
+
+    @property
+    def num_pairs(self):
+        return len(self.pair_src)
+
+    def node_index(self, osmid):
+        """Map an OSM node id to its internal index."""
+        i = int(np.searchsorted(self.node_ids, osmid))
+        if i >= len(self.node_ids) or self.node_ids[i] != osmid:
+            raise KeyError(osmid)
+        return i
+
+    def edge_index(self, u, v, key):
+        """Map an (u, v, key) edge given in OSM ids to its internal edge index."""
+        ui, vi = self.node_index(u), self.node_index(v)
+        lo, hi = self.edge_indptr[ui], self.edge_indptr[ui + 1]
+        for e in range(lo, hi):
+            if self.edge_dst[e] == vi and self.edge_key[e] == key:
+                return e
+        raise KeyError((u, v, key))
+
+    def edge_tuple(self, e):
+        """(u, v, key) in OSM ids for an internal edge index."""
+        return (int(self.node_ids[self.edge_src[e]]),
+                int(self.node_ids[self.edge_dst[e]]),
+                int(self.edge_key[e]))
+
+    def edge_name(self, e):
+        return self.names[self.edge_name_id[e]]
+
+    def edge_coords(self, e):
+        """Edge geometry as a list of (lat, lon) tuples, ready for folium."""
+        coords = self.geom_coords[self.geom_offsets[e]:self.geom_offsets[e + 1]]
+        return [(lat, lon) for lon, lat in coords.tolist()]
+
+    def reverse_edges(self):
+        """
+        Index of the opposite edge (v, u, key) of every edge (u, v, key), or -1
+        where there is none, e.g. on one-way streets.
+        """
+        m = self.num_edges
+        if m == 0:
+            return np.empty(0, dtype=np.int64)
+        src, dst, key = (np.asarray(a, dtype=np.int64) for a in (self.edge_src, self.edge_dst, self.edge_key))
+        # Edges are sorted by (src, dst, key), so this code is sorted too
+        n, width = self.num_nodes, int(key.max()) + 1
+        code = (src * n + dst) * width + key
+        wanted = (dst * n + src) * width + key
+        rev = np.minimum(np.searchsorted(code, wanted), m - 1)
+        return np.where(code[rev] == wanted, rev, -1)
+
+    def adjacency(self):
+        """
+        Plain Python lists of the pair adjacency and node coordinates in radians.
+        Indexing lists is much cheaper than indexing NumPy arrays inside the
+        search loop, so they are built once and reused by every query.
+        """
+        if self._lists is None:
+            self._lists = (
+                self.pair_indptr.tolist(),
+                self.pair_dst.tolist(),
+                np.radians(self.x).tolist(),
+                np.radians(self.y).tolist(),
+            )
+        return self._lists
+
+    def reduced_costs(self, edge_costs, key=None):
+        """
+        Reduce a per-edge cost vector to one cheapest edge per pair.
+
+        Returns a ReducedCosts. Results are cached under `key` when one is given.
+        """
+        if key is not None and key in self._reduced:
+            return self._reduced[key]
+        edge_costs = np.asarray(edge_costs, dtype=np.float64)
+        # Sort by (pair, cost); the first edge of each pair group is the cheapest
+        order = np.lexsort((edge_costs, self.edge_pair))
+        best_edge = order[self.pair_start]
+        result = ReducedCosts(edge_costs[best_edge], best_edge)
+        if key is not None:
+            self._reduced[key] = result
+        return result
+
+    def clear_costs(self):
+        self._reduced.clear()
+
+
+def from_networkx(G):
+    """Build a RoutingGraph from an osmnx MultiDiGraph."""
+    node_ids = np.sort(np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes()))
+    x = np.array([G.nodes[n]["x"] for n in node_ids.tolist()], dtype=np.float64)
+    y = np.array([G.nodes[n]["y"] for n in node_ids.tolist()], dtype=np.float64)
+
+    m = G.number_of_edges()
+    src = np.empty(m, dtype=np.int64)
+    dst = np.empty(m, dtype=np.int64)
+    key = np.empty(m, dtype=np.int64)
+    length = np.empty(m, dtype=np.float64)
+    maxspeed = np.empty(m, dtype=np.float32)
+    name_id = np.empty(m, dtype=np.int32)
+    names = []
+    name_lookup = {}
+    geoms = []
+    for i, (u, v, k, data) in enumerate(G.edges(keys=True, data=True)):
+        src[i], dst[i], key[i] = u, v, k
+        length[i] = data.get("length", 1.0)
+        speed = parse_maxspeed(data.get("maxspeed"))
+        maxspeed[i] = np.nan if speed is None else speed
+        name = normalize_name(data.get("name"))
+        if name not in name_lookup:
+            name_lookup[name] = len(names)
+            names.append(name)
+        name_id[i] = name_lookup[name]
+        if "geometry" in data:
+            geoms.append(np.asarray(data["geometry"].coords, dtype=np.float64)[:, :2])
+        else:
+            # Straight segment between the end nodes, as plot_route draws it
+            geoms.append(np.array([[G.nodes[u]["x"], G.nodes[u]["y"]],
+                                   [G.nodes[v]["x"], G.nodes[v]["y"]]]))
+
+    src = np.searchsorted(node_ids, src)
+    dst = np.searchsorted(node_ids, dst)
+    edge_order = np.lexsort((key, dst, src))
+
+    geoms = [geoms[i] for i in edge_order.tolist()]
+    geom_offsets = np.zeros(m + 1, dtype=np.int64)
+    geom_offsets[1:] = np.cumsum([len(g) for g in geoms])
+    geom_coords = np.concatenate(geoms) if geoms else np.empty((0, 2), dtype=np.float64)
+
+    rg = RoutingGraph(
+        node_ids, x, y,
+        src[edge_order].astype(np.int32), dst[edge_order].astype(np.int32),
+        key[edge_order], length[edge_order], maxspeed[edge_order], name_id[edge_order], names,
+        geom_offsets, geom_coords,
+    )
+    # Position of every RoutingGraph edge in G.edges() iteration order
+    rg.nx_edge_order = edge_order
+    return rg
+
+
+_cache = weakref.WeakKeyDictionary()
+
+
+def as_routing_graph(G):
+    """Return the RoutingGraph for G, building it on first use."""
+    if isinstance(G, RoutingGraph):
+        return G
+    rg = _cache.get(G)
+    if rg is None:
+        rg = from_networkx(G)
+        _cache[G] = rg
+    return rg
+
+
+def invalidate_costs(G):
+    """Drop cached reduced costs after edge attributes of G were rewritten."""
+    rg = _cache.get(G)
+    if rg is not None:
+        rg.clear_costs()
+
+
+def attribute_costs(G, rg, weight):
+    """Per-edge cost vector for a networkx edge attribute, in RoutingGraph edge order."""
+    values = np.fromiter(
+        (data.get(weight, data.get("length", 1)) for _, _, data in G.edges(data=True)),
+        dtype=np.float64, count=rg.num_edges,
+    )
+    return values[rg.nx_edge_order]
+
+
+def costs_for_weight(G, rg, weight, weather=None):
+    """
+    ReducedCosts for an edge attribute name or a per-edge cost vector.
+    With `weather` set, `weight` names a metric of the precomputed cost tables
+    and the graph's edge attributes are not read at all.
+    """
+    if weather is not None:
+        return tables_for(rg).reduced(weather, weight)
+    if isinstance(weight, str):
+        if weight not in rg._reduced:
+            if isinstance(G, RoutingGraph):
+                # Without the networkx graph only the stored lengths are available
+                if weight != "length":
+                    raise ValueError(f"Edge attribute {weight!r} needs a weather cost table on a RoutingGraph")
+                return rg.reduced_costs(rg.edge_length, key=weight)
+            rg.reduced_costs(attribute_costs(G, rg, weight), key=weight)
+        return rg._reduced[weight]
+    return rg.reduced_costs(weight)
+
+
+def _zero_heuristic(u):
+    return 0.0
+
+
+def astar(rg, source, target, pair_cost, heuristic=None, stats=None):
+    """
+    A* over the pair adjacency of a RoutingGraph.
+
+    Parameters:
+    - rg: RoutingGraph
+    - source, target: internal node indices
+    - pair_cost: per-pair costs as a list (ReducedCosts.cost_list)
+    - heuristic: callable node index -> lower bound on the remaining cost;
+                 must be consistent (see heuristics.py). None runs Dijkstra.
+    - stats: optional dict that receives 'expanded' (nodes settled) and
+             'pushes' (heap pushes) counters for the query
+
+    Returns the list of pair indices along the route, or None if the target
+    is unreachable. Only nodes the search touches are stored, so memory per
+    query depends on the explored region rather than on the graph size.
+    """
+    indptr, pair_dst, _, _ = rg.adjacency()
+    if heuristic is None:
+        heuristic = _zero_heuristic
+
+    g_score = {source: 0.0}
+    came_from = {}
+    closed = set()
+    open_set = [(heuristic(source), source)]
+    pushes = 1
+
+    while open_set:
+        _, current = heappop(open_set)
+        if current == target:
+            if stats is not None:
+                stats.update(expanded=len(closed) + 1, pushes=pushes)
+            pairs = []
+            while current in came_from:
+                p = came_from[current]
+                pairs.append(p)
+                current = int(rg.pair_src[p])
+            return pairs[::-1]
+        if current in closed:
+            continue
+        closed.add(current)
+
+        g_current = g_score[current]
+        for p in range(indptr[current], indptr[current + 1]):
+            nbr = pair_dst[p]
+            if nbr in closed:
+                continue
+            tentative_g = g_current + pair_cost[p]
+            if tentative_g < g_score.get(nbr, math.inf):
+                g_score[nbr] = tentative_g
+                came_from[nbr] = p
+                heappush(open_set, (tentative_g + heuristic(nbr), nbr))
+                pushes += 1
+    if stats is not None:
+        stats.update(expanded=len(closed), pushes=pushes)
+    return None
+
+
+def route_from_pairs(rg, source, pairs, best_edge):
+    """Turn a list of pairs into the (node_path, edge_path, road_names) triple of astar_route."""
+    node_path = [int(rg.node_ids[source])]
+    edge_path = []
+    road_names = []
+    for p in pairs:
+        e = best_edge[p]
+        u, v, k = rg.edge_tuple(e)
+        node_path.append(v)
+        edge_path.append((u, v, k))
+        road_names.append(rg.edge_name(e))
+    return node_path, edge_path, road_names
@@ -0,0 +1,438 @@
+"""
+Standalone routing server.
+
+Run from the repository root:
+    python routing_server.py --port 8765 --workers 4
+
+The graph snapshot is loaded once by each of a pool of worker processes
+(route_jobs), which build the cost tables of --weathers before the server
+starts listening. JSON endpoints:
+- POST /route   {"origin": [lat, lng], "dest": [lat, lng], "weather": "Rain",
+                 "job": "cost_risk" | "cost_time" | "options" | "alternatives",
+                 "k": 3 (alternatives only, 1 to MAX_K),
+                 "metrics": ["cost_time", "cost_risk"] (options only)}
+- POST /batch   {"trips": [[origin_lat, origin_lng, dest_lat, dest_lng], ...],
+                 "weather": "Rain", "metric": "cost_time", "paths": false}
+- POST /matrix  {"origins": [[lat, lng], ...], "destinations": [[lat, lng], ...],
+                 "weather": "Rain", "metric": "cost_time", "max_cost": null}
+- GET  /health  worker count, capacity and requests in flight
+- GET  /metrics routing traces and server counters in the Prometheus text format
+
+Every response has a Server-Timing header: queue (waiting for a worker and
+the transfer to and from it), the stages of the worker's trace, compute
+(the worker's total) and total (the whole request). At most workers + queue
+requests are accepted at once; the others get 503 with Retry-After right
+away, so an overloaded server answers quickly instead of piling up work.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import networkx as nx
+import numpy as np
+
+import metrics
+import route_jobs
+import routing_utils as ru
+from batch_routing import NO_PATH, NOT_SNAPPED, OK
+from cost_tables import risk_table_path
+
+DEFAULT_PORT = 8765
+WEATHERS = ("Clear", "Partially cloudy", "Overcast", "Rain")
+MAX_QUEUE = 32  # requests accepted beyond one per worker
+REQUEST_TIMEOUT = 60.0  # seconds
+MAX_BODY = 4 * 2 ** 20  # bytes
+MAX_TRIPS = 10_000  # per /batch request
+MAX_CELLS = 250_000  # per /matrix request
+BATCH_CHUNK = 256  # trips per worker task of a /batch request
+MAX_K = 10  # alternative routes per /route request
+
+ROUTE_JOBS = route_jobs.ROUTE_METRICS + ("options", "alternatives")
+STATUS_NAMES = {OK: "ok", NO_PATH: "no_path", NOT_SNAPPED: "not_snapped"}
+
+
+class RequestError(Exception):
+    """Error answered with an HTTP status and a JSON message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _point(value, name):
+    # (lat, lng) from a JSON [lat, lng] pair or an address string
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list) and len(value) == 2 and all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+        return (float(value[0]), float(value[1]))
+    raise RequestError(400, f"{name} must be [lat, lng] or an address string")
+
+
+def _metric(body):
+    metric = body.get("metric", "cost_time")
+    if metric not in route_jobs.ROUTE_METRICS:
+        raise RequestError(400, f"metric must be one of {', '.join(route_jobs.ROUTE_METRICS)}")
+    return metric
+
+
+def _metrics(body):
+    # Metrics whose optimal route an options job returns; [] for none
+    names = body.get("metrics")
+    if not isinstance(names, list) or not all(isinstance(n, str) and n in route_jobs.ROUTE_METRICS for n in names):
+        raise RequestError(400, f"metrics must be a list of {', '.join(route_jobs.ROUTE_METRICS)}")
+    return tuple(names)
+
+
+def _weather(body):
+    # Workers would fail with FileNotFoundError on a weather without a risk table
+    weather = body.get("weather", "Clear")
+    if not isinstance(weather, str) or not os.path.exists(risk_table_path(weather)):
+        raise RequestError(400, f"No risk table for weather {weather!r}")
+    return weather
+
+
+def _limit(body, name):
+    # Optional non-negative limit (max_snap_distance, max_cost); workers
+    # would fail with a 500 on strings or negative values
+    value = body.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float("inf"):
+        raise RequestError(400, f"{name} must be a non-negative number or null")
+    return float(value)
+
+
+def _k(body):
+    # Number of alternative routes; k <= 0 would make the worker return
+    # every candidate it finds
+    k = body.get("k", 3)
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_K:
+        raise RequestError(400, f"k must be an integer from 1 to {MAX_K}")
+    return k
+
+
+def _finite(values):
+    # JSON has no inf or nan: unreachable or failed entries become null
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+def _jsonable(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class RoutingService:
+    """
+    The worker pool and its admission control, shared by the request threads.
+
+    Parameters:
+    - pool: route_jobs.route_pool executor
+    - workers: number of worker processes of the pool
+    - max_queue: requests accepted beyond one per worker; more get 503
+    - timeout: seconds a request may take before it gets 504
+    """
+
+    def __init__(self, pool, workers, max_queue=MAX_QUEUE, timeout=REQUEST_TIMEOUT):
+        self.pool = pool
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.timeout = timeout
+        self.prometheus = metrics.add_sink(metrics.PrometheusSink())
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.in_flight = 0
+        self.rejected = 0
+        self.started = time.time()
+
+    def admit(self):
+        """Take a slot for a request without waiting; False when the server is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        self._local.running = None
+        return True
+
+    def release(self):
+        """
+        Give back the request's slot. Jobs of a timed-out request that were
+        already running cannot be cancelled, so their slot is only given
+        back when the last of them finishes.
+        """
+        running, self._local.running = self._local.running, None
+        if not running:
+            self._release_slot()
+            return
+        remaining = [len(running)]
+
+        def finished(_):
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._release_slot()
+
+        for future in running:
+            future.add_done_callback(finished)
+
+    def _release_slot(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def run(self, tasks):
+        """
+        Run (fn, *args) tasks on the pool and wait for all of them.
+
+        Returns the results and traces in task order; the traces are also
+        sent to the metrics sinks. Raises RequestError(504) on timeout; the
+        tasks that did not start are cancelled, and the ones still running
+        keep the request's slot (see release).
+        """
+        futures = [self.pool.submit(*task) for task in tasks]
+        done, not_done = wait(futures, timeout=self.timeout)
+        if not_done:
+            self._local.running = [future for future in not_done if not future.cancel()]
+            raise RequestError(504, f"Routing took longer than {self.timeout:g} s")
+        results, traces = [], []
+        for future in futures:
+            result, trace = future.result()
+            metrics.emit(trace)
+            results.append(result)
+            traces.append(trace)
+        return results, traces
+
+    def health(self):
+        with self._lock:
+            return {"status": "ok", "workers": self.workers, "capacity": self.capacity,
+                    "in_flight": self.in_flight, "rejected": self.rejected,
+                    "uptime": round(time.time() - self.started, 1)}
+
+    def render_metrics(self):
+        with self._lock:
+            lines = ["# TYPE routing_server_in_flight gauge", f"routing_server_in_flight {self.in_flight}",
+                     "# TYPE routing_server_rejected_total counter", f"routing_server_rejected_total {self.rejected}"]
+        return self.prometheus.render() + "\n".join(lines) + "\n"
+
+    # Endpoint handlers: parsed JSON body -> (response body, traces)
+
+    def route(self, body):
+        job = body.get("job", "cost_risk")
+        if job not in ROUTE_JOBS:
+            raise RequestError(400, f"job must be one of {', '.join(ROUTE_JOBS)}")
+        origin, dest = _point(body.get("origin"), "origin"), _point(body.get("dest"), "dest")
+        weather = _weather(body)
+        options = {"k": _k(body)} if job == "alternatives" else {}
+        if job == "options" and "metrics" in body:
+            options["metrics"] = _metrics(body)
+        (result,), traces = self.run([(_route_task, job, origin, dest, weather,
+                                       _limit(body, "max_snap_distance"), options)])
+        if job in route_jobs.ROUTE_METRICS:
+            node_path, edge_path, road_names = result
+            result = {"node_path": node_path, "edge_path": edge_path, "road_names": road_names}
+        elif job == "alternatives":
+            result = {"routes": result}
+        return result, traces
+
+    def batch(self, body):
+        trips = body.get("trips")
+        try:
+            trips = np.asarray(trips, dtype=np.float64).reshape(-1, 4)
+        except (TypeError, ValueError):
+            raise RequestError(400, "trips must be a list of [origin_lat, origin_lng, dest_lat, dest_lng]")
+        if len(trips) > MAX_TRIPS:
+            raise RequestError(413, f"At most {MAX_TRIPS} trips per request")
+        metric, weather = _metric(body), _weather(body)
+        paths = bool(body.get("paths", False))
+        # Large batches are split so that every worker takes part
+        chunks = [trips[i:i + BATCH_CHUNK] for i in range(0, len(trips), BATCH_CHUNK)] or [trips]
+        max_snap_distance = _limit(body, "max_snap_distance")
+        results, traces = self.run([(route_jobs.run_batch, chunk, weather, metric,
+                                     max_snap_distance, paths) for chunk in chunks])
+        status = np.concatenate([r["status"] for r in results])
+        response = {
+            "status": [STATUS_NAMES[int(s)] for s in status],
+            "cost": _finite(np.concatenate([r["cost"] for r in results])),
+            "time": _finite(np.concatenate([r["time"] for r in results])),
+            "edge_count": np.concatenate([r["edge_count"] for r in results]).tolist(),
+        }
+        if paths:
+            response["edge_paths"] = [p for r in results for p in r["edge_paths"]]
+        return response, traces
+
+    def matrix(self, body):
+        origins = [_point(p, "origins") for p in body.get("origins") or []]
+        destinations = [_point(p, "destinations") for p in body.get("destinations") or []]
+        if not origins or not destinations:
+            raise RequestError(400, "origins and destinations must be non-empty lists")
+        if len(origins) * len(destinations) > MAX_CELLS:
+            raise RequestError(413, f"At most {MAX_CELLS} matrix cells per request")
+        metric, weather = _metric(body), _weather(body)
+        (result,), traces = self.run([(route_jobs.run_matrix, origins, destinations, weather, metric,
+                                       _limit(body, "max_cost"), _limit(body, "max_snap_distance"))])
+        return {"matrix": [_finite(row) for row in result]}, traces
+
+
+def _route_task(job, origin, dest, weather, max_snap_distance, options):
+    # Module-level so the pool can pickle it
+    return route_jobs.run_job(job, origin, dest, weather, max_snap_distance, **options)
+
+
+def server_timing(traces, total):
+    """Server-Timing header value for the worker traces of a request that took `total` seconds."""
+    # Parallel tasks (chunks of a batch) overlap, so the slowest one counts
+    compute = max((t.total for t in traces), default=0.0)
+    stages = {}
+    for t in traces:
+        for name, seconds in t.stages.items():
+            stages[name] = max(stages.get(name, 0.0), seconds)
+    parts = [("queue", max(total - compute, 0.0))] + list(stages.items()) + [("compute", compute), ("total", total)]
+    return ", ".join(f"{name};dur={seconds * 1e3:.2f}" for name, seconds in parts)
+
+
+class RoutingHandler(BaseHTTPRequestHandler):
+    server_version = "RoutingServer/1.0"
+    # Keep-alive, so load tests and clients reuse their connections
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle's algorithm the
+    # body waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+    disable_nagle_algorithm = True
+    quiet = True
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send_json(200, service.health())
+        elif self.path == "/metrics":
+            self._send(200, service.render_metrics().encode(), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        service = self.server.service
+        handlers = {"/route": service.route, "/batch": service.batch, "/matrix": service.matrix}
+        try:
+            handler = handlers.get(self.path)
+            body = self._read_json()
+            if handler is None:
+                raise RequestError(404, f"Unknown path {self.path}")
+            if not service.admit():
+                self._send_json(503, {"error": "Server busy, retry later"}, {"Retry-After": "1"})
+                return
+            try:
+                response, traces = handler(body)
+            finally:
+                service.release()
+        except RequestError as e:
+            self._send_json(e.status, {"error": str(e)})
+            return
+        except nx.NetworkXNoPath as e:
+            self._send_json(404, {"error": str(e)})
+            return
+        except ValueError as e:
+            # Points too far from the road network, addresses that do not geocode...
+            self._send_json(422, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        response["trace"] = [t.as_dict() for t in traces]
+        self._send_json(200, response, {"Server-Timing": server_timing(traces, time.perf_counter() - start)})
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            raise RequestError(413, f"Request body larger than {MAX_BODY} bytes")
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise RequestError(400, "Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise RequestError(400, "Request body must be a JSON object")
+        return body
+
+    def _send_json(self, status, body, headers=None):
+        self._send(status, json.dumps(body, default=_jsonable).encode(), "application/json", headers)
+
+    def _send(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(snapshot_path, index_path, host="127.0.0.1", port=DEFAULT_PORT, workers=None,
+                max_queue=MAX_QUEUE, weathers=WEATHERS, timeout=REQUEST_TIMEOUT):
+    """
+    Start the worker pool, wait until every worker has loaded the graph and
+    its cost tables, and return a ThreadingHTTPServer bound to (host, port).
+    Call serve_forever() on it; server.service.pool must be shut down after.
+    """
+    workers = workers or route_jobs.default_workers()
+    pool = route_jobs.route_pool(snapshot_path, index_path, workers, weathers)
+    route_jobs.warm_pool(pool, workers)
+    server = ThreadingHTTPServer((host, port), RoutingHandler)
+    server.service = RoutingService(pool, workers, max_queue, timeout)
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Routing server with JSON endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, help="worker processes (default: all cores but one)")
+    parser.add_argument("--queue", type=int, default=MAX_QUEUE,
+                        help="requests accepted beyond one per worker before answering 503")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="seconds per request")
+    parser.add_argument("--snapshot", default=ru.SNAPSHOT_PATH)
+    parser.add_argument("--index", default=None, help="saved spatial index (default: SNAPSHOT.kdtree)")
+    parser.add_argument("--weathers", nargs="+", default=list(WEATHERS), help="cost tables built at start")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.snapshot == ru.SNAPSHOT_PATH and not os.path.exists(args.snapshot):
+        ru.load_graph()  # builds the snapshot and its spatial index
+    index = args.index or args.snapshot + ".kdtree"
+    print("Starting routing workers...")
+    server = make_server(args.snapshot, index, args.host, args.port, args.workers, args.queue,
+                         args.weathers, args.timeout)
+    RoutingHandler.quiet = not args.verbose
+    service = server.service
+    print(f"Routing server on http://{args.host}:{server.server_address[1]} "
+          f"({service.workers} workers, {service.capacity} requests at most)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,230 +1,281 @@
 import osmnx as ox
-import pandas as pd
-from routing import astar_route
+import numpy as np
+from routing import astar_route, ch_route
+from corridor import corridor_route
+from multi_objective import route_options
+from alternatives import alternative_routes
+from routing_engine import as_routing_graph, from_networkx, invalidate_costs
+from graph_snapshot import load_snapshot, write_snapshot
+from spatial_index import spatial_index_for
+from cost_tables import compute_cost_table, tables_for
+from boundary_cache import boundary_layer, DEFAULT_TOLERANCE, PLACES
 import folium
 import matplotlib.pyplot as plt
+import math
+import metrics
 import os
-import regex as re
-
-def load_graph():
-    # Load the LA driving graph
-    places = [
-        "Los Angeles, California, USA",
-        "Santa Monica, California, USA",
-        "Beverly Hills, California, USA",
-        "West Hollywood, California, USA",
-        "Culver City, California, USA",
-        "Inglewood, California, USA",
-        "Glendale, California, USA",
-        "Burbank, California, USA",
-        "Pasadena, California, USA"
-    ]
-
-    if not os.path.exists("data/la.graphml"):
+from shapely.geometry import LineString
+
+GRAPHML_PATH = "data/la.graphml"
+SNAPSHOT_PATH = "data/la.graph"
+SPATIAL_INDEX_PATH = "data/la.graph.kdtree"
+
+
+def load_graph(snapshot=True):
+    # Load the LA driving graph.
+    # With snapshot=True a RoutingGraph is memory-mapped from the binary
+    # snapshot, which is written from the GraphML the first time (or whenever
+    # the GraphML is newer). Its KD-tree snapping index is loaded from (or
+    # built and saved to) SPATIAL_INDEX_PATH alongside it.
+    # Pass snapshot=False for the full networkx graph.
+    if snapshot and os.path.exists(SNAPSHOT_PATH) and (
+            not os.path.exists(GRAPHML_PATH)
+            or os.path.getmtime(SNAPSHOT_PATH) >= os.path.getmtime(GRAPHML_PATH)):
+        rg = load_snapshot(SNAPSHOT_PATH)
+        spatial_index_for(rg, SPATIAL_INDEX_PATH)
+        return rg
+
+    if not os.path.exists(GRAPHML_PATH):
         # Download the graph and save it to a file
-        G = ox.graph_from_place(places, network_type="drive")
-        ox.save_graphml(G, "data/la.graphml")
+        G = ox.graph_from_place(PLACES, network_type="drive")
+        ox.save_graphml(G, GRAPHML_PATH)
 
     else:
-        G = ox.load_graphml("data/la.graphml")
+        G = ox.load_graphml(GRAPHML_PATH)
+
+    if snapshot:
+        write_snapshot(from_networkx(G), SNAPSHOT_PATH, meta={"source": GRAPHML_PATH})
+        rg = load_snapshot(SNAPSHOT_PATH)
+        spatial_index_for(rg, SPATIAL_INDEX_PATH)
+        return rg
     return G
 
 
-def city_overlay_helper(m):
-    places = [
-        "Los Angeles, California, USA",
-        "Santa Monica, California, USA",
-        "Beverly Hills, California, USA",
-        "West Hollywood, California, USA",
-        "Culver City, California, USA",
-        "Inglewood, California, USA",
-        "Glendale, California, USA",
-        "Burbank, California, USA",
-        "Pasadena, California, USA"
-    ]
-    for place in places:
-        gdf = ox.geocode_to_gdf(place)
-        folium.GeoJson(
-            gdf.geometry.iloc[0],
-            name=place,
-            style_function=lambda x: {
-                'color': 'blue',
-                'weight': 2,
-                'fillOpacity': 0.15
-            }
-        ).add_to(m)
+def city_overlay_helper(m, tolerance=DEFAULT_TOLERANCE):
+    # Overlay the study area boundaries as one simplified GeoJSON layer read
+    # from the local boundary cache (data/boundaries), so no geocoding
+    # requests are made when a map is built
+    folium.GeoJson(
+        boundary_layer(tolerance),
+        name="City boundaries",
+        style_function=lambda x: {
+            'color': 'blue',
+            'weight': 2,
+            'fillOpacity': 0.15
+        }
+    ).add_to(m)
     return m
 
-def parse_maxspeed(value):
-    if isinstance(value, list):
-        value = value[0]
-    if isinstance(value, str):
-        match = re.search(r"\d+", value)
-        if match:
-            return float(match.group())
-    elif isinstance(value, (int, float)):
-        return float(value)
-    return None
-
 def get_edge_data(G, weather="Clear"): # Pick one of: Clear, Partially cloudy, Overcast, Rain
-    risk_csv = os.path.join("risk_maps/", f"{weather.replace(', ', '_').replace(' ', '_')}.csv")
-    risk_df = pd.read_csv(risk_csv)
-    risk_lookup = dict(zip(risk_df["road_name"], risk_df["risk_score"]))
-
-    for u, v, key, data in G.edges(keys=True, data=True):
-        # Length
-        length = data.get("length", 1.0)
-        data["cost_distance"] = length
-
-        # Risk
-        name = data.get("name")
-        if isinstance(name, list): name = name[0]
-        if not name: name = "Unnamed Road"
-        risk = risk_lookup.get(name, 0.0) # 0.0 default fallback
-        data["cost_risk"] = length * (1 + risk)
-
-        # Time (travel time in hours)
-        maxspeed = parse_maxspeed(data.get("maxspeed"))
-        if not maxspeed or maxspeed <= 0:
-            maxspeed = 50  # Default speed in km/h
-
-        time_hours = (length / 1000) / maxspeed
-        data["cost_time"] = time_hours
+    # Writes cost_distance, cost_risk and cost_time onto every edge of G.
+    # Values come from the same vectorized cost table the router uses, so
+    # per-edge risk from risk_map_gen --level edge is picked up here too
+    rg = as_routing_graph(G)
+    costs = compute_cost_table(rg, weather)
+    # Cost tables are in RoutingGraph edge order; nx_edge_order maps G's edge order onto it
+    position = np.empty(rg.num_edges, dtype=np.int64)
+    position[rg.nx_edge_order] = np.arange(rg.num_edges)
+    columns = {metric: costs[metric][position].tolist() for metric in ("cost_distance", "cost_risk", "cost_time")}
+
+    for i, (u, v, key, data) in enumerate(G.edges(keys=True, data=True)):
+        data["cost_distance"] = columns["cost_distance"][i]
+        data["cost_risk"] = columns["cost_risk"][i]
+        data["cost_time"] = columns["cost_time"][i]
+
+    # Costs changed, so the routing engine must re-reduce parallel edges
+    invalidate_costs(G)
     return G
 
 
-def path_finding(G, cost_attribute, origin, dest, weather):
-    G = get_edge_data(G, weather)
-
-    # Compute the route based on the selected cost attribute
-    node_path, edge_path, road_names = astar_route(
-        G,
-        origin_point=origin,
-        destination_point=dest,
-        weight=cost_attribute,
-    )
-    
-    print(node_path)
-    print(f"Number of nodes in path {cost_attribute}: {len(node_path)}")
-    print(f"Number of edges in path {cost_attribute}: {len(edge_path)}")
-    print(f"Roads to follow {cost_attribute}: ", road_names)
+def route_cost(G, edge_path, cost_attribute, weather):
+    # Sum a cost metric along an edge path using the precomputed cost tables
+    rg = as_routing_graph(G)
+    costs = tables_for(rg).get(weather, cost_attribute)
+    return float(sum(costs[rg.edge_index(u, v, key)] for u, v, key in edge_path))
+
+
+@metrics.traced("path_finding")
+def path_finding(G, cost_attribute, origin, dest, weather, max_snap_distance=None, alt=False, ch=False,
+                 corridor=False):
+    # Compute the route based on the selected cost attribute; costs come from
+    # the per-weather cost tables, so the shared graph is left untouched.
+    # ch=True answers from the precomputed contraction hierarchy instead of A*,
+    # corridor=True searches a region around the trip first (see corridor.py).
+    # Stage timings and search counters (nodes expanded, route nodes, edges
+    # and roads) go to the metrics sinks instead of stdout
+    metrics.label(weather=weather, metric=cost_attribute)
+    if ch:
+        node_path, edge_path, road_names = ch_route(
+            G, origin, dest, weight=cost_attribute, weather=weather,
+            max_snap_distance=max_snap_distance,
+        )
+    elif corridor:
+        node_path, edge_path, road_names = corridor_route(
+            G, origin, dest, weight=cost_attribute, weather=weather,
+            max_snap_distance=max_snap_distance,
+        )
+    else:
+        node_path, edge_path, road_names = astar_route(
+            G,
+            origin_point=origin,
+            destination_point=dest,
+            weight=cost_attribute,
+            weather=weather,
+            max_snap_distance=max_snap_distance,
+            alt=alt,
+        )
+
+    metrics.count(route_nodes=len(node_path), route_roads=len(road_names))
     return edge_path
 
-def plot_route(G, edge_path, m, cost_attribute, origin, dest):
-    counter = -1
+def alternative_paths(G, cost_attribute, origin, dest, weather, k=3, max_snap_distance=None):
+    # Up to k clearly different routes for the cost attribute, best first
+    # (see alternatives.py); returns their edge paths, ready for plot_route.
+    # Route count and candidates go to the metrics sinks
+    routes = alternative_routes(G, origin, dest, weather, metric=cost_attribute, k=k,
+                                max_snap_distance=max_snap_distance)
+    return [route["edge_path"] for route in routes]
+
+# Color of every risk level the colormap distinguishes; matplotlib maps a
+# float x to entry min(int(x * 256), 255) and an int i to entry i, so
+# lookups give identical colors
+_cmap = plt.get_cmap("RdYlGn_r")  # reverse of green→red
+RISK_COLORS = [
+    '#{:02x}{:02x}{:02x}'.format(*(int(c * 255) for c in _cmap(i)[:3]))
+    for i in range(_cmap.N)
+]
+
+
+# Define a color scale for risk (0.0 = green, 1.0+ = red)
+def risk_to_color(risk):
+    # Clamp risk between 0 and 1
+    risk = min(max(risk*10, 0), 1)
+    # Same lookup as cmap(risk): ints index the table, floats are scaled to it
+    if isinstance(risk, int):
+        return RISK_COLORS[risk]
+    return RISK_COLORS[min(int(risk * len(RISK_COLORS)), len(RISK_COLORS) - 1)]
+
+
+def simplify_tolerance(m, lat, zoom_margin=2):
+    # Size of a map pixel in degrees at `zoom_margin` levels above the map's
+    # zoom, so simplification stays invisible until zoomed in that far
+    zoom = m.options.get("zoom", 12) + zoom_margin
+    meters = 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom
+    return meters / 111320
+
+
+@metrics.traced("plot_route")
+def plot_route(G, edge_path, m, cost_attribute, origin, dest, weather=None, tolerance=None):
+    # Edge attributes are read through the RoutingGraph, so G can be either
+    # the networkx graph or a RoutingGraph loaded from a snapshot.
+    # Consecutive edges with the same color and popup are merged into one
+    # line, simplified to the map's zoom (or `tolerance` in degrees, 0 to
+    # keep every vertex), and the route is added as a single GeoJSON layer
+    rg = as_routing_graph(G)
+    if weather is not None:
+        risk_costs = tables_for(rg).get(weather, "cost_risk")
+    if tolerance is None:
+        tolerance = simplify_tolerance(m, origin[0])
+
+    metrics.label(metric=cost_attribute)
+    metrics.count(route_edges=len(edge_path))
+    runs = []  # [color, popup, coords]
     for u, v, key in edge_path:
-        data = G.edges[u, v, key]
-        counter += 1
+        e = rg.edge_index(u, v, key)
+        coords = rg.edge_coords(e)
+        name = rg.edge_name(e)
 
-        # Determine geometry
-        if 'geometry' in data:
-            line = data['geometry']
-            coords = [(lat, lon) for lon, lat in line.coords]
-        else:
-            point_u = (G.nodes[u]['y'], G.nodes[u]['x'])
-            point_v = (G.nodes[v]['y'], G.nodes[v]['x'])
-            coords = [point_u, point_v]
-    
         # Determine color and popup based on cost type
         if cost_attribute == "cost_risk":
-            length = data.get("length", 1.0)
-            cost_risk = data.get("cost_risk", length)
+            length = rg.edge_length[e]
+            if weather is not None:
+                cost_risk = risk_costs[e]
+            elif G is not rg:
+                cost_risk = G.edges[u, v, key].get("cost_risk", length)
+            else:
+                cost_risk = length
             base_risk = (cost_risk / length) - 1
             color = risk_to_color(base_risk)
-            if counter == 0:
-                first_color = color
-            elif counter == len(edge_path) - 1:
-                last_color = color
-            popupString = f"{data.get('name', 'Unnamed Road')}<br>Risk: {base_risk:.2f}"
-            
+            popupString = f"{name}<br>Risk: {base_risk:.2f}"
         else:
             color = "blue"
-            if counter == 0:
-                first_color = color
-            elif counter == len(edge_path) - 1:
-                last_color = color
-            popupString = f"{data.get('name', 'Unnamed Road')}<br>Fastest Route"
-
-        folium.PolyLine(
-            locations=coords,
-            color=color,
-            weight=5,
-            opacity=0.8,
-            popup=popupString
-        ).add_to(m)
-
-    
-    first_u, first_v, first_key = edge_path[0]
-    data_first = G.edges[first_u, first_v, first_key]
-    last_u, last_v, last_key = edge_path[-1]
-    data_last = G.edges[last_u, last_v, last_key]
-
-    if 'geometry' in data_last:
-        last_coords = (data_last['geometry'].coords[-1][1], data_last['geometry'].coords[-1][0])  # (lat, lon)
-    else:
-        last_coords = (G.nodes[last_v]['y'], G.nodes[last_v]['x'])  # fallback if no geometry
-    if 'geometry' in data_first:
-        first_node_coords = (data_first['geometry'].coords[0][1], data_first['geometry'].coords[0][0])  # (lat, lon)
-    else:
-        first_node_coords = (G.nodes[first_u]['y'], G.nodes[first_u]['x'])
-
-
-    # Add the start coords to first node line and end coords to last node line
-    folium.PolyLine(locations=[origin, first_node_coords],
-                    color=first_color,
-                    weight=5,
-                    opacity=0.8,
-                    popup=popupString
-                    ).add_to(m)
-    
-
-    folium.PolyLine(locations=[last_coords, dest],
-                color=last_color,
-                weight=5,
-                opacity=0.8,
-                popup=popupString
-                ).add_to(m)
-    
+            popupString = f"{name}<br>Fastest Route"
+
+        if runs and runs[-1][0] == color and runs[-1][1] == popupString:
+            runs[-1][2].extend(coords[1:])
+        else:
+            runs.append([color, popupString, list(coords)])
+
+    # Add the start coords to first node line and end coords to last node line;
+    # both connectors show the popup of the last edge
+    first_color, last_color = runs[0][0], runs[-1][0]
+    lines = [(first_color, popupString, [origin, runs[0][2][0]])]
+    lines += [tuple(run) for run in runs]
+    lines.append((last_color, popupString, [runs[-1][2][-1], dest]))
+
+    metrics.count(features=len(lines))
+    features = []
+    for color, popup, coords in lines:
+        line = LineString([(lon, lat) for lat, lon in coords])
+        if tolerance > 0 and len(coords) > 2:
+            line = line.simplify(tolerance, preserve_topology=False)
+        features.append({
+            "type": "Feature",
+            "properties": {"color": color, "popup": popup},
+            "geometry": {"type": "LineString",
+                         "coordinates": [[round(x, 6), round(y, 6)] for x, y in line.coords]},
+        })
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name="Safest route" if cost_attribute == "cost_risk" else "Fastest route",
+        style_function=lambda f: {
+            'color': f['properties']['color'],
+            'weight': 5,
+            'opacity': 0.8
+        },
+        on_each_feature=folium.JsCode(
+            "function(feature, layer) { layer.bindPopup(feature.properties.popup); }"
+        ),
+    ).add_to(m)
+
     # Add start and end markers
     folium.Marker(origin, tooltip="Start", icon=folium.Icon(color="green")).add_to(m)
     folium.Marker(dest, tooltip="Destination", icon=folium.Icon(color="red")).add_to(m)
 
 
-# Define a color scale for risk (0.0 = green, 1.0+ = red)
-def risk_to_color(risk):
-    # Clamp risk between 0 and 1
-    risk = min(max(risk*10, 0), 1)
-    # Use a color map (green to red)
-    cmap = plt.get_cmap("RdYlGn_r")  # reverse of green→red
-    r, g, b, _ = cmap(risk)
-    return f'#{int(r*255):02x}{int(g*255):02x}{int(b*255):02x}'
-
-
 def VisualizeMap(G, origin, dest, weather):
-    edge_path = path_finding(G, "cost_risk", origin, dest, weather)
-    edge_path_fast = path_finding(G, "cost_time", origin, dest, weather)
+    # Safest, fastest and trade-off routes from a single call
+    options = route_options(G, origin, dest, weather)
+    edge_path = options["best"]["cost_risk"]["edge_path"]
+    edge_path_fast = options["best"]["cost_time"]["edge_path"]
     # Calculate total travel time for each route (in minutes)
-    total_time_risk = sum(G.edges[u, v, key]["cost_time"] for u, v, key in edge_path) * 60
-    total_time_fast = sum(G.edges[u, v, key]["cost_time"] for u, v, key in edge_path_fast) * 60
+    total_time_risk = options["best"]["cost_risk"]["total_time"] * 60
+    total_time_fast = options["best"]["cost_time"]["total_time"] * 60
+    tradeoffs = "".join(
+        f"Trade-off: {r['total_time'] * 60:.1f} min, risk {r['total_risk'] / 1000:.1f}<br>"
+        for r in options["pareto"][1:-1]
+    )
 
     # Create a folium map centered on the origin
     m = folium.Map(location=origin, zoom_start=13)
     m = city_overlay_helper(m) # helper function to overlay LA city boundary
 
-    plot_route(G, edge_path, m, "cost_risk", origin, dest)
-    plot_route(G, edge_path_fast, m, "cost_time", origin, dest)
+    plot_route(G, edge_path, m, "cost_risk", origin, dest, weather)
+    plot_route(G, edge_path_fast, m, "cost_time", origin, dest, weather)
 
 
 
     # Add info box with travel times
     info_html = f"""
     <div style="position: fixed; 
-                top: 10px; left: 60px; width: 250px; height: 100px; 
+                top: 10px; left: 60px; width: 250px; min-height: 100px; 
                 background-color: white; z-index:9999; font-size:14px;
                 border:2px solid grey; padding: 10px;">
     <b>Route Time Estimates</b><br>
     <span style='color:black;'>Safest route: </span>{total_time_risk:.1f} min<br>
-    <span style='color:blue;'>Fastest route: </span>{total_time_fast:.1f} min
+    <span style='color:blue;'>Fastest route: </span>{total_time_fast:.1f} min<br>
+    {tradeoffs}
     </div>
     """
     m.get_root().html.add_child(folium.Element(info_html))
@@ -0,0 +1,187 @@
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+R = 6371000  # Earth radius in meters
+
+INDEX_VERSION = 1
+
+
+class SpatialIndex:
+    """
+    KD-tree snapping index over the nodes and edge geometries of a RoutingGraph.
+
+    Coordinates are projected to a local equirectangular plane in meters,
+    which is accurate to well under a meter at city scale. Edge geometries
+    are cut into segments no longer than `max_segment_length`, and the edge
+    tree indexes segment midpoints: a segment can be at most half its length
+    closer than its midpoint, which bounds the candidate search exactly.
+
+    All query methods take arrays of latitudes and longitudes and are
+    vectorized over them. With `max_distance` set, points farther than that
+    (in meters) from the graph get index -1.
+    """
+
+    def __init__(self, rg, max_segment_length=100.0):
+        self.signature = graph_signature(rg)
+        self.lat0 = float(np.radians(np.mean(rg.y))) if rg.num_nodes else 0.0
+
+        self.node_tree = cKDTree(self._project(rg.y, rg.x))
+
+        # Segments of every edge geometry, split so none is longer than max_segment_length
+        coords = self._project(rg.geom_coords[:, 1], rg.geom_coords[:, 0])
+        offsets = np.asarray(rg.geom_offsets)
+        counts = np.diff(offsets)
+        seg_edge = np.repeat(np.arange(rg.num_edges), np.maximum(counts - 1, 0))
+        is_start = np.ones(len(coords), dtype=bool)
+        is_start[offsets[1:] - 1] = False  # last vertex of each edge starts no segment
+        start = coords[is_start]
+        end = coords[np.flatnonzero(is_start) + 1]
+
+        pieces = np.maximum(np.ceil(np.hypot(*(end - start).T) / max_segment_length), 1).astype(np.int64)
+        rep = np.repeat(np.arange(len(start)), pieces)
+        step = np.arange(len(rep)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = (step / pieces[rep])[:, None]
+        t1 = ((step + 1) / pieces[rep])[:, None]
+        delta = end[rep] - start[rep]
+        self.seg_start = start[rep] + t0 * delta
+        self.seg_end = start[rep] + t1 * delta
+        self.seg_edge = seg_edge[rep]
+        seg_len = np.hypot(*(self.seg_end - self.seg_start).T)
+        self.max_half_length = float(seg_len.max() / 2) if len(seg_len) else 0.0
+        self.seg_tree = cKDTree((self.seg_start + self.seg_end) / 2)
+
+    def _project(self, lat, lng):
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lng = np.radians(np.asarray(lng, dtype=np.float64))
+        return np.column_stack((R * lng * np.cos(self.lat0), R * lat))
+
+    def _unproject(self, xy):
+        lat = np.degrees(xy[:, 1] / R)
+        lng = np.degrees(xy[:, 0] / (R * np.cos(self.lat0)))
+        return lat, lng
+
+    def nearest_nodes(self, lat, lng, max_distance=None):
+        """
+        Nearest graph node for every point.
+
+        Returns (nodes, distances): internal node indices and distances in meters.
+        """
+        points = self._project(np.atleast_1d(lat), np.atleast_1d(lng))
+        valid = np.isfinite(points).all(axis=1)
+        dist = np.full(len(points), np.inf)
+        nodes = np.full(len(points), -1, dtype=np.int64)
+        if valid.any():
+            dist[valid], nodes[valid] = self.node_tree.query(points[valid])
+        if max_distance is not None:
+            nodes[dist > max_distance] = -1
+        return nodes, dist
+
+    def _project_on_segments(self, points, segs):
+        start, end = self.seg_start[segs], self.seg_end[segs]
+        delta = end - start
+        denom = (delta ** 2).sum(axis=-1)
+        t = np.where(denom > 0, ((points - start) * delta).sum(axis=-1) / np.where(denom > 0, denom, 1), 0)
+        t = np.clip(t, 0, 1)
+        proj = start + t[..., None] * delta
+        return proj, np.hypot(*np.moveaxis(points - proj, -1, 0))
+
+    def _nearest_segments(self, points, k=8):
+        n = len(points)
+        best_seg = np.full(n, -1, dtype=np.int64)
+        best_dist = np.full(n, np.inf)
+        best_proj = np.full((n, 2), np.nan)
+        valid = np.isfinite(points).all(axis=1)
+        if not valid.any() or len(self.seg_edge) == 0:
+            return best_seg, best_dist, best_proj
+
+        pts = points[valid]
+        k = min(k, len(self.seg_edge))
+        mid_dist, segs = self.seg_tree.query(pts, k=k)
+        mid_dist, segs = mid_dist.reshape(len(pts), k), segs.reshape(len(pts), k)
+        proj, dist = self._project_on_segments(pts[:, None, :], segs)
+        j = np.argmin(dist, axis=1)
+        rows = np.arange(len(pts))
+        seg, d, p = segs[rows, j], dist[rows, j], proj[rows, j]
+
+        # Any segment not among the k candidates has a midpoint at least mid_dist[:, -1]
+        # away, so it can only be closer if mid_dist[:, -1] - max_half_length < d
+        for i in np.flatnonzero(mid_dist[:, -1] - self.max_half_length < d):
+            cand = np.array(self.seg_tree.query_ball_point(pts[i], d[i] + self.max_half_length))
+            if len(cand):
+                cp, cd = self._project_on_segments(pts[i], cand)
+                c = np.argmin(cd)
+                if cd[c] < d[i]:
+                    seg[i], d[i], p[i] = cand[c], cd[c], cp[c]
+
+        best_seg[valid], best_dist[valid], best_proj[valid] = seg, d, p
+        return best_seg, best_dist, best_proj
+
+    def nearest_edges(self, lat, lng, max_distance=None):
+        """
+        Nearest edge (by geometry) for every point.
+
+        Returns (edges, distances): internal edge indices and distances in meters.
+        """
+        segs, dist, _ = self._nearest_segments(self._project(np.atleast_1d(lat), np.atleast_1d(lng)))
+        edges = np.where(segs >= 0, self.seg_edge[np.maximum(segs, 0)], -1)
+        if max_distance is not None:
+            edges[dist > max_distance] = -1
+        return edges, dist
+
+    def project_to_edges(self, lat, lng, max_distance=None):
+        """
+        Closest point on the nearest edge for every point.
+
+        Returns (edges, proj_lat, proj_lng, distances).
+        """
+        segs, dist, proj = self._nearest_segments(self._project(np.atleast_1d(lat), np.atleast_1d(lng)))
+        edges = np.where(segs >= 0, self.seg_edge[np.maximum(segs, 0)], -1)
+        if max_distance is not None:
+            edges[dist > max_distance] = -1
+        proj_lat, proj_lng = self._unproject(proj)
+        return edges, proj_lat, proj_lng, dist
+
+    def matches(self, rg):
+        return self.signature == graph_signature(rg)
+
+
+def graph_signature(rg):
+    # Cheap fingerprint to detect an index saved for a different graph
+    return (rg.num_nodes, rg.num_edges, len(rg.geom_coords),
+            float(np.sum(rg.x)), float(np.sum(rg.y)))
+
+
+def save_spatial_index(index, path):
+    with open(path, "wb") as f:
+        pickle.dump((INDEX_VERSION, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_spatial_index(path, rg=None):
+    """Load a saved index; returns None if it is missing, outdated or built for another graph."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        version, index = pickle.load(f)
+    if version != INDEX_VERSION or (rg is not None and not index.matches(rg)):
+        return None
+    return index
+
+
+def spatial_index_for(rg, path=None):
+    """
+    The SpatialIndex attached to a RoutingGraph. On first use it is loaded
+    from `path` if a matching index was saved there, otherwise built (and
+    saved to `path` when one is given).
+    """
+    index = getattr(rg, "spatial_index", None)
+    if index is None:
+        index = load_spatial_index(path, rg) if path else None
+        if index is None:
+            index = SpatialIndex(rg)
+            if path:
+                save_spatial_index(index, path)
+        rg.spatial_index = index
+    return index
@@ -0,0 +1,149 @@
+import folium
+import numpy as np
+import shapely
+from scipy.sparse.csgraph import dijkstra
+from shapely.geometry import MultiPoint, mapping
+
+from routing import geocode_point, snap_error
+from routing_engine import as_routing_graph
+from cost_tables import tables_for
+from heuristics import cost_matrix, reverse_cost_matrix
+from spatial_index import spatial_index_for
+
+
+# Bytes of Dijkstra distances held at once: sweeps run in chunks of sources
+# and only the target columns of each chunk are kept
+SWEEP_BYTES = 32 * 2 ** 20
+
+# Width in degrees (about 50 m) given to isochrones whose reached nodes lie
+# on one line, where the hull is a LineString instead of a Polygon
+ISOCHRONE_BUFFER = 0.0005
+
+
+def _snap(rg, points, max_snap_distance):
+    points = [geocode_point(p) for p in points]
+    lat = np.array([p[0] for p in points], dtype=np.float64)
+    lng = np.array([p[1] for p in points], dtype=np.float64)
+    nodes, _ = spatial_index_for(rg).nearest_nodes(lat, lng, max_distance=max_snap_distance)
+    return nodes
+
+
+def many_to_many(G, origins, destinations, weather, metric="cost_time", max_cost=None,
+                 max_snap_distance=None):
+    """
+    Cost matrix between every origin and every destination.
+
+    Runs one Dijkstra sweep per origin on the road graph, or one per
+    destination on the reversed graph when there are fewer destinations.
+    Sweeps run in chunks of at most SWEEP_BYTES of distances, so memory
+    grows with origins times destinations, not with the graph size.
+    With `max_cost` set, sweeps stop at that cost and pairs beyond it are inf.
+
+    Parameters:
+    - G: networkx.MultiDiGraph or RoutingGraph
+    - origins, destinations: lists of (lat, lng) tuples or address strings
+    - weather, metric: cost table to use (cost_time is in hours)
+    - max_cost: optional cost bound for early termination
+    - max_snap_distance: see astar_route; points that cannot be snapped give inf
+
+    Returns a (len(origins), len(destinations)) float64 NumPy array.
+    """
+    rg = as_routing_graph(G)
+    reduced = tables_for(rg).reduced(weather, metric)
+    sources = _snap(rg, origins, max_snap_distance)
+    targets = _snap(rg, destinations, max_snap_distance)
+    limit = np.inf if max_cost is None else max_cost
+
+    result = np.full((len(sources), len(targets)), np.inf)
+    forward = len(np.unique(sources)) <= len(np.unique(targets))
+    sweep_nodes, other_nodes = (sources, targets) if forward else (targets, sources)
+    matrix = cost_matrix(rg, reduced) if forward else reverse_cost_matrix(rg, reduced)
+
+    valid_sweep = np.flatnonzero(sweep_nodes >= 0)
+    valid_other = np.flatnonzero(other_nodes >= 0)
+    if len(valid_sweep) and len(valid_other):
+        unique, inverse = np.unique(sweep_nodes[valid_sweep], return_inverse=True)
+        columns = other_nodes[valid_other]
+        costs = np.empty((len(unique), len(columns)))
+        chunk = max(1, SWEEP_BYTES // (8 * rg.num_nodes))
+        for i in range(0, len(unique), chunk):
+            dist = dijkstra(matrix, indices=unique[i:i + chunk], limit=limit)
+            costs[i:i + chunk] = dist.reshape(-1, rg.num_nodes)[:, columns]
+        block = costs[inverse]
+        if forward:
+            result[np.ix_(valid_sweep, valid_other)] = block
+        else:
+            result[np.ix_(valid_other, valid_sweep)] = block.T
+    return result
+
+
+def one_to_many(G, origin, destinations, weather, metric="cost_time", max_cost=None,
+                max_snap_distance=None):
+    """Costs from one origin to every destination, as a 1-D array (see many_to_many)."""
+    return many_to_many(G, [origin], destinations, weather, metric, max_cost, max_snap_distance)[0]
+
+
+def isochrones(G, origin, weather, max_costs, metric="cost_time", ratio=0.3,
+               max_snap_distance=None):
+    """
+    Areas reachable from `origin` within each cost bound, from a single sweep
+    that stops at the largest bound.
+
+    Parameters:
+    - G: networkx.MultiDiGraph or RoutingGraph
+    - origin: (lat, lng) tuple or address string
+    - weather: weather condition of the cost tables
+    - max_costs: list of bounds in the metric's unit, e.g. [5 / 60, 10 / 60]
+                 hours for 5 and 10 minute isochrones with cost_time
+    - ratio: shapely concave_hull ratio; 1 gives the convex hull
+    - max_snap_distance: see astar_route
+
+    Returns a list of shapely Polygons in (lng, lat) coordinates, one per
+    bound (None when nothing but the origin is reachable). When the reached
+    nodes lie on one line, e.g. along a single road, the polygon is their
+    hull widened by ISOCHRONE_BUFFER.
+    """
+    rg = as_routing_graph(G)
+    reduced = tables_for(rg).reduced(weather, metric)
+    origin = geocode_point(origin)
+    source = _snap(rg, [origin], max_snap_distance)[0]
+    if source < 0:
+        raise snap_error(origin, max_snap_distance)
+
+    dist = dijkstra(cost_matrix(rg, reduced), indices=source, limit=max(max_costs))
+    polygons = []
+    for bound in max_costs:
+        reached = np.flatnonzero(dist <= bound)
+        if len(reached) < 2:
+            polygons.append(None)
+            continue
+        points = MultiPoint(np.column_stack((rg.x[reached], rg.y[reached])))
+        hull = shapely.concave_hull(points, ratio=ratio)
+        if hull.geom_type != "Polygon":
+            hull = hull.buffer(ISOCHRONE_BUFFER)
+        polygons.append(hull)
+    return polygons
+
+
+def add_isochrones(m, polygons, labels=None, colors=("#2b83ba", "#abdda4", "#fdae61", "#d7191c")):
+    """
+    Draw isochrone polygons on a folium map, e.g. the one built by VisualizeMap.
+    Larger areas are drawn first so smaller ones stay visible on top.
+    """
+    labels = labels or [f"Isochrone {i + 1}" for i in range(len(polygons))]
+    order = sorted(range(len(polygons)), key=lambda i: -(polygons[i].area if polygons[i] else 0))
+    for i in order:
+        if polygons[i] is None:
+            continue
+        color = colors[i % len(colors)]
+        folium.GeoJson(
+            mapping(polygons[i]),
+            name=labels[i],
+            tooltip=labels[i],
+            style_function=lambda x, color=color: {
+                'color': color,
+                'weight': 2,
+                'fillOpacity': 0.25
+            }
+        ).add_to(m)
+    return m